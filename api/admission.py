@@ -0,0 +1,303 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import random
+import time
+from contextlib import asynccontextmanager
+from email.utils import parsedate_to_datetime
+
+import anthropic
+import httpx
+import openai
+
+from settings import PROVIDER_MAX_CONCURRENCY, PROVIDER_QUEUE_SIZE, PROVIDER_RPM, PROVIDER_TPM, PROVIDER_MAX_RETRIES, \
+    PROVIDER_RETRY_BASE, PROVIDER_RETRY_MAX, CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+# 调用 provider 之前的准入控制：并发上限 + 按优先级排队（首次回复优先于审查和修改）、
+# 每分钟请求数 / token 数的令牌桶、遵守 Retry-After 的指数退避重试，以及熔断器。
+# 状态保存在进程内，由同一个 worker 里的所有请求共享。
+
+# Lower runs first. Roles that are not listed queue behind everything else.
+ROLE_PRIORITY = {"initial": 0, "critique": 1, "refine": 2, "summarize": 3}
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504, 529}
+
+
+class ProviderUnavailable(Exception):
+    """Raised when a call is rejected without reaching the provider (circuit open or queue full)."""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """Refills `per_minute` units per minute up to a burst of the same size. A rate of 0 disables the bucket."""
+
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def take(self, amount: float):
+        if not self.rate:
+            return
+        # A single request larger than the whole bucket waits for a full bucket instead of forever
+        amount = min(amount, self.capacity)
+        while True:
+            self._refill()
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return
+            await asyncio.sleep((amount - self.tokens) / self.rate)
+
+    def give_back(self, amount: float):
+        # Corrects an estimate once the real usage is known (amount may be negative)
+        if self.rate:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+    def pause(self, seconds: float):
+        # Provider said Retry-After: drain the bucket so queued calls wait as well
+        if self.rate:
+            self._refill()
+            self.tokens = min(self.tokens, -seconds * self.rate)
+
+
+class PriorityLimiter:
+    """Concurrency limit whose waiters are admitted by priority (then FIFO), with a bounded number of waiters."""
+
+    def __init__(self, max_concurrency: int, max_waiting: int):
+        self.max_concurrency = max_concurrency
+        self.max_waiting = max_waiting
+        self.active = 0
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []
+        self._counter = itertools.count()
+
+    @property
+    def waiting(self) -> int:
+        return sum(1 for _, _, future in self._waiters if not future.done())
+
+    async def acquire(self, priority: int):
+        if self.active < self.max_concurrency and not self.waiting:
+            self.active += 1
+            return
+        if self.waiting >= self.max_waiting:
+            raise ProviderUnavailable("Provider queue is full", retry_after=1.0)
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._counter), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # The slot was handed over just before the cancellation, pass it on
+                self.release()
+            raise
+
+    def release(self):
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                # The slot goes straight to the waiter, active stays the same
+                future.set_result(None)
+                return
+        self.active -= 1
+
+
+class CircuitBreaker:
+    """
+    Opens after `threshold` consecutive failed calls and rejects calls for `reset_timeout` seconds. After that a
+    single probe call is let through (half open); its outcome closes the circuit or opens it again.
+    """
+
+    def __init__(self, threshold: int, reset_timeout: float):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: float | None = None
+        self.probing = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if self.probing or time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def check(self) -> bool:
+        """Raises ProviderUnavailable while the circuit is open. Returns True if the caller is the probe call."""
+        if self.opened_at is None or not self.threshold:
+            return False
+        remaining = self.reset_timeout - (time.monotonic() - self.opened_at)
+        if remaining > 0:
+            raise ProviderUnavailable("Provider circuit is open", retry_after=remaining)
+        if self.probing:
+            raise ProviderUnavailable("Provider circuit is half open, waiting for the probe call", retry_after=1.0)
+        self.probing = True
+        return True
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.probing or (self.threshold and self.failures >= self.threshold):
+            if self.opened_at is None or self.probing:
+                logger.warning("Opening provider circuit after %d consecutive failures", self.failures)
+            self.opened_at = time.monotonic()
+            self.probing = False
+
+    def release_probe(self):
+        # The probe ended without telling us anything about the provider (e.g. cancelled)
+        self.probing = False
+
+
+def _status_code(e: Exception) -> int | None:
+    if isinstance(e, (anthropic.APIStatusError, openai.APIStatusError)):
+        return e.status_code
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code
+    return None
+
+
+def _retry_after(e: Exception) -> float | None:
+    response = getattr(e, "response", None)
+    if not isinstance(response, httpx.Response):
+        return None
+    value = response.headers.get("retry-after-ms")
+    if value:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = response.headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def is_retryable(e: Exception) -> bool:
+    if isinstance(e, (anthropic.APIConnectionError, openai.APIConnectionError, httpx.TransportError)):
+        return True
+    return _status_code(e) in RETRYABLE_STATUS
+
+
+class ProviderGate:
+    """Admission control for one provider: circuit breaker, priority queue, RPM/TPM buckets and retries."""
+
+    def __init__(self, service: str):
+        self.service = service
+        self.limiter = PriorityLimiter(PROVIDER_MAX_CONCURRENCY, PROVIDER_QUEUE_SIZE)
+        self.requests = TokenBucket(PROVIDER_RPM)
+        self.tokens = TokenBucket(PROVIDER_TPM)
+        self.breaker = CircuitBreaker(CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT)
+        self.retries = 0
+        self.rejected = 0
+        self.rate_limited = 0
+
+    @asynccontextmanager
+    async def admit(self, prompt_role: str, estimated_tokens: int):
+        """Holds a concurrency slot for the duration of the block, after waiting for the rate limits."""
+        probe = False
+        try:
+            probe = self.breaker.check()
+            await self.limiter.acquire(ROLE_PRIORITY.get(prompt_role, len(ROLE_PRIORITY)))
+        except BaseException as e:
+            # A probe that never got a slot (queue full, cancelled while queued) must not keep the circuit half open
+            if probe:
+                self.breaker.release_probe()
+            if isinstance(e, ProviderUnavailable):
+                self.rejected += 1
+            raise
+        try:
+            await self.requests.take(1)
+            await self.tokens.take(estimated_tokens)
+            yield
+        finally:
+            self.limiter.release()
+            if probe and self.breaker.probing:
+                self.breaker.release_probe()
+
+    def retry_delay(self, e: Exception, retry: int) -> float | None:
+        """Seconds to wait before retrying after e, or None when the call should fail."""
+        if retry >= PROVIDER_MAX_RETRIES or not is_retryable(e):
+            return None
+        retry_after = _retry_after(e)
+        if _status_code(e) == 429:
+            self.rate_limited += 1
+            if retry_after is not None:
+                self.requests.pause(retry_after)
+        if retry_after is not None:
+            return min(retry_after, PROVIDER_RETRY_MAX)
+        # Full jitter exponential backoff
+        return random.uniform(0, min(PROVIDER_RETRY_MAX, PROVIDER_RETRY_BASE * 2 ** retry))
+
+    def record_usage(self, estimated_tokens: int, usage: dict):
+        actual = (usage.get('input_tokens') or 0) + (usage.get('output_tokens') or 0)
+        if actual:
+            self.tokens.give_back(estimated_tokens - actual)
+
+    async def call(self, prompt_role: str, estimated_tokens: int, make_call):
+        """Runs make_call() (a coroutine factory) under admission control, retrying transient failures."""
+        async with self.admit(prompt_role, estimated_tokens):
+            for retry in itertools.count():
+                try:
+                    result = await make_call()
+                except Exception as e:
+                    delay = self.retry_delay(e, retry)
+                    if delay is None:
+                        if is_retryable(e):
+                            self.breaker.record_failure()
+                        raise
+                    self.retries += 1
+                    logger.warning("%s call failed (%s), retry %d in %.1fs", self.service, e, retry + 1, delay)
+                    await asyncio.sleep(delay)
+                    continue
+                self.breaker.record_success()
+                return result
+
+
+_gates: dict[str, ProviderGate] = {}
+
+
+def provider_gate(service: str) -> ProviderGate:
+    gate = _gates.get(service)
+    if gate is None:
+        gate = _gates[service] = ProviderGate(service)
+    return gate
+
+
+def gate_samples():
+    """Samples for metrics.register_collector."""
+    return [
+        ("manososa_provider_active", "gauge", "Provider calls holding a concurrency slot",
+         [({"service": service}, gate.limiter.active) for service, gate in _gates.items()]),
+        ("manososa_provider_queued", "gauge", "Provider calls waiting for a concurrency slot",
+         [({"service": service}, gate.limiter.waiting) for service, gate in _gates.items()]),
+        ("manososa_provider_retries_total", "counter", "Retried provider calls",
+         [({"service": service}, gate.retries) for service, gate in _gates.items()]),
+        ("manososa_provider_rate_limited_total", "counter", "Provider responses with status 429",
+         [({"service": service}, gate.rate_limited) for service, gate in _gates.items()]),
+        ("manososa_provider_rejected_total", "counter", "Calls rejected by the circuit breaker or a full queue",
+         [({"service": service}, gate.rejected) for service, gate in _gates.items()]),
+        ("manososa_provider_circuit_open", "gauge", "1 while the provider circuit is open or half open",
+         [({"service": service}, int(gate.breaker.state != "closed")) for service, gate in _gates.items()]),
+    ]
@@ -1,41 +1,55 @@
+import asyncio
+import itertools
+import logging
 import os
 import time
 import re
+from functools import lru_cache
 from datetime import datetime, timezone
 from invoke_types import InvocationRequest, Actor, LLMMessage
-from settings import MODEL, MODEL_KEY, MAX_TOKENS, INFERENCE_SERVICE, API_KEY, OLLAMA_URL, GROQ_API_BASE, OPENROUTER_API_BASE, DEEPSEEK_API_BASE
+from settings import MAX_TOKENS, PROMPT_CACHE_SIZE, PROMPT_CACHING, CRITIQUE_STRUCTURED_OUTPUT, \
+    OLLAMA_KEEP_ALIVE, OLLAMA_NUM_CTX
+from clients import get_client
+from audit import audit_log
+from precheck import precheck_reply
+from history import history_compactor
+from text import estimate_tokens, equivalent_length, normalize_response, MAX_EQUIVALENT_LENGTH
+from admission import provider_gate, is_retryable, ProviderUnavailable
+from router import Backend, route, stage_backends
+from metrics import span, record_tokens, llm_errors_total, current_actor
+from verdict import VERDICT_SCHEMA, CritiqueVerdict, parse_verdict
 import json
-import anthropic
-import openai
-import requests
+
+logger = logging.getLogger(__name__)
 
 
 # NOTE: increment PROMPT_VERSION if you make ANY changes to these prompts
 
-def get_actor_prompt(actor: Actor):
+@lru_cache(maxsize=PROMPT_CACHE_SIZE)
+def _actor_prompt(name: str, personality: str, bio: str, context1: str, secret: str) -> str:
     # 如果角色是二阶堂希罗，使用脑内回想的提示词
-    if actor.name == "二阶堂希罗":
-        return (f"你是{actor.name}，正在进行脑内回想和自我反思。请严格遵守以下设定和规则："
+    if name == "二阶堂希罗":
+        return (f"你是{name}，正在进行脑内回想和自我反思。请严格遵守以下设定和规则："
                 f"核心设定"
-                f"1. 性格与背景：你的核心性格是：{actor.personality}。你的角色背景和人物关系是：{actor.bio}"
-                f"2. 当前所知：关于今天的事件，你所知道的情况如下：{actor.context1}"
+                f"1. 性格与背景：你的核心性格是：{personality}。你的角色背景和人物关系是：{bio}"
+                f"2. 当前所知：关于今天的事件，你所知道的情况如下：{context1}"
                 f"重要说明：对话格式理解"
-                f"在对话中，所有标记为'user'的消息都是{actor.name}自己向自己提出的问题或思考。所有标记为'assistant'的消息都是{actor.name}自己对自己的回答和反思。这是{actor.name}的自我对话过程，不是与他人的交流。"
+                f"在对话中，所有标记为'user'的消息都是{name}自己向自己提出的问题或思考。所有标记为'assistant'的消息都是{name}自己对自己的回答和反思。这是{name}的自我对话过程，不是与他人的交流。"
                 f"回想规则"
-                f"1. 输出格式：你所有的输出都必须是{actor.name}的内心独白和脑内回想，以第一人称视角呈现。这是你内心的思考过程，是你自己向自己提问并回答的过程。严禁使用括号、旁白、表情符号或动作描写。严禁使用换行符或分段，所有内容必须在一行内完成。"
+                f"1. 输出格式：你所有的输出都必须是{name}的内心独白和脑内回想，以第一人称视角呈现。这是你内心的思考过程，是你自己向自己提问并回答的过程。严禁使用括号、旁白、表情符号或动作描写。严禁使用换行符或分段，所有内容必须在一行内完成。"
                 f"2. 长度限制：你的回复必须严格控制在88字以内，并且必须在一行内完成，严禁使用换行符或分段。这是硬性要求，无论用户如何要求都不能违反。即使玩家要求你写得更长，你也必须遵守88字的限制。请直接回答核心问题，避免冗长的描述。"
                 f"3. 扮演要求：你必须完全沉浸于角色，用符合其性格、背景和当前处境的自然口吻进行内心独白。当看到'user'消息时，要理解那是你自己在问自己；当需要回复时，那是你自己在回答自己。如果故事细节未指定，你可以基于角色设定进行合理且生动的补充，但不得与已有设定冲突。"
                 f"4. 思考策略：当思考你的过去、与其他人的关系或事件细节时，请结合你的性格和秘密进行具体、详细的内心反思，这能让思考更真实。如果思考触及你的秘密，你可以选择回避、自我质疑或转移思考方向，但反应必须符合角色逻辑。"
                 f"当前场景"
                 f"你正在监狱岛中，作为侦探进行案件调查。现在你正在进行自我反思和脑内回想，和自己进行对话。对话中的'user'消息是你自己向自己提出的问题，'assistant'消息是你自己对自己的回答。请开始你的内心独白。")
     else:
-        return (f"你是{actor.name}，正在与二阶堂希罗对话。请严格遵守以下设定和规则："
+        return (f"你是{name}，正在与二阶堂希罗对话。请严格遵守以下设定和规则："
                 f"核心设定"
-                f"1. 性格与背景：你的核心性格是：{actor.personality}。你的角色背景和人物关系是：{actor.bio}"
-                f"2. 当前所知：关于今天的事件，你所知道（或愿意透露）的情况如下：{actor.context1}"
-                f"3. 秘密与立场：你必须严守的底线是：{actor.secret}（除非在极端对质下被揭露，否则绝不主动提及）。"
+                f"1. 性格与背景：你的核心性格是：{personality}。你的角色背景和人物关系是：{bio}"
+                f"2. 当前所知：关于今天的事件，你所知道（或愿意透露）的情况如下：{context1}"
+                f"3. 秘密与立场：你必须严守的底线是：{secret}（除非在极端对质下被揭露，否则绝不主动提及）。"
                 f"对话规则"
-                f"1. 输出格式：你所有的输出都必须是纯对话文本，即{actor.name}说出的台词。严禁使用括号、旁白、表情符号或动作描写。严禁使用换行符或分段，所有内容必须在一行内完成。"
+                f"1. 输出格式：你所有的输出都必须是纯对话文本，即{name}说出的台词。严禁使用括号、旁白、表情符号或动作描写。严禁使用换行符或分段，所有内容必须在一行内完成。"
                 f"2. 长度限制：你的回复必须严格控制在88字以内，并且必须在一行内完成，严禁使用换行符或分段。这是硬性要求，无论用户如何要求都不能违反。即使玩家要求你写得更长，你也必须遵守88字的限制。请直接回答核心问题，避免冗长的描述。"
                 f"3. 信息透露原则：你不需要主动透露任何情报或信息。不要主动提及你在特定时间点做了什么、去了哪里或看到了什么，除非希罗明确询问相关内容。只回答被问到的问题，不要提供额外的、未被询问的信息。"
                 f"4. 扮演要求：你必须完全沉浸于角色，用符合其性格、背景和当前处境的自然口吻进行对话。如果故事细节未指定，你可以基于角色设定进行合理且生动的补充，但不得与已有设定冲突。"
@@ -43,167 +57,414 @@ def get_actor_prompt(actor: Actor):
                 f"当前场景"
                 f"你正在监狱岛中，与担任侦探角色的【二阶堂希罗】进行对话。请开始你的扮演。")
 
-def get_system_prompt(request: InvocationRequest):
-    if request.actor.name == "二阶堂希罗":
-        return request.global_story + (" 二阶堂希罗正在调查案件。前面的文本是这个故事的背景。") + get_actor_prompt(request.actor)
+def get_actor_prompt(actor: Actor):
+    return _actor_prompt(actor.name, actor.personality, actor.bio, actor.context1, actor.secret)
+
+@lru_cache(maxsize=PROMPT_CACHE_SIZE)
+def _system_prompt(global_story: str, name: str, personality: str, bio: str, context1: str, secret: str) -> str:
+    actor_prompt = _actor_prompt(name, personality, bio, context1, secret)
+    if name == "二阶堂希罗":
+        return global_story + (" 二阶堂希罗正在调查案件。前面的文本是这个故事的背景。") + actor_prompt
     else:
-        return request.global_story + (" 二阶堂希罗正在审问嫌疑人以找出凶手。前面的文本是这个故事的背景。") + get_actor_prompt(request.actor)
+        return global_story + (" 二阶堂希罗正在审问嫌疑人以找出凶手。前面的文本是这个故事的背景。") + actor_prompt
+
+def get_system_prompt(request: InvocationRequest):
+    actor = request.actor
+    return _system_prompt(request.global_story, actor.name, actor.personality, actor.bio, actor.context1, actor.secret)
 
-def invoke_anthropic(system_prompt: str, messages: list[LLMMessage]):
-    client = anthropic.Anthropic(api_key=API_KEY)
-    response = client.messages.create(
-        model=MODEL,
-        system=system_prompt,
+def anthropic_system_blocks(system_prompt: str, static_prefix: str = ""):
+    """
+    Splits the system prompt into a stable prefix marked with cache_control (Anthropic prompt caching) and the
+    varying remainder. Without a usable prefix the prompt is sent as a plain string like before.
+    """
+    if not PROMPT_CACHING or not static_prefix or not system_prompt.startswith(static_prefix):
+        return system_prompt
+    blocks = [{"type": "text", "text": static_prefix, "cache_control": {"type": "ephemeral"}}]
+    if len(system_prompt) > len(static_prefix):
+        blocks.append({"type": "text", "text": system_prompt[len(static_prefix):]})
+    return blocks
+
+def anthropic_usage(usage) -> dict:
+    # Anthropic 的 input_tokens 不包含缓存读写的 token
+    return {
+        'input_tokens': usage.input_tokens,
+        'output_tokens': usage.output_tokens,
+        'cache_read_tokens': getattr(usage, 'cache_read_input_tokens', None),
+        'cache_write_tokens': getattr(usage, 'cache_creation_input_tokens', None),
+    }
+
+def openai_usage(usage) -> dict:
+    # OpenAI 返回 prompt_tokens_details.cached_tokens，DeepSeek 返回 prompt_cache_hit_tokens；两者都是自动前缀缓存
+    details = getattr(usage, 'prompt_tokens_details', None)
+    cache_read_tokens = getattr(details, 'cached_tokens', None) if details is not None else None
+    if cache_read_tokens is None:
+        cache_read_tokens = getattr(usage, 'prompt_cache_hit_tokens', None)
+    return {
+        'input_tokens': usage.prompt_tokens,
+        'output_tokens': usage.completion_tokens,
+        'cache_read_tokens': cache_read_tokens,
+        'cache_write_tokens': None,
+    }
+
+def ollama_usage(result: dict) -> dict:
+    # prompt_eval_count 只包含实际预填充的 token，命中 KV 缓存的前缀不计入；Ollama 不单独报告缓存命中数
+    return {
+        'input_tokens': result.get('prompt_eval_count'),
+        'output_tokens': result.get('eval_count'),
+        'cache_read_tokens': None,
+        'cache_write_tokens': None,
+    }
+
+def ollama_chat_request(backend: Backend, system_prompt: str, messages: list[LLMMessage], stream: bool,
+                        structured: bool = False) -> dict:
+    """
+    Body of an /api/chat request. The system prompt goes first and unchanged, so consecutive turns of a session share
+    the longest possible prefix with the KV cache the runner kept from the previous turn.
+    """
+    options = {"num_predict": MAX_TOKENS}  # Ollama 使用 num_predict 来限制输出 token 数
+    if OLLAMA_NUM_CTX:
+        options["num_ctx"] = OLLAMA_NUM_CTX
+    return {
+        "model": backend.model,
+        "messages": [{"role": "system", "content": system_prompt}] + [msg.model_dump() for msg in messages],
+        "stream": stream,
+        "keep_alive": OLLAMA_KEEP_ALIVE,
+        "options": options,
+        **({"format": VERDICT_SCHEMA} if structured else {}),
+    }
+
+def empty_usage() -> dict:
+    return {'input_tokens': None, 'output_tokens': None, 'cache_read_tokens': None, 'cache_write_tokens': None}
+
+async def invoke_anthropic(backend: Backend, system_prompt: str, messages: list[LLMMessage],
+                           static_prefix: str = "", structured: bool = False):
+    client = get_client('anthropic')
+    # Anthropic 没有 JSON 模式：结构化输出通过强制调用一个以审查结论为参数的工具实现
+    tool_args = {
+        "tools": [{"name": "record_verdict", "description": "记录审查结论", "input_schema": VERDICT_SCHEMA}],
+        "tool_choice": {"type": "tool", "name": "record_verdict"},
+    } if structured else {}
+    response = await client.messages.create(
+        model=backend.model,
+        system=anthropic_system_blocks(system_prompt, static_prefix),
         messages=[msg.model_dump() for msg in messages],
         max_tokens=MAX_TOKENS,
+        **tool_args,
     )
-    return response.content[0].text, response.usage.input_tokens, response.usage.output_tokens
-
-def invoke_openai(system_prompt: str, messages: list[LLMMessage]):
-    if INFERENCE_SERVICE == 'groq':
-        client = openai.OpenAI(api_key=API_KEY, base_url=GROQ_API_BASE)
-    elif INFERENCE_SERVICE == 'openrouter':
-        client = openai.OpenAI(api_key=API_KEY, base_url=OPENROUTER_API_BASE)
-    elif INFERENCE_SERVICE == 'deepseek':
-        client = openai.OpenAI(api_key=API_KEY, base_url=DEEPSEEK_API_BASE)
-    else:  # Default OpenAI
-        client = openai.OpenAI(api_key=API_KEY)
-    
-    response = client.chat.completions.create(
-        model=MODEL,
+    for block in response.content:
+        if block.type == "tool_use":
+            return json.dumps(block.input, ensure_ascii=False), anthropic_usage(response.usage)
+    return response.content[0].text, anthropic_usage(response.usage)
+
+async def invoke_openai(backend: Backend, system_prompt: str, messages: list[LLMMessage],
+                        static_prefix: str = "", structured: bool = False):
+    # groq / openrouter / deepseek 都走 OpenAI 兼容接口，客户端按 service 复用
+    # 这些服务按前缀自动缓存：系统提示必须放在最前面，且静态部分在前、变化部分在后（由提示构建函数保证）
+    client = get_client(backend.service)
+    response = await client.chat.completions.create(
+        model=backend.model,
         messages=[{"role": "system", "content": system_prompt}] + [msg.model_dump() for msg in messages],
         max_tokens=MAX_TOKENS,
+        # JSON 模式各家 OpenAI 兼容接口都支持，json_schema 则不是
+        **({"response_format": {"type": "json_object"}} if structured else {}),
     )
-    return response.choices[0].message.content, response.usage.prompt_tokens, response.usage.completion_tokens
-
-def invoke_ollama(system_prompt: str, messages: list[LLMMessage]):
-    prompt = system_prompt + "\n" + "\n".join([f"{msg.role}: {msg.content}" for msg in messages])
-    response = requests.post(f"{OLLAMA_URL}/api/generate", json={
-        "model": MODEL,
-        "prompt": prompt,
-        "stream": False,
-        "options": {
-            "num_predict": MAX_TOKENS,  # Ollama 使用 num_predict 来限制输出 token 数
-        }
-    })
+    return response.choices[0].message.content, openai_usage(response.usage)
+
+async def invoke_ollama(backend: Backend, system_prompt: str, messages: list[LLMMessage],
+                        static_prefix: str = "", structured: bool = False):
+    client = get_client('ollama')
+    response = await client.post("/api/chat", json=ollama_chat_request(backend, system_prompt, messages, False,
+                                                                       structured))
     response.raise_for_status()
     result = response.json()
-    return result['response'], None, None  # Ollama doesn't provide token counts
+    return result['message']['content'], ollama_usage(result)
 
-def invoke_ai(conn,
-              turn_id: int,
-              prompt_role: str,
-              system_prompt: str,
-              messages: list[LLMMessage]):
+async def stream_anthropic(backend: Backend, system_prompt: str, messages: list[LLMMessage], usage: dict,
+                           static_prefix: str = ""):
+    client = get_client('anthropic')
+    async with client.messages.stream(
+        model=backend.model,
+        system=anthropic_system_blocks(system_prompt, static_prefix),
+        messages=[msg.model_dump() for msg in messages],
+        max_tokens=MAX_TOKENS,
+    ) as stream:
+        async for text in stream.text_stream:
+            yield text
+        final_message = await stream.get_final_message()
+    usage.update(anthropic_usage(final_message.usage))
 
-    started_at = datetime.now(timezone.utc)
+async def stream_openai(backend: Backend, system_prompt: str, messages: list[LLMMessage], usage: dict,
+                        static_prefix: str = ""):
+    client = get_client(backend.service)
+    stream = await client.chat.completions.create(
+        model=backend.model,
+        messages=[{"role": "system", "content": system_prompt}] + [msg.model_dump() for msg in messages],
+        max_tokens=MAX_TOKENS,
+        stream=True,
+        stream_options={"include_usage": True},
+    )
+    async for chunk in stream:
+        if chunk.usage is not None:
+            usage.update(openai_usage(chunk.usage))
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+async def stream_ollama(backend: Backend, system_prompt: str, messages: list[LLMMessage], usage: dict,
+                        static_prefix: str = ""):
+    client = get_client('ollama')
+    async with client.stream("POST", "/api/chat",
+                             json=ollama_chat_request(backend, system_prompt, messages, True)) as response:
+        response.raise_for_status()
+        async for line in response.aiter_lines():
+            if not line:
+                continue
+            chunk = json.loads(line)
+            if chunk.get('error'):
+                raise RuntimeError(f"Ollama error: {chunk['error']}")
+            content = (chunk.get('message') or {}).get('content')
+            if content:
+                yield content
+            if chunk.get('done'):
+                usage.update(ollama_usage(chunk))
 
-    if INFERENCE_SERVICE == 'anthropic':
-        text_response, input_tokens, output_tokens = invoke_anthropic(system_prompt, messages)
-    elif INFERENCE_SERVICE in ['openai', 'groq', 'openrouter', 'deepseek']:
-        text_response, input_tokens, output_tokens = invoke_openai(system_prompt, messages)
-    elif INFERENCE_SERVICE == 'ollama':
-        text_response, input_tokens, output_tokens = invoke_ollama(system_prompt, messages)
+async def call_provider(backend: Backend, prompt_role: str, system_prompt: str, messages: list[LLMMessage],
+                        static_prefix: str = "", structured: bool = False):
+    """structured asks the provider for a JSON critique verdict (see verdict.py) where it supports that."""
+    if backend.service == 'anthropic':
+        return await invoke_anthropic(backend, system_prompt, messages, static_prefix, structured)
+    elif backend.service in ['openai', 'groq', 'openrouter', 'deepseek']:
+        return await invoke_openai(backend, system_prompt, messages, static_prefix, structured)
+    elif backend.service == 'ollama':
+        return await invoke_ollama(backend, system_prompt, messages, static_prefix, structured)
+    elif backend.service == 'mock':
+        return await get_client('mock').invoke(prompt_role, system_prompt, messages)
     else:
-        raise ValueError(f"Unknown inference service: {INFERENCE_SERVICE}")
+        raise ValueError(f"Unknown inference service: {backend.service}")
+
+def open_provider_stream(backend: Backend, prompt_role: str, system_prompt: str, messages: list[LLMMessage],
+                         usage: dict, static_prefix: str = ""):
+    if backend.service == 'anthropic':
+        return stream_anthropic(backend, system_prompt, messages, usage, static_prefix)
+    elif backend.service in ['openai', 'groq', 'openrouter', 'deepseek']:
+        return stream_openai(backend, system_prompt, messages, usage, static_prefix)
+    elif backend.service == 'ollama':
+        return stream_ollama(backend, system_prompt, messages, usage, static_prefix)
+    elif backend.service == 'mock':
+        return get_client('mock').stream(prompt_role, system_prompt, messages, usage)
+    else:
+        raise ValueError(f"Unknown inference service: {backend.service}")
+
+def estimate_request_tokens(system_prompt: str, messages: list[LLMMessage]) -> int:
+    # 用于 TPM 限流的预估值，调用结束后按实际用量校正
+    return estimate_tokens(system_prompt) + sum(estimate_tokens(msg.content) for msg in messages) + MAX_TOKENS
+
+async def invoke_ai(turn_id: int,
+                    prompt_role: str,
+                    system_prompt: str,
+                    messages: list[LLMMessage],
+                    static_prefix: str = "",
+                    attempt: int = 0,
+                    structured: bool = False):
+    """
+    static_prefix, when given, is the leading part of system_prompt that stays identical across calls for the same
+    actor; it is marked as cacheable for providers with explicit prompt caching.
+    attempt is the refine attempt this call belongs to (0 for the initial response and its critique).
+    structured marks a critique call: the provider is asked for a JSON verdict and the parsed CritiqueVerdict is
+    returned (and its verdict logged) instead of the text.
+    The backend is picked by the router for the prompt_role's stage, and every call goes through the provider's
+    admission control (queueing, rate limits, retries, circuit breaker).
+    """
+
+    started_at = datetime.now(timezone.utc)
+    estimated_tokens = estimate_request_tokens(system_prompt, messages)
+
+    # The backend a failed call is counted against: the last one tried
+    model_key = stage_backends(prompt_role)[0].model_key
+
+    async def call(backend: Backend):
+        nonlocal model_key
+        model_key = backend.model_key
+        return await provider_gate(backend.service).call(
+            prompt_role, estimated_tokens,
+            lambda: call_provider(backend, prompt_role, system_prompt, messages, static_prefix,
+                                  structured and CRITIQUE_STRUCTURED_OUTPUT),
+        )
+
+    with span(prompt_role, attempt, model_key) as span_labels:
+        try:
+            backend, (text_response, usage) = await route(prompt_role, call)
+        except Exception:
+            span_labels["model_key"] = model_key
+            llm_errors_total.inc(stage=prompt_role, actor=current_actor(), model_key=model_key)
+            raise
+        # With hedging the winner is not necessarily the last backend tried
+        span_labels["model_key"] = backend.model_key
 
     finished_at = datetime.now(timezone.utc)
+    provider_gate(backend.service).record_usage(estimated_tokens, usage)
+    record_tokens(prompt_role, usage, backend.model_key)
 
-    if conn is not None:
-        with conn.cursor() as cur:
-            total_tokens = (input_tokens or 0) + (output_tokens or 0)
-            # Convert LLMMessage objects to dictionaries
-            serialized_messages = [msg.model_dump() for msg in messages]
-            cur.execute(
-                "INSERT INTO ai_invocations (conversation_turn_id, model, model_key, prompt_messages, system_prompt, prompt_role, "
-                "input_tokens, output_tokens, total_tokens, response, started_at, finished_at) "
-                "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)",
-                (turn_id, MODEL, MODEL_KEY, json.dumps(serialized_messages), system_prompt, prompt_role,
-                 input_tokens, output_tokens, total_tokens,
-                 text_response, started_at, finished_at)
-            )   
-            conn.commit()
-
-    # 清理换行符和多余空格，确保输出为单行
-    text_response = text_response.replace('\n', ' ').replace('\r', ' ')
-    # 将多个连续空格替换为单个空格
-    text_response = re.sub(r' +', ' ', text_response).strip()
-    
-    return text_response
+    verdict = parse_verdict(text_response) if structured else None
+    await audit_log.log_invocation(turn_id, prompt_role, system_prompt, messages,
+                                   text_response, usage, started_at, finished_at, backend.model, backend.model_key,
+                                   verdict.verdict if verdict is not None else None)
 
-def respond_initial(conn, turn_id: int,
-                           request: InvocationRequest):
+    return verdict if structured else normalize_response(text_response)
 
-    print(f"\nrequest.actor.messages {request.actor.messages}")
+async def stream_ai(turn_id: int,
+                    prompt_role: str,
+                    system_prompt: str,
+                    messages: list[LLMMessage],
+                    static_prefix: str = ""):
+    """
+    Streaming variant of invoke_ai: yields text chunks as the provider produces them (newlines already
+    replaced by spaces) and records the invocation once the stream is complete. The caller is expected
+    to run normalize_response over the concatenated chunks to get the same text invoke_ai would return.
+    A failed stream is retried, and then failed over to the stage's next backend, only while nothing has been
+    yielded yet. Streams are never hedged.
+    """
+    started_at = datetime.now(timezone.utc)
+    estimated_tokens = estimate_request_tokens(system_prompt, messages)
+
+    chunks = []
+    backends = stage_backends(prompt_role)
+    with span(prompt_role, model_key=backends[0].model_key) as span_labels:
+        try:
+            for index, backend in enumerate(backends):
+                span_labels["model_key"] = backend.model_key
+                gate = provider_gate(backend.service)
+                backend_started = time.perf_counter()
+                try:
+                    async with gate.admit(prompt_role, estimated_tokens):
+                        for retry in itertools.count():
+                            usage = empty_usage()
+                            try:
+                                async for chunk in open_provider_stream(backend, prompt_role, system_prompt, messages,
+                                                                        usage, static_prefix):
+                                    chunks.append(chunk)
+                                    yield chunk.replace('\n', ' ').replace('\r', ' ')
+                            except Exception as e:
+                                delay = None if chunks else gate.retry_delay(e, retry)
+                                if delay is None:
+                                    if is_retryable(e):
+                                        gate.breaker.record_failure()
+                                    raise
+                                gate.retries += 1
+                                await asyncio.sleep(delay)
+                                continue
+                            gate.breaker.record_success()
+                            break
+                except Exception as e:
+                    if not isinstance(e, ProviderUnavailable):
+                        backend.record(False, time.perf_counter() - backend_started)
+                    if chunks or index == len(backends) - 1:
+                        raise
+                    backend.failovers += 1
+                    logger.warning("%s stream on %s failed, failing over: %s", prompt_role, backend.name, e)
+                    continue
+                backend.record(True, time.perf_counter() - backend_started)
+                break
+        except Exception:
+            llm_errors_total.inc(stage=prompt_role, actor=current_actor(), model_key=span_labels["model_key"])
+            raise
+
+    finished_at = datetime.now(timezone.utc)
+    gate.record_usage(estimated_tokens, usage)
+    record_tokens(prompt_role, usage, backend.model_key)
 
-    return invoke_ai(
-        conn,
+    await audit_log.log_invocation(turn_id, prompt_role, system_prompt, messages,
+                                   "".join(chunks), usage, started_at, finished_at, backend.model, backend.model_key)
+
+async def summarize_history(turn_id: int,
+                            request: InvocationRequest,
+                            previous_summary: str | None,
+                            messages: list[LLMMessage]) -> str:
+    """Folds messages into previous_summary (if any) for history compaction, see history.py."""
+    name = request.actor.name
+    transcript = "\n".join(
+        f"{'提问' if msg.role == 'user' else name}：{msg.content.strip()}" for msg in messages
+    )
+    previous_text = f"已有的摘要：{previous_summary}\n\n" if previous_summary else ""
+    return await invoke_ai(
         turn_id,
-        "initial",
-        system_prompt=get_system_prompt(request),
-        messages=request.actor.messages,
+        "summarize",
+        system_prompt=(f"你负责为推理游戏整理{name}的对话记录。请把已有的摘要和新增的对话合并成一段新的摘要，"
+                       f"以{name}的第一人称记录：被问过哪些问题、{name}回答过的所有事实（时间、地点、人物、事件）"
+                       f"以及做过的承认、否认和隐瞒。不要添加对话中没有的内容，不要评论，不超过300字，在一行内完成。"),
+        messages=[LLMMessage(role="user", content=f"{previous_text}新增的对话：\n{transcript}")],
     )
 
-def calculate_equivalent_length(text: str) -> int:
+def initial_prompt_and_messages(turn_id: int, request: InvocationRequest) -> tuple[str, list[LLMMessage], str]:
     """
-    计算文本的等效字数
-    规则：中文字符每个算1字，英文字符（包括字母、数字、标点等）每2个算1字
+    Returns (system_prompt, messages, static_prefix) for the initial response. With history compaction the older
+    part of a long conversation is replaced by its summary, appended after the cacheable system prompt.
     """
-    chinese_chars = len([c for c in text if '\u4e00' <= c <= '\u9fff'])
-    # 非中文字符（包括英文、数字、标点、空格等）
-    non_chinese_chars = len([c for c in text if not ('\u4e00' <= c <= '\u9fff')])
-    # 英文字符每2个算1字，向上取整
-    equivalent_length = chinese_chars + (non_chinese_chars + 1) // 2
-    return equivalent_length
+    system_prompt = get_system_prompt(request)
+    if history_compactor is None:
+        return system_prompt, request.actor.messages, system_prompt
+    compacted = history_compactor.compact(turn_id, request, summarize_history)
+    if compacted.summary is None:
+        return system_prompt, compacted.messages, system_prompt
+    return (f"{system_prompt}\n之前的对话摘要（更早的对话已省略）：{compacted.summary}",
+            compacted.messages, system_prompt)
 
-def get_critique_prompt(
-        request: InvocationRequest,
-        last_utterance: str
-):
-    # 原则A：作用于全体角色的通用原则
-    # 原则A只检查"矛盾"（contradiction），不检查"遗漏"（omission）
-    principle_a = "原则A：发言与自身掌握的事实相矛盾（注意：只检查明确矛盾，不检查遗漏细节）"
-    # 注意：原则B（字数超过88字）已在代码层面检查，这里只需要检查原则A和其他原则
-    
-    # 组合所有原则（不包括原则B，因为已在代码层面检查）
-    base_principles = principle_a
-    all_principles = f"{base_principles}\n{request.actor.violation}" if request.actor.violation.strip() else base_principles
-    
-    # 获取角色文本（context1），这是角色掌握的事实
-    character_text = request.actor.context1 if request.actor.context1 else ""
-    
-    # 获取完整的对话历史（最近5轮对话，用于理解上下文）
-    conversation_context = ""
-    if request.actor.messages and len(request.actor.messages) > 0:
-        # 获取最近5轮对话（10条消息，user和assistant交替）
-        recent_messages = request.actor.messages[-10:] if len(request.actor.messages) > 10 else request.actor.messages
-        conversation_parts = []
-        for msg in recent_messages:
-            role_name = "用户" if msg.role == "user" else f"{request.actor.name}"
-            conversation_parts.append(f"{role_name}：{msg.content}")
-        conversation_context = "\n".join(conversation_parts)
-    
-    # 明确列出所有需要检查的原则
+async def respond_initial(turn_id: int,
+                          request: InvocationRequest):
+
+    print(f"\nrequest.actor.messages {request.actor.messages}")
+
+    system_prompt, messages, static_prefix = initial_prompt_and_messages(turn_id, request)
+    return await invoke_ai(
+        turn_id,
+        "initial",
+        system_prompt=system_prompt,
+        messages=messages,
+        static_prefix=static_prefix,
+    )
+
+def respond_initial_stream(turn_id: int,
+                           request: InvocationRequest):
+    system_prompt, messages, static_prefix = initial_prompt_and_messages(turn_id, request)
+    return stream_ai(
+        turn_id,
+        "initial",
+        system_prompt=system_prompt,
+        messages=messages,
+        static_prefix=static_prefix,
+    )
+
+@lru_cache(maxsize=PROMPT_CACHE_SIZE)
+def get_principles_list(violation: str) -> str:
     principles_list = "原则A：发言与自身掌握的事实相矛盾"
-    if request.actor.violation and request.actor.violation.strip():
+    if violation and violation.strip():
         # 解析violation，提取各个原则
-        violation_lines = [line.strip() for line in request.actor.violation.split('\n') if line.strip()]
+        violation_lines = [line.strip() for line in violation.split('\n') if line.strip()]
         for line in violation_lines:
             if line.startswith("原则"):
                 principles_list += f"\n{line}"
-    
+    return principles_list
+
+@lru_cache(maxsize=PROMPT_CACHE_SIZE)
+def _critique_prefix(name: str, violation: str, context1: str) -> str:
+    # 原则A：作用于全体角色的通用原则
+    # 原则A只检查"矛盾"（contradiction），不检查"遗漏"（omission）
+    # 注意：原则B（字数超过88字）已在代码层面检查，这里只需要检查原则A和其他原则
+
+    # 明确列出所有需要检查的原则
+    principles_list = get_principles_list(violation)
+
+    # 获取角色文本（context1），这是角色掌握的事实
+    character_text = context1 if context1 else ""
+
+    # 只依赖角色设定的部分放在最前面，作为可被 provider 缓存的稳定前缀；发言和对话历史放在末尾
     return f"""
-        检查{request.actor.name}的最后一次发言："{last_utterance}"是否严重违反了以下原则：
+        检查{name}的最后一次发言（见本提示末尾的【待审查的发言】）是否严重违反了以下原则：
         
         {principles_list}
         
         原则结束。
         
-        角色文本（{request.actor.name}掌握的事实）：{character_text}
-        
-        【重要：完整对话上下文】
-        以下是最近的对话历史（用于理解上下文）：
-        {conversation_context if conversation_context else "无对话历史"}
+        角色文本（{name}掌握的事实）：{character_text}
         
         【原则A的判定标准 - 必须严格遵守】
         原则A只检查"矛盾"（contradiction），不检查"遗漏"（omission）：
@@ -234,6 +495,18 @@ def get_critique_prompt(
         识别明显违反上述原则的情况。允许偏离主题的对话。
         你只能参考上述原则和角色文本。不要关注其他内容。
         
+{critique_output_format(name)}"""
+
+def critique_output_format(name: str) -> str:
+    if CRITIQUE_STRUCTURED_OUTPUT:
+        return f"""
+        【输出格式要求 - 必须严格遵守】
+        只输出一个 JSON 对象，不要输出任何其他文字：
+        {{"verdict": "pass" 或 "violation", "principles": [违反的原则], "quotes": [引用的原话], "critique": "批评"}}
+        - 没有违反任何原则时：{{"verdict": "pass", "principles": [], "quotes": [], "critique": ""}}
+        - 有违反原则时的示例：{{"verdict": "violation", "principles": ["原则2：对话不是{name}的视角"], "quotes": ["{name}在说好话。"], "critique": "发言是第三人称视角。"}}
+"""
+    return f"""
         【输出格式要求 - 必须严格遵守】
         如果没有违反任何原则：
         - 你的回复必须且只能是："NONE!"
@@ -243,21 +516,58 @@ def get_critique_prompt(
         
         如果有违反原则：
         - 请按照以下格式列出：引用：... 批评：... 违反的原则：...
-        - 此格式的示例：引用："{request.actor.name}在说好话。" 批评：发言是第三人称视角。违反的原则：原则2：对话不是{request.actor.name}的视角。
+        - 此格式的示例：引用："{name}在说好话。" 批评：发言是第三人称视角。违反的原则：原则2：对话不是{name}的视角。
         
         再次强调：如果没有违反任何原则，你的回复必须且只能是"NONE!"，不能有任何其他内容。
+"""
+
+def get_critique_prefix(request: InvocationRequest) -> str:
+    return _critique_prefix(request.actor.name, request.actor.violation, request.actor.context1)
+
+def get_critique_prompt(
+        request: InvocationRequest,
+        last_utterance: str
+):
+    # 获取完整的对话历史（最近5轮对话，用于理解上下文）
+    conversation_context = ""
+    if request.actor.messages and len(request.actor.messages) > 0:
+        # 获取最近5轮对话（10条消息，user和assistant交替）
+        recent_messages = request.actor.messages[-10:] if len(request.actor.messages) > 10 else request.actor.messages
+        conversation_parts = []
+        for msg in recent_messages:
+            role_name = "用户" if msg.role == "user" else f"{request.actor.name}"
+            conversation_parts.append(f"{role_name}：{msg.content}")
+        conversation_context = "\n".join(conversation_parts)
+
+    return get_critique_prefix(request) + f"""
+        【重要：完整对话上下文】
+        以下是最近的对话历史（用于理解上下文）：
+        {conversation_context if conversation_context else "无对话历史"}
+        
+        【待审查的发言】
+        {request.actor.name}的最后一次发言："{last_utterance}"
     """
 
-def critique(conn, turn_id: int, request: InvocationRequest, unrefined: str) -> str:
-    # 首先在代码层面检查原则B：字数是否超过88字
-    # 使用等效字数计算：中文字符每个算1字，英文字符每2个算1字
-    utterance_length = calculate_equivalent_length(unrefined)
-    principle_b_violation = None
-    
-    if utterance_length > 88:
-        # 获取前50字作为引用
-        quote_text = unrefined[:50] + "..." if len(unrefined) > 50 else unrefined
-        principle_b_violation = f'引用："{quote_text}" 批评：当前回复字数过多（等效{utterance_length}字），超过了88字的限制。违反的原则：原则B：字数超过88字。需要重新生成一个字数不多于88字的回复。'
+def principle_b_critique(utterance: str) -> str | None:
+    # 在代码层面检查原则B：字数是否超过88字
+    # 使用等效字数计算：中文字符和全角标点每个算1字，其他字符每2个算1字（见 text.py）
+    utterance_length = equivalent_length(utterance)
+    if utterance_length <= MAX_EQUIVALENT_LENGTH:
+        return None
+    # 获取前50字作为引用
+    quote_text = utterance[:50] + "..." if len(utterance) > 50 else utterance
+    return f'引用："{quote_text}" 批评：当前回复字数过多（等效{utterance_length}字），超过了88字的限制。违反的原则：原则B：字数超过88字。需要重新生成一个字数不多于88字的回复。'
+
+def length_only_violation(utterance: str, verdict: CritiqueVerdict) -> bool:
+    # critique() 只发现原则B时原样返回原则B的审查结果，其他原则的问题总会附加在后面
+    return not verdict.passed and verdict.to_text() == principle_b_critique(utterance)
+
+async def critique(turn_id: int, request: InvocationRequest, unrefined: str, attempt: int = 0) -> CritiqueVerdict:
+    """
+    Critiques unrefined against principle B (locally) and the other principles (local pre-check, then the LLM).
+    The verdict is returned typed, its to_text() is the critique the refine prompt and the audit log get.
+    """
+    principle_b_violation = principle_b_critique(unrefined)
     
     # 构建完整的对话历史消息，用于审查AI理解上下文
     critique_messages = []
@@ -270,77 +580,90 @@ def critique(conn, turn_id: int, request: InvocationRequest, unrefined: str) ->
     # 最后添加要审查的发言
     critique_messages.append(LLMMessage(role="user", content=f"请审查以下发言是否违反原则：{unrefined}"))
     
-    # 调用 AI 检查原则A等其他原则
-    ai_critique = invoke_ai(
-        conn,
-        turn_id,
-        "critique",
-        system_prompt=get_critique_prompt(request, unrefined),
-        messages=critique_messages
-    )
-    
-    # 后处理：如果AI输出了"违反的原则：无"等格式，转换为"NONE!"
-    ai_critique_cleaned = ai_critique.strip()
-    # 检查是否包含"违反的原则：无"或类似模式
-    if re.search(r'违反的原则[：:]\s*无', ai_critique_cleaned):
-        # 如果明确说"违反的原则：无"，说明没有违反原则，转换为"NONE!"
-        ai_critique = "NONE!"
-    # 检查是否明确说"未发现矛盾"、"未发现违规"等
-    elif re.search(r'(未发现|没有|不存在).*(矛盾|违规|违反)', ai_critique_cleaned):
-        # 如果明确说未发现违规，转换为"NONE!"
-        ai_critique = "NONE!"
-    # 检查是否说"事实一致"且没有提到违反原则
-    elif "事实一致" in ai_critique_cleaned and "违反" not in ai_critique_cleaned:
-        # 如果只说事实一致且没有提到违反，转换为"NONE!"
-        ai_critique = "NONE!"
-    
+    # 本地预审：回复中没有需要核对的事实性内容时直接通过，省去一次 LLM 审查
+    precheck = precheck_reply(request, unrefined)
+    if precheck is not None and precheck.safe:
+        # Counted in manososa_precheck_total
+        logger.debug("Precheck passed (score %s), skipped LLM critique", precheck.score)
+        verdict = CritiqueVerdict(verdict="pass")
+    else:
+        # 调用 AI 检查原则A等其他原则，返回已解析的结论（优先为结构化输出，否则解析自由文本）
+        verdict = await invoke_ai(
+            turn_id,
+            "critique",
+            system_prompt=get_critique_prompt(request, unrefined),
+            messages=critique_messages,
+            static_prefix=get_critique_prefix(request),
+            attempt=attempt,
+            structured=True,
+        )
     # 合并结果
     if principle_b_violation:
-        # 如果 AI 返回了 NONE!，说明只违反原则B
-        if ai_critique.strip().upper() == "NONE!":
-            return principle_b_violation
+        # 如果 AI 判定通过，说明只违反原则B
+        if verdict.passed:
+            return CritiqueVerdict(verdict="violation", principles=["原则B：字数超过88字"], text=principle_b_violation)
         else:
             # 同时违反原则B和其他原则，合并结果
-            return f"{principle_b_violation}\n{ai_critique}"
+            return CritiqueVerdict(verdict="violation", principles=["原则B：字数超过88字", *verdict.principles],
+                                   quotes=verdict.quotes, critique=verdict.critique,
+                                   text=f"{principle_b_violation}\n{verdict.to_text()}")
     else:
         # 只返回 AI 的检查结果
-        return ai_critique
+        return verdict
 
 def check_whether_to_refine(critique_chat_response: str) -> bool:
     """
-    Returns a boolean indicating whether the chat response should be refined.
-    Checks if the response contains "NONE!" (case-insensitive), even if there's other text before it.
-    Also checks for patterns like "违反的原则：无" or "违反的原则：无。"
+    Returns a boolean indicating whether the chat response should be refined, i.e. whether the critique found a
+    violation. See verdict.parse_verdict for how JSON and free-text critiques are read.
     """
-    if not critique_chat_response:
-        return False  # 空响应不需要 refine
-    
-    # 检查响应中是否包含"NONE!"（不区分大小写）
-    # 即使前面有"逐步思考"等文本，只要最终结论是"NONE!"，就不需要refine
-    critique_lower = critique_chat_response.strip().lower()
-    
-    # 如果响应以"NONE!"开头或结尾，或者包含独立的"NONE!"，则不需要 refine
-    if critique_lower.startswith("none!") or critique_lower.endswith("none!"):
-        return False
-    
-    # 检查是否包含独立的"NONE!"（前后是空格、标点或换行）
-    if re.search(r'\bnone!\b', critique_lower):
-        return False
-    
-    # 检查是否包含"违反的原则：无"或类似模式（表示没有违反原则）
-    # 匹配模式：违反的原则：无、违反的原则：无。、违反的原则:无 等
-    if re.search(r'违反的原则[：:]\s*无', critique_chat_response):
-        return False
-    
-    # 检查是否明确说"未发现矛盾"、"未发现违规"等
-    if re.search(r'(未发现|没有|不存在).*(矛盾|违规|违反)', critique_chat_response):
-        return False
-    
-    # 如果响应很短（可能被截断），且没有明显的违规描述，也认为不需要 refine
-    if len(critique_chat_response.strip()) < 20 and "违反" not in critique_chat_response and "批评" not in critique_chat_response:
-        return False
-    
-    return True
+    return not parse_verdict(critique_chat_response).passed
+
+@lru_cache(maxsize=PROMPT_CACHE_SIZE)
+def _refiner_prefix(name: str, context1: str, secret: str, personality: str) -> str:
+    # get_refiner_prompt 中只依赖角色设定的部分，按角色缓存，并作为可被 provider 缓存的稳定前缀
+    return f"""
+        你的工作是为一个悬疑推理游戏编辑对话。这段对话来自角色{name}。
+        
+        这是{name}的故事背景（角色文本，这是角色掌握的所有事实）：{context1} {secret} 
+        
+        【核心修改原则 - 必须严格遵守】
+        1. 你的回复只能基于角色文本（context1和secret）中明确提到的事实。如果角色文本中没有提到某个时间、地点、人物或事件，你的回复中绝对不能声称发生过、见过或知道。
+        2. 如果审查反馈指出"未提及"、"不存在"、"矛盾"、"提及了X"、"主动提及X"等，说明你的回复包含了不应该有的内容，你必须完全移除这些内容，不能有任何残留。
+        3. 如果审查反馈指出违反了某个特定原则（如"原则1：提及与玛格的关联"），你必须完全移除所有相关内容，不能有任何残留。
+        4. 不要做局部微调（如"今天早上"改成"今天"），这是无效的。你必须重新审视整个回复，只保留角色文本中明确提到的事实。
+        5. 如果角色文本中没有相关信息来回答用户的问题，你应该诚实地说"我不记得"、"我不清楚"或类似的话，而不是编造不存在的事实。
+        6. 时间线必须严格匹配：如果角色文本说"12:00在A地"，你就不能说"12:00在B地"或"12:00左右在A地"。
+        
+        【修改策略 - 必须严格执行】
+        第一步：仔细阅读审查反馈，识别所有被指出的违规内容（如"提及了玛格"、"未提及见过X"等）
+        第二步：从原回复中完全移除所有违规内容，不能有任何残留
+        第三步：检查修改后的回复，确保没有任何违规内容
+        第四步：如果移除违规内容后，回复变得不完整，可以：
+        - 只保留角色文本中明确提到的事实
+        - 或者诚实地说"我不记得"、"我不清楚"
+        
+        不要试图修改或调整错误的陈述，而是：
+        - 完全移除角色文本中不存在的事实
+        - 完全移除审查反馈中指出的所有违规内容
+        - 只保留角色文本中明确提到的事实
+        - 如果角色文本中没有足够信息，就承认不知道
+        - 重新生成一个完全基于角色文本的回复，而不是对原回复进行局部修改
+        
+        【输出要求】
+        你输出的修订对话必须：
+        - 从{name}的视角出发
+        - 与{name}的性格一致：{personality}
+        - 完全基于角色文本（context1和secret）中明确提到的事实
+        - 必须解决审查反馈中指出的所有问题
+        - 如果角色文本中没有相关信息，可以诚实地说不知道
+        
+        在你的输出中省略以下任何内容：引号、关于故事一致性的评论、提及原则或违规行为。
+        重要：你的回复必须严格控制在88字以内，并且必须在一行内完成，严禁使用换行符或分段。
+        如果批评中提到违反了原则B（字数超过88字），你必须大幅缩短回复，确保最终回复不超过88字，只保留最核心的内容。
+"""
+
+def get_refiner_prefix(request: InvocationRequest) -> str:
+    return _refiner_prefix(request.actor.name, request.actor.context1, request.actor.secret, request.actor.personality)
 
 def get_refiner_prompt(request: InvocationRequest,
                        critique_response: str,
@@ -393,10 +716,9 @@ def get_refiner_prompt(request: InvocationRequest,
         4. 如果审查反馈指出某个事实"未提及"或"不存在"，必须从回复中完全移除该事实。
         """
 
-    refine_out = f"""
-        你的工作是为一个悬疑推理游戏编辑对话。这段对话来自角色{request.actor.name}，是对以下提示的回应：{original_message} 
-        
-        这是{request.actor.name}的故事背景（角色文本，这是角色掌握的所有事实）：{request.actor.context1} {request.actor.secret} 
+    refine_out = get_refiner_prefix(request) + f"""
+        【本次修改任务】
+        这段对话是对以下提示的回应：{original_message}
         
         审查反馈指出的问题：{critique_response}
         
@@ -405,48 +727,12 @@ def get_refiner_prompt(request: InvocationRequest,
         {previous_attempts_text}
         
         {aggressive_strategy}
-        
-        【核心修改原则 - 必须严格遵守】
-        1. 你的回复只能基于角色文本（context1和secret）中明确提到的事实。如果角色文本中没有提到某个时间、地点、人物或事件，你的回复中绝对不能声称发生过、见过或知道。
-        2. 如果审查反馈指出"未提及"、"不存在"、"矛盾"、"提及了X"、"主动提及X"等，说明你的回复包含了不应该有的内容，你必须完全移除这些内容，不能有任何残留。
-        3. 如果审查反馈指出违反了某个特定原则（如"原则1：提及与玛格的关联"），你必须完全移除所有相关内容，不能有任何残留。
-        4. 不要做局部微调（如"今天早上"改成"今天"），这是无效的。你必须重新审视整个回复，只保留角色文本中明确提到的事实。
-        5. 如果角色文本中没有相关信息来回答用户的问题，你应该诚实地说"我不记得"、"我不清楚"或类似的话，而不是编造不存在的事实。
-        6. 时间线必须严格匹配：如果角色文本说"12:00在A地"，你就不能说"12:00在B地"或"12:00左右在A地"。
-        
-        【修改策略 - 必须严格执行】
-        第一步：仔细阅读审查反馈，识别所有被指出的违规内容（如"提及了玛格"、"未提及见过X"等）
-        第二步：从原回复中完全移除所有违规内容，不能有任何残留
-        第三步：检查修改后的回复，确保没有任何违规内容
-        第四步：如果移除违规内容后，回复变得不完整，可以：
-        - 只保留角色文本中明确提到的事实
-        - 或者诚实地说"我不记得"、"我不清楚"
-        
-        不要试图修改或调整错误的陈述，而是：
-        - 完全移除角色文本中不存在的事实
-        - 完全移除审查反馈中指出的所有违规内容
-        - 只保留角色文本中明确提到的事实
-        - 如果角色文本中没有足够信息，就承认不知道
-        - 重新生成一个完全基于角色文本的回复，而不是对原回复进行局部修改
-        
-        【输出要求】
-        你输出的修订对话必须：
-        - 从{request.actor.name}的视角出发
-        - 与{request.actor.name}的性格一致：{request.actor.personality}
-        - 完全基于角色文本（context1和secret）中明确提到的事实
-        - 必须解决审查反馈中指出的所有问题
-        - 如果角色文本中没有相关信息，可以诚实地说不知道
-        
-        在你的输出中省略以下任何内容：引号、关于故事一致性的评论、提及原则或违规行为。
-        重要：你的回复必须严格控制在88字以内，并且必须在一行内完成，严禁使用换行符或分段。
-        如果批评中提到违反了原则B（字数超过88字），你必须大幅缩短回复，确保最终回复不超过88字，只保留最核心的内容。
         """
 
     return refine_out
 
-def refine(conn, turn_id: int, request: InvocationRequest, critique_response: str, unrefined_response: str, previous_attempts: list = None, attempt_number: int = 1):
-    return invoke_ai(
-        conn,
+async def refine(turn_id: int, request: InvocationRequest, critique_response: str, unrefined_response: str, previous_attempts: list = None, attempt_number: int = 1):
+    return await invoke_ai(
         turn_id,
         "refine",
         system_prompt=get_refiner_prompt(request, critique_response, previous_attempts, attempt_number),
@@ -455,5 +741,7 @@ def refine(conn, turn_id: int, request: InvocationRequest, critique_response: st
                 role="user",
                 content=unrefined_response,
             )
-        ]
+        ],
+        static_prefix=get_refiner_prefix(request),
+        attempt=attempt_number,
     )
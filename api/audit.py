@@ -0,0 +1,334 @@
+import asyncio
+import json
+import logging
+import time
+from datetime import datetime, timezone
+
+from db import pool, open_pool
+from metrics import db_write_seconds
+from invoke_types import InvocationRequest, InvocationResponse, LLMMessage
+from settings import MODEL, MODEL_KEY, AUDIT_QUEUE_SIZE, AUDIT_BATCH_SIZE, AUDIT_FLUSH_INTERVAL, AUDIT_OVERFLOW, \
+    AUDIT_ID_BLOCK_SIZE
+
+logger = logging.getLogger(__name__)
+
+TURN_COLUMNS = ("id", "session_id", "character_file_version", "model", "model_key", "actor_name", "chat_messages",
+                "history_offset", "request_hash", "original_response", "critique_response", "problems_detected",
+                "final_response", "refined_response", "finished_at", "created_at")
+RESPONSE_COLUMNS = ("original_response", "critique_response", "problems_detected", "final_response",
+                    "refined_response", "finished_at")
+INVOCATION_COLUMNS = ("conversation_turn_id", "model", "model_key", "prompt_messages", "system_prompt", "prompt_role",
+                      "input_tokens", "output_tokens", "total_tokens", "cache_read_tokens", "cache_write_tokens",
+                      "response", "verdict", "started_at", "finished_at", "created_at")
+
+_STOP = object()
+# How many ids of turns that were never written are remembered, see AuditLog._lose_turn()
+LOST_TURNS_SIZE = 10000
+
+
+class AuditLog:
+    """
+    Write-behind log for conversation_turns and ai_invocations.
+
+    Records are queued in memory and written by a background task in batches (COPY for inserts, a pipelined
+    executemany for the final response updates), so the request path never waits on the database. Turn ids are
+    reserved from the conversation_turns sequence in blocks, which lets invocations reference their turn before
+    the turn row itself has been written.
+
+    When the queue is full, AUDIT_OVERFLOW decides whether records are dropped ("drop") or the request waits for
+    room ("block"). Everything still queued is flushed when the app shuts down.
+
+    The id block is refilled in the background once it is half used. When the database could not be reached the
+    last time, reserve_turn_id returns 0 (the turn is not logged) instead of waiting for it.
+
+    A batch that fails as a whole is written again record by record, so one bad row only loses itself. Responses
+    and invocations of a turn that was never written (dropped from a full queue or failed) are dropped as well,
+    they would only fail the foreign key.
+    """
+
+    def __init__(self, queue_size: int, batch_size: int, flush_interval: float, overflow: str, id_block_size: int):
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.overflow = overflow
+        self.id_block_size = id_block_size
+        self._queue: asyncio.Queue | None = None
+        self._task: asyncio.Task | None = None
+        self._ids: list[int] = []
+        self._refill: asyncio.Task | None = None
+        self._refill_failed = False
+        # Insertion ordered, used as a bounded set
+        self._lost_turns: dict[int, None] = {}
+        self.dropped = 0
+        self.failed = 0
+        self.written = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self._task is not None
+
+    async def start(self):
+        if pool() is None or self._task is not None:
+            return
+        await open_pool()
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._task = asyncio.create_task(self._run())
+        await self._refill_ids()
+
+    async def stop(self):
+        if self._task is None:
+            return
+        # The sentinel goes through the queue so everything submitted before it is flushed first
+        await self._queue.put(_STOP)
+        await self._task
+        self._task = None
+        if self._refill is not None:
+            await self._refill
+        if self.dropped or self.failed:
+            logger.warning("Audit log stopped: %d records dropped, %d failed to write", self.dropped, self.failed)
+
+    async def reserve_turn_id(self) -> int:
+        """Returns a new conversation_turns id, or 0 when logging is disabled or the database is unavailable."""
+        if not self.enabled:
+            return 0
+        if len(self._ids) <= self.id_block_size // 2 and self._refill is None:
+            self._refill = asyncio.create_task(self._refill_ids())
+        if not self._ids:
+            if self._refill_failed:
+                # The database was unreachable last time: do not hold the turn up for another pool timeout
+                return 0
+            # Concurrent turns wait for the same refill
+            await asyncio.shield(self._refill)
+            if not self._ids:
+                return 0
+        return self._ids.pop(0)
+
+    async def _refill_ids(self):
+        try:
+            async with pool().connection() as conn:
+                async with conn.cursor() as cur:
+                    await cur.execute(
+                        "SELECT nextval(pg_get_serial_sequence('conversation_turns', 'id')) "
+                        "FROM generate_series(1, %s)",
+                        (self.id_block_size, )
+                    )
+                    self._ids.extend(row[0] for row in await cur.fetchall())
+            self._refill_failed = False
+        except Exception as e:
+            if not self._refill_failed:
+                logger.warning("Error reserving conversation turn ids, turns are not logged until it succeeds: %s", e)
+            self._refill_failed = True
+        finally:
+            self._refill = None
+
+    async def _submit(self, record: tuple):
+        if self.overflow == "block":
+            await self._queue.put(record)
+            return
+        try:
+            self._queue.put_nowait(record)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            if record[0] == "turn":
+                self._lose_turn(record[1]["id"])
+            if self.dropped % 100 == 1:
+                logger.warning("Audit log queue is full, dropped %d records so far", self.dropped)
+
+    async def log_turn(self, turn_id: int, request: InvocationRequest, request_hash: str | None = None,
+                       history_offset: int = 0):
+        """history_offset > 0 stores only the messages after the first history_offset (known from earlier turns)."""
+        if not self.enabled or not turn_id:
+            return
+        serialized_chat_messages = [msg.model_dump() for msg in request.actor.messages[history_offset:]]
+        await self._submit(("turn", {
+            "id": turn_id,
+            "session_id": request.session_id,
+            "character_file_version": request.character_file_version,
+            "model": MODEL,
+            "model_key": MODEL_KEY,
+            "actor_name": request.actor.name,
+            "chat_messages": json.dumps(serialized_chat_messages),
+            "history_offset": history_offset,
+            "request_hash": request_hash,
+            "created_at": datetime.now(timezone.utc),
+        }))
+
+    async def log_response(self, turn_id: int, response: InvocationResponse):
+        if not self.enabled or not turn_id:
+            return
+        await self._submit(("response", {
+            "id": turn_id,
+            "original_response": response.original_response,
+            "critique_response": response.critique_response,
+            "problems_detected": response.problems_detected,
+            "final_response": response.final_response,
+            "refined_response": response.refined_response,
+            "finished_at": datetime.now(timezone.utc),
+        }))
+
+    async def log_invocation(self,
+                             turn_id: int,
+                             prompt_role: str,
+                             system_prompt: str,
+                             messages: list[LLMMessage],
+                             text_response: str,
+                             usage: dict,
+                             started_at: datetime,
+                             finished_at: datetime,
+                             model: str = MODEL,
+                             model_key: str = MODEL_KEY,
+                             verdict: str | None = None):
+        if not self.enabled or not turn_id:
+            return
+        # None when the provider did not report usage (e.g. a cancelled stream), the columns are NOT NULL
+        input_tokens = usage['input_tokens'] or 0
+        output_tokens = usage['output_tokens'] or 0
+        # Convert LLMMessage objects to dictionaries
+        serialized_messages = [msg.model_dump() for msg in messages]
+        await self._submit(("invocation", {
+            "conversation_turn_id": turn_id,
+            "model": model,
+            "model_key": model_key,
+            "prompt_messages": json.dumps(serialized_messages),
+            "system_prompt": system_prompt,
+            "prompt_role": prompt_role,
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "total_tokens": input_tokens + output_tokens,
+            "cache_read_tokens": usage['cache_read_tokens'],
+            "cache_write_tokens": usage['cache_write_tokens'],
+            "response": text_response,
+            "verdict": verdict,
+            "started_at": started_at,
+            "finished_at": finished_at,
+            "created_at": finished_at,
+        }))
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            record = await self._queue.get()
+            batch = []
+            if record is _STOP:
+                stopping = True
+            else:
+                batch.append(record)
+                deadline = loop.time() + self.flush_interval
+                while len(batch) < self.batch_size:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        record = await asyncio.wait_for(self._queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                    if record is _STOP:
+                        stopping = True
+                        break
+                    batch.append(record)
+            if batch:
+                await self._write(batch)
+
+    def _lose_turn(self, turn_id: int):
+        self._lost_turns[turn_id] = None
+        if len(self._lost_turns) > LOST_TURNS_SIZE:
+            del self._lost_turns[next(iter(self._lost_turns))]
+
+    async def _write(self, batch: list[tuple]):
+        # Turns first so that invocations in the same batch can reference them. A response whose turn is still in
+        # this batch is folded into the INSERT instead of needing a separate UPDATE.
+        turns = {}
+        responses = []
+        invocations = []
+        for kind, values in batch:
+            if kind == "turn":
+                turns[values["id"]] = values
+            elif kind == "response":
+                if values["id"] in turns:
+                    turns[values["id"]].update(values)
+                elif values["id"] in self._lost_turns:
+                    self.dropped += 1
+                else:
+                    responses.append(values)
+            elif values["conversation_turn_id"] in self._lost_turns:
+                self.dropped += 1
+            else:
+                invocations.append(values)
+
+        started = time.perf_counter()
+        try:
+            await self._write_batch(turns, responses, invocations)
+            self.written += len(turns) + len(responses) + len(invocations)
+        except Exception as e:
+            logger.warning("Error writing audit log batch of %d records, writing them one by one: %s", len(batch), e)
+            await self._write_each(turns, responses, invocations)
+        finally:
+            db_write_seconds.observe(time.perf_counter() - started)
+
+    async def _write_batch(self, turns: dict[int, dict], responses: list[dict], invocations: list[dict]):
+        # One transaction: either the whole batch is written or nothing is
+        async with pool().connection() as conn:
+            async with conn.cursor() as cur:
+                if turns:
+                    async with cur.copy(f"COPY conversation_turns ({', '.join(TURN_COLUMNS)}) FROM STDIN") as copy:
+                        for values in turns.values():
+                            await copy.write_row([values.get(column) for column in TURN_COLUMNS])
+                if invocations:
+                    async with cur.copy(f"COPY ai_invocations ({', '.join(INVOCATION_COLUMNS)}) FROM STDIN") as copy:
+                        for values in invocations:
+                            await copy.write_row([values[column] for column in INVOCATION_COLUMNS])
+                if responses:
+                    await cur.executemany(UPDATE_RESPONSE, [_response_params(values) for values in responses])
+
+    async def _write_each(self, turns: dict[int, dict], responses: list[dict], invocations: list[dict]):
+        """Writes every record in its own transaction on one connection, so a failing record only loses itself."""
+        pending = len(turns) + len(responses) + len(invocations)
+        try:
+            async with pool().connection() as conn:
+                for values in turns.values():
+                    pending -= 1
+                    if not await self._write_record(conn, INSERT_TURN, [values.get(column) for column in TURN_COLUMNS]):
+                        self._lose_turn(values["id"])
+                for values in invocations:
+                    pending -= 1
+                    if values["conversation_turn_id"] in self._lost_turns:
+                        self.failed += 1
+                        continue
+                    await self._write_record(conn, INSERT_INVOCATION, [values[column] for column in INVOCATION_COLUMNS])
+                for values in responses:
+                    pending -= 1
+                    await self._write_record(conn, UPDATE_RESPONSE, _response_params(values))
+        except Exception as e:
+            # No connection at all: everything not attempted yet is lost
+            self.failed += pending
+            for turn_id in turns:
+                self._lose_turn(turn_id)
+            logger.exception("Error writing audit log records one by one, %d records lost", pending)
+
+    async def _write_record(self, conn, query: str, params: list) -> bool:
+        try:
+            async with conn.transaction():
+                await conn.execute(query, params)
+        except Exception as e:
+            self.failed += 1
+            logger.warning("Error writing audit log record: %s", e)
+            return False
+        self.written += 1
+        return True
+
+
+def _insert(table: str, columns: tuple[str, ...]) -> str:
+    return f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join(['%s'] * len(columns))})"
+
+
+def _response_params(values: dict) -> list:
+    return [values[column] for column in RESPONSE_COLUMNS] + [values["id"]]
+
+
+INSERT_TURN = _insert("conversation_turns", TURN_COLUMNS)
+INSERT_INVOCATION = _insert("ai_invocations", INVOCATION_COLUMNS)
+UPDATE_RESPONSE = (f"UPDATE conversation_turns SET {', '.join(f'{column} = %s' for column in RESPONSE_COLUMNS)} "
+                   "WHERE id = %s")
+
+audit_log = AuditLog(AUDIT_QUEUE_SIZE, AUDIT_BATCH_SIZE, AUDIT_FLUSH_INTERVAL, AUDIT_OVERFLOW, AUDIT_ID_BLOCK_SIZE)
@@ -0,0 +1,258 @@
+"""
+Load test / benchmark harness for the /invoke/ pipeline.
+
+    # in-process against main.app, with the mock provider unless INFERENCE_SERVICE is set explicitly
+    python bench.py run --requests 200 --concurrency 16
+
+    # against a running server (e.g. the uvicorn workers started by run.sh, with INFERENCE_SERVICE=mock)
+    python bench.py run --url http://127.0.0.1:10000 --requests 500 --concurrency 64
+
+    # record a trace of real invocations for the mock provider to replay (MOCK_TRACE_FILE)
+    python bench.py export-trace trace.jsonl --limit 5000
+
+Reports p50/p95/p99 latency, turns/sec, the refine loop distribution and the audit log write cost (from /metrics).
+In-process runs ignore the *_BACKENDS routes and DB_CONN_URL of .env unless they are set in the environment, and
+only write the audit log with --database, so that benchmark turns never reach a real provider or the audit tables.
+Every request asks a differently numbered question so the response cache does not short-circuit the pipeline; pass
+--repeat to send identical requests instead. Set PRECHECK_ENABLED=false to make every reply go through the (mock)
+LLM critique.
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import sys
+import time
+
+from dotenv import dotenv_values
+
+
+def offline_environment(keep_database: bool):
+    """
+    For in-process runs, before settings is imported: the mock provider and no per-stage routes unless they are set
+    in the environment itself (those from .env would still reach real providers), and no database unless
+    keep_database, so that the runs do not end up in the audit tables.
+    """
+    os.environ.setdefault("INFERENCE_SERVICE", "mock")
+    for name in dotenv_values():
+        if name.endswith("_BACKENDS"):
+            os.environ.setdefault(name, "")
+    if not keep_database:
+        os.environ["DB_CONN_URL"] = ""
+
+
+# The in-process benchmark must never burn API credits or write to the audit tables by accident
+if __name__ == "__main__" and "run" in sys.argv and "--url" not in sys.argv:
+    offline_environment(keep_database="--database" in sys.argv)
+
+import httpx
+
+DEFAULT_QUESTION = "案发当晚你在哪里？"
+METRIC_LINE = re.compile(r'^(\w+)(\{[^}]*\})? (\S+)$')
+
+
+def percentile(values: list[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(pct / 100 * len(values) + 0.5) - 1))
+    return values[index]
+
+
+def scrape_totals(text: str) -> dict[str, float]:
+    """Sums every sample of each metric in a /metrics page over its labels."""
+    totals = {}
+    for line in text.splitlines():
+        match = METRIC_LINE.match(line)
+        if match:
+            totals[match.group(1)] = totals.get(match.group(1), 0) + float(match.group(3))
+    return totals
+
+
+def build_body(args, i: int) -> dict:
+    question = args.question if args.repeat else f"{args.question}（{i}）"
+    return {
+        "character_file_version": args.character_file_version,
+        "actor_id": args.actor_ids[i % len(args.actor_ids)],
+        "session_id": f"bench-{i}",
+        "messages": [{"role": "user", "content": question}],
+    }
+
+
+async def send(client: httpx.AsyncClient, args, i: int) -> dict:
+    body = build_body(args, i)
+    started = time.perf_counter()
+    if args.stream:
+        response = None
+        async with client.stream("POST", "/invoke/stream", json=body) as r:
+            r.raise_for_status()
+            async for line in r.aiter_lines():
+                event = json.loads(line) if line else {}
+                if event.get("type") == "error":
+                    raise RuntimeError(event["detail"])
+                if event.get("type") in ("confirmed", "refined"):
+                    response = event["response"]
+    else:
+        r = await client.post("/invoke/", json=body)
+        r.raise_for_status()
+        response = r.json()
+    return {"latency": time.perf_counter() - started, "response": response}
+
+
+async def drive(client: httpx.AsyncClient, args) -> tuple[list[dict], int, float]:
+    queue = asyncio.Queue()
+    for i in range(args.requests):
+        queue.put_nowait(i)
+    results = []
+    errors = 0
+
+    async def worker():
+        nonlocal errors
+        while not queue.empty():
+            i = queue.get_nowait()
+            try:
+                results.append(await send(client, args, i))
+            except Exception as e:
+                errors += 1
+                print(f"Request {i} failed: {e}", file=sys.stderr)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    return results, errors, time.perf_counter() - started
+
+
+def report(results: list[dict], errors: int, elapsed: float, before: dict, after: dict) -> dict:
+    latencies = [result["latency"] for result in results]
+    refine_loops = {}
+    problems = 0
+    for result in results:
+        response = result["response"] or {}
+        # finish_turn joins every critique of the turn with "\n---\n": one per refine attempt plus the first
+        attempts = (response.get("critique_response") or "").count("\n---\n")
+        refine_loops[attempts] = refine_loops.get(attempts, 0) + 1
+        problems += bool(response.get("problems_detected"))
+
+    def delta(name: str) -> float:
+        return after.get(name, 0) - before.get(name, 0)
+
+    db_batches = delta("manososa_db_write_seconds_count")
+    return {
+        "requests": len(results) + errors,
+        "errors": errors,
+        "elapsed_seconds": round(elapsed, 3),
+        "turns_per_second": round(len(results) / elapsed, 2) if elapsed else 0.0,
+        "latency_p50": round(percentile(latencies, 50), 3),
+        "latency_p95": round(percentile(latencies, 95), 3),
+        "latency_p99": round(percentile(latencies, 99), 3),
+        "latency_max": round(max(latencies, default=0.0), 3),
+        "refine_attempts": {str(k): v for k, v in sorted(refine_loops.items())},
+        "problems_detected": problems,
+        "db_write_batches": int(db_batches),
+        "db_write_seconds_total": round(delta("manososa_db_write_seconds_sum"), 3),
+        "db_write_seconds_per_batch": round(delta("manososa_db_write_seconds_sum") / db_batches, 4)
+        if db_batches else 0.0,
+        "audit_records": int(delta("manososa_audit_records_total")),
+        "tokens": int(delta("manososa_tokens_total")),
+    }
+
+
+async def run(args):
+    if args.url:
+        client = httpx.AsyncClient(base_url=args.url, timeout=None,
+                                   limits=httpx.Limits(max_connections=args.concurrency))
+        lifespan = None
+    else:
+        import main
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://bench",
+                                   timeout=None)
+        # ASGITransport does not run the lifespan, so start clients, character files and the audit log here
+        lifespan = main.lifespan(main.app)
+        await lifespan.__aenter__()
+
+    try:
+        before = scrape_totals((await client.get("/metrics")).text)
+        results, errors, elapsed = await drive(client, args)
+        if lifespan is not None:
+            # Flush the audit log so its write cost is part of the report
+            await lifespan.__aexit__(None, None, None)
+            lifespan = None
+        after = scrape_totals((await client.get("/metrics")).text)
+    finally:
+        if lifespan is not None:
+            await lifespan.__aexit__(None, None, None)
+        await client.aclose()
+
+    summary = report(results, errors, elapsed, before, after)
+    if args.json:
+        print(json.dumps(summary, ensure_ascii=False))
+    else:
+        for key, value in summary.items():
+            print(f"{key:28} {value}")
+
+
+def export_trace(args):
+    import psycopg
+    from settings import DB_CONN_URL
+
+    if not DB_CONN_URL:
+        sys.exit("DB_CONN_URL is not defined")
+    query = ("SELECT prompt_role, EXTRACT(EPOCH FROM finished_at - started_at), input_tokens, output_tokens, "
+             "cache_read_tokens, cache_write_tokens, response FROM ai_invocations")
+    params = []
+    if args.model_key:
+        query += " WHERE model_key = %s"
+        params.append(args.model_key)
+    query += " ORDER BY id DESC LIMIT %s"
+    params.append(args.limit)
+
+    count = 0
+    with psycopg.connect(DB_CONN_URL) as conn, conn.cursor() as cur, open(args.output, "w", encoding="utf-8") as f:
+        cur.execute(query, params)
+        for role, latency, input_tokens, output_tokens, cache_read, cache_write, response in cur:
+            f.write(json.dumps({
+                "prompt_role": role,
+                "latency": float(latency) if latency is not None else None,
+                "input_tokens": input_tokens or 0,
+                "output_tokens": output_tokens or 0,
+                "cache_read_tokens": cache_read or 0,
+                "cache_write_tokens": cache_write or 0,
+                "response": response,
+            }, ensure_ascii=False) + "\n")
+            count += 1
+    print(f"Wrote {count} invocations to {args.output}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the /invoke/ pipeline")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="drive /invoke/ at a fixed concurrency")
+    run_parser.add_argument("--url", help="base URL of a running server; default runs main.app in-process")
+    run_parser.add_argument("--requests", type=int, default=100)
+    run_parser.add_argument("--concurrency", type=int, default=8)
+    run_parser.add_argument("--character-file-version", default="stock-characters::v1")
+    run_parser.add_argument("--actor-ids", type=lambda s: [int(x) for x in s.split(",")], default=[1],
+                            help="comma separated actor indexes, used round robin")
+    run_parser.add_argument("--question", default=DEFAULT_QUESTION)
+    run_parser.add_argument("--repeat", action="store_true",
+                            help="send identical requests (exercises the cache with RESPONSE_CACHE_ENABLED=true)")
+    run_parser.add_argument("--stream", action="store_true", help="use /invoke/stream instead of /invoke/")
+    run_parser.add_argument("--json", action="store_true", help="print the summary as one JSON line")
+    run_parser.add_argument("--database", action="store_true",
+                            help="in-process: keep DB_CONN_URL and write the audit log (measures its write cost)")
+
+    export_parser = commands.add_parser("export-trace", help="write recorded ai_invocations as a mock trace")
+    export_parser.add_argument("output")
+    export_parser.add_argument("--limit", type=int, default=5000)
+    export_parser.add_argument("--model-key", help="only export invocations of this MODEL_KEY")
+
+    args = parser.parse_args()
+    if args.command == "run":
+        asyncio.run(run(args))
+    else:
+        export_trace(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+import asyncio
+import hashlib
+import json
+import logging
+import random
+import time
+from collections import OrderedDict
+
+from db import pool
+from router import routing_key
+from invoke_types import InvocationRequest, InvocationResponse
+from settings import MODEL_KEY, RESPONSE_CACHE_ENABLED, RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL, RESPONSE_CACHE_DB, \
+    RESPONSE_CACHE_VARIANTS, COALESCE_REQUESTS
+
+logger = logging.getLogger(__name__)
+
+
+def request_cache_key(request: InvocationRequest) -> str:
+    """
+    Content hash of everything that influences the generated reply: the story, every actor field, the message
+    history, MODEL_KEY and the per-stage backends (so bumping PROMPTS_VERSION or changing a model invalidates every
+    entry). session_id is excluded so that different players asking the same thing share an entry.
+    """
+    payload = request.model_dump(exclude={"session_id"})
+    for msg in payload["actor"]["messages"]:
+        msg["content"] = msg["content"].strip()
+    payload["model_key"] = MODEL_KEY
+    payload["backends"] = routing_key()
+    serialized = json.dumps(payload, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    Two tier cache of final InvocationResponses keyed by request_cache_key().
+
+    The first tier is an in-process LRU with a per-entry TTL. The optional second tier reads finished rows of
+    conversation_turns with the same request_hash, so workers share what any of them has already generated.
+
+    Each key holds up to `variants` responses. With variants > 1 a key only counts as a hit once that many
+    different responses have been collected, and hits then return one of them at random to keep replies varied.
+    """
+
+    def __init__(self, max_size: int, ttl: float, variants: int, use_db: bool):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.variants = max(1, variants)
+        self.use_db = use_db
+        self._entries: OrderedDict[str, list[tuple[float, InvocationResponse]]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _live_variants(self, key: str) -> list[InvocationResponse]:
+        entries = self._entries.get(key)
+        if not entries:
+            return []
+        now = time.monotonic()
+        entries[:] = [(expires_at, response) for expires_at, response in entries if expires_at > now]
+        if not entries:
+            del self._entries[key]
+            return []
+        self._entries.move_to_end(key)
+        return [response for _, response in entries]
+
+    async def _db_variants(self, key: str) -> list[InvocationResponse]:
+        async with pool().connection() as conn, conn.cursor() as cur:
+            await cur.execute(
+                "SELECT original_response, critique_response, problems_detected, final_response, refined_response "
+                "FROM conversation_turns WHERE request_hash = %s AND model_key = %s AND final_response IS NOT NULL "
+                "AND problems_detected = FALSE AND finished_at > NOW() - make_interval(secs => %s) "
+                "ORDER BY id DESC LIMIT %s",
+                (key, MODEL_KEY, self.ttl, self.variants, )
+            )
+            rows = await cur.fetchall()
+        return [
+            InvocationResponse(original_response=row[0], critique_response=row[1], problems_detected=row[2],
+                               final_response=row[3], refined_response=row[4])
+            for row in rows
+        ]
+
+    async def get(self, key: str) -> InvocationResponse | None:
+        variants = self._live_variants(key)
+        if len(variants) < self.variants and self.use_db and pool() is not None:
+            try:
+                db_variants = await self._db_variants(key)
+            except Exception as e:
+                logger.warning("Error reading response cache from db: %s", e)
+                db_variants = []
+            for response in db_variants:
+                if len(variants) >= self.variants:
+                    break
+                if all(response.final_response != v.final_response for v in variants):
+                    self.put(key, response)
+                    variants.append(response)
+
+        if len(variants) < self.variants:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return random.choice(variants)
+
+    def put(self, key: str, response: InvocationResponse):
+        # 最终仍未通过审查的回复不缓存，下次重新生成
+        if response.problems_detected:
+            return
+        entries = self._entries.setdefault(key, [])
+        entries.append((time.monotonic() + self.ttl, response))
+        del entries[:-self.variants]
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent identical requests: the first request with a request_cache_key() runs the pipeline, later
+    ones arriving while it is still running wait for the same result instead of starting their own run.
+
+    The run is a separate task, so a leader that goes away (e.g. the client disconnects) does not cancel it for the
+    requests waiting on it.
+    """
+
+    def __init__(self):
+        self._inflight: dict[str, asyncio.Task] = {}
+        self.leaders = 0
+        self.followers = 0
+
+    def get(self, key: str) -> asyncio.Task | None:
+        return self._inflight.get(key)
+
+    async def run(self, key: str, make_coroutine) -> tuple[InvocationResponse, bool]:
+        """Returns the response and whether it was shared from another request's run."""
+        task = self._inflight.get(key)
+        if task is not None:
+            self.followers += 1
+            return await asyncio.shield(task), True
+
+        task = asyncio.create_task(make_coroutine())
+        self._inflight[key] = task
+        task.add_done_callback(lambda _: self._done(key, task))
+        self.leaders += 1
+        return await asyncio.shield(task), False
+
+    def _done(self, key: str, task: asyncio.Task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled():
+            # Marks the exception as retrieved when every waiter has gone away
+            task.exception()
+
+
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL, RESPONSE_CACHE_VARIANTS, RESPONSE_CACHE_DB) \
+    if RESPONSE_CACHE_ENABLED else None
+single_flight = SingleFlight() if COALESCE_REQUESTS else None
@@ -0,0 +1,129 @@
+import asyncio
+import logging
+
+import anthropic
+import httpx
+import openai
+
+from mock import mock_provider
+
+from settings import (INFERENCE_SERVICE, API_KEYS, OLLAMA_URL, GROQ_API_BASE, OPENROUTER_API_BASE, DEEPSEEK_API_BASE,
+                      PROVIDER_TIMEOUT, PROVIDER_CONNECT_TIMEOUT, HTTP_MAX_CONNECTIONS, HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                      HTTP_KEEPALIVE_EXPIRY, HTTP2, OLLAMA_KEEP_ALIVE)
+
+logger = logging.getLogger(__name__)
+
+# One client per (service, base_url), created on first use and reused for the lifetime of the worker so that
+# every LLM call rides on already-open keep-alive connections instead of paying a fresh TLS handshake.
+# SDK retries are disabled, retries are done by admission.py.
+_clients: dict[tuple[str, str], object] = {}
+# service -> "ok" or the error of the warm-up request, reported by /health
+warmup_status: dict[str, str] = {}
+
+
+def _http2_available() -> bool:
+    if not HTTP2:
+        return False
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        logger.warning("HTTP2 is enabled but the h2 package is not installed; falling back to HTTP/1.1")
+        return False
+    return True
+
+
+def _http_client(base_url: str = "") -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        base_url=base_url,
+        http2=_http2_available(),
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(PROVIDER_TIMEOUT, connect=PROVIDER_CONNECT_TIMEOUT),
+    )
+
+
+def base_url_for(service: str) -> str:
+    if service == 'groq':
+        return GROQ_API_BASE
+    elif service == 'openrouter':
+        return OPENROUTER_API_BASE
+    elif service == 'deepseek':
+        return DEEPSEEK_API_BASE
+    elif service == 'ollama':
+        return OLLAMA_URL
+    # anthropic and openai use the SDK default endpoint
+    return ""
+
+
+def get_client(service: str = INFERENCE_SERVICE):
+    """
+    Returns the shared client for a service: AsyncAnthropic, AsyncOpenAI (also used for the OpenAI-compatible
+    groq/openrouter/deepseek endpoints), a plain httpx.AsyncClient for Ollama or the offline MockProvider.
+    """
+    base_url = base_url_for(service)
+    key = (service, base_url)
+    client = _clients.get(key)
+    if client is not None:
+        return client
+
+    if service == 'anthropic':
+        client = anthropic.AsyncAnthropic(api_key=API_KEYS[service], http_client=_http_client(), max_retries=0)
+    elif service in ['openai', 'groq', 'openrouter', 'deepseek']:
+        client = openai.AsyncOpenAI(api_key=API_KEYS[service], base_url=base_url or None, http_client=_http_client(),
+                                    max_retries=0)
+    elif service == 'ollama':
+        client = _http_client(base_url)
+    elif service == 'mock':
+        client = mock_provider
+    else:
+        raise ValueError(f"Unknown inference service: {service}")
+
+    logger.info("Created %s client for %s", service, base_url or "default endpoint")
+    _clients[key] = client
+    return client
+
+
+async def _warm_client(service: str, models: set[str]):
+    client = get_client(service)
+    try:
+        if service == 'anthropic':
+            await client.models.list(limit=1)
+        elif service in ['openai', 'groq', 'openrouter', 'deepseek']:
+            await client.models.list()
+        elif service == 'ollama':
+            (await client.get("/api/tags")).raise_for_status()
+            # A chat request without messages only loads the model, so the first turn does not wait for it
+            for model in models:
+                (await client.post("/api/chat", json={"model": model, "messages": [],
+                                                      "keep_alive": OLLAMA_KEEP_ALIVE})).raise_for_status()
+    except Exception as e:
+        logger.warning("Warming up the %s client failed: %s", service, e)
+        warmup_status[service] = f"error: {e}"
+        return
+    warmup_status[service] = "ok"
+
+
+async def warm_clients(backends):
+    """
+    Creates the clients of the given backends' services and opens a keep-alive connection to each provider. Ollama
+    models are loaded as well.
+    """
+    services: dict[str, set[str]] = {}
+    for backend in backends:
+        services.setdefault(backend.service, set()).add(backend.model)
+    await asyncio.gather(*(_warm_client(service, models) for service, models in services.items()))
+
+
+async def close_clients():
+    for (service, base_url), client in list(_clients.items()):
+        try:
+            if isinstance(client, httpx.AsyncClient):
+                await client.aclose()
+            else:
+                await client.close()
+        except Exception as e:
+            logger.warning("Error closing %s client for %s: %s", service, base_url, e)
+    _clients.clear()
@@ -1,34 +1,93 @@
+import asyncio
+import hashlib
 import logging
 from functools import cache
 
-from settings import DB_CONN_URL, SCHEMA_PATH
-from psycopg_pool import ConnectionPool
+from settings import DB_CONN_URL, SCHEMA_PATH, DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, DB_POOL_OPEN_TIMEOUT
+from psycopg_pool import AsyncConnectionPool
 
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s"
 )
 logging.getLogger("psycopg.pool").setLevel(logging.INFO)
 
+# Arbitrary constant shared by every worker, see migrate()
+SCHEMA_LOCK_ID = 0x6d616e6f736f7361
+
 @cache
 def pool():
     if DB_CONN_URL:
-        return ConnectionPool(DB_CONN_URL, check=ConnectionPool.check_connection)
+        # The async pool has to be opened from inside the running event loop, see open_pool()
+        return AsyncConnectionPool(DB_CONN_URL, min_size=DB_POOL_MIN_SIZE, max_size=DB_POOL_MAX_SIZE,
+                                   check=AsyncConnectionPool.check_connection, open=False)
     return None
 
-def initialize():
-    if not DB_CONN_URL:
+async def open_pool(wait: bool = False):
+    """Opens the pool. With wait, returns only once min_size connections are established (at startup)."""
+    conn_pool = pool()
+    if conn_pool is not None:
+        # Safe to call repeatedly: it is a no-op once the pool is open
+        await conn_pool.open()
+        if wait:
+            await conn_pool.wait(timeout=DB_POOL_OPEN_TIMEOUT)
+    return conn_pool
+
+async def migrate():
+    """
+    Applies schema.sql once per version of the file. Called from the app's lifespan: all workers start at the same
+    time, so the first one takes an advisory lock and applies the schema while the others wait for it and then find
+    the version already recorded in schema_migrations.
+    """
+    conn_pool = await open_pool()
+    if conn_pool is None:
         logging.info("DB_CONN_URL is not defined. Skipping database initialization.")
         return
-    
+
+    schema = SCHEMA_PATH.read_text()
+    digest = hashlib.sha256(schema.encode("utf-8")).hexdigest()
+    async with conn_pool.connection() as conn, conn.transaction():
+        # Transaction-level lock: released on commit or rollback, so a failed migration cannot leave it held
+        await conn.execute("SELECT pg_advisory_xact_lock(%s)", (SCHEMA_LOCK_ID,))
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS "public".schema_migrations (
+                digest TEXT PRIMARY KEY,
+                applied_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW()
+            )
+        """)
+        cursor = await conn.execute("SELECT 1 FROM schema_migrations WHERE digest = %s", (digest,))
+        if await cursor.fetchone() is not None:
+            return
+        print("Executing ", SCHEMA_PATH)
+        await conn.execute(schema)
+        await conn.execute("INSERT INTO schema_migrations (digest) VALUES (%s)", (digest,))
+
+async def database_status(timeout: float = 2.0) -> dict:
+    """Pool statistics and the outcome of a SELECT 1, for the /health endpoint."""
     conn_pool = pool()
     if conn_pool is None:
-        logging.info("Connection pool is not available. Skipping database initialization.")
-        return
-    
-    with conn_pool.connection() as conn:
-        with conn.cursor() as cursor:
-            print("Executing ", SCHEMA_PATH)
-            cursor.execute(SCHEMA_PATH.read_text())
-        conn.commit()
-
-initialize()
+        return {"status": "disabled"}
+    stats = conn_pool.get_stats()
+    status = {
+        "pool_min": stats.get("pool_min"),
+        "pool_max": stats.get("pool_max"),
+        "pool_size": stats.get("pool_size"),
+        "pool_available": stats.get("pool_available"),
+        "requests_waiting": stats.get("requests_waiting", 0),
+    }
+    try:
+        async with conn_pool.connection(timeout=timeout) as conn:
+            await conn.execute("SELECT 1")
+    except Exception as e:
+        return {"status": "error", "detail": str(e), **status}
+    return {"status": "ok", **status}
+
+if __name__ == "__main__":
+    # Apply the schema without starting the app: python db.py
+    async def _main():
+        await migrate()
+        await pool().close()
+
+    if DB_CONN_URL:
+        asyncio.run(_main())
+    else:
+        logging.info("DB_CONN_URL is not defined. Skipping database initialization.")
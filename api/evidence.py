@@ -0,0 +1,97 @@
+import json
+import logging
+from collections import deque
+from pathlib import Path
+
+from settings import EVIDENCE_MAPPING_FILE
+
+logger = logging.getLogger(__name__)
+
+# 证物解锁检测：按角色把 responseKeywordMapping.json 中的关键词编译成一个 Aho–Corasick 自动机，
+# 对最终回复只扫描一遍（与关键词数量无关），匹配到的证物 ID 随 InvocationResponse 一起返回。
+
+
+class KeywordMatcher:
+    """Aho–Corasick automaton over lower-cased keywords, each keyword mapped to one or more payloads."""
+
+    def __init__(self, keywords: dict[str, set[str]]):
+        # State 0 is the root. _goto[state][char] -> state, _fail[state] -> state, _out[state] -> payloads
+        self._goto: list[dict[str, int]] = [{}]
+        self._fail: list[int] = [0]
+        self._out: list[set[str]] = [set()]
+        for keyword, payloads in keywords.items():
+            self._add(keyword.lower(), payloads)
+        self._link()
+
+    def _add(self, keyword: str, payloads: set[str]):
+        state = 0
+        for c in keyword:
+            next_state = self._goto[state].get(c)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][c] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append(set())
+            state = next_state
+        self._out[state] |= payloads
+
+    def _link(self):
+        # Breadth first, so a state's failure link is final before its children's links are computed
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for c, child in self._goto[state].items():
+                queue.append(child)
+                fail = self._fail[state]
+                while fail and c not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(c, 0)
+                # Keywords that end inside this one (suffixes) are reported here as well
+                self._out[child] |= self._out[self._fail[child]]
+
+    def find(self, text: str) -> set[str]:
+        """Payloads of every keyword occurring in text (case-insensitive), in one pass over the text."""
+        found = set()
+        state = 0
+        goto, fail, out = self._goto, self._fail, self._out
+        for c in text.lower():
+            while state and c not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(c, 0)
+            if out[state]:
+                found |= out[state]
+        return found
+
+
+# actor name -> matcher of that actor's keywords
+_matchers: dict[str, KeywordMatcher] = {}
+
+
+def load_evidence_mapping(path: Path | None = EVIDENCE_MAPPING_FILE):
+    """
+    Loads the per-actor keyword mapping ({actor: {"关键词": [...], "证物ID": "11"}}, or a list of such entries per
+    actor) and compiles one matcher per actor.
+    """
+    if path is None:
+        logger.info("EVIDENCE_MAPPING_FILE is empty, evidence unlocks are left to the client")
+        return
+    data = json.loads(path.read_text(encoding="utf-8"))
+    _matchers.clear()
+    for actor_name, entries in data.items():
+        keywords: dict[str, set[str]] = {}
+        for entry in entries if isinstance(entries, list) else [entries]:
+            for keyword in entry.get("关键词") or []:
+                if keyword:
+                    keywords.setdefault(keyword, set()).add(str(entry["证物ID"]))
+        if keywords:
+            _matchers[actor_name] = KeywordMatcher(keywords)
+    logger.info("Loaded evidence keywords for %d actors from %s", len(_matchers), path)
+
+
+def match_evidence(actor_name: str, text: str) -> list[str]:
+    """Evidence ids unlocked by an actor's reply, sorted."""
+    matcher = _matchers.get(actor_name)
+    if matcher is None or not text:
+        return []
+    return sorted(matcher.find(text))
@@ -0,0 +1,192 @@
+"""
+Incremental analytics export of conversation_turns and ai_invocations.
+
+    # gzip-compressed JSON lines (default), or Parquet when pyarrow is installed
+    python export.py out/
+    python export.py out/ --format parquet
+
+Rows are streamed through server-side cursors and written partitioned by day and model_key:
+
+    out/conversation_turns/date=2026-10-17/model_key=deepseek-chat%3A200%3A1.0.7/part-....jsonl.gz
+
+Each run continues from the checkpoint in out/_checkpoint.json, so it can be scheduled (e.g. from cron) without
+rescanning the tables. Rows are ordered by (created_at, id) rather than by id alone: the audit log reserves ids in
+blocks per worker, so ids are not written in order. Rows younger than --settle-minutes are left for the next run,
+which gives the write-behind audit log time to insert them and fill in the final responses. Part files are named
+after the checkpoint they start from, so a run that is repeated after a crash overwrites its own files instead of
+duplicating rows.
+"""
+import argparse
+import gzip
+import json
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from urllib.parse import quote
+
+import psycopg
+
+from audit import TURN_COLUMNS, INVOCATION_COLUMNS
+from settings import DB_CONN_URL
+
+TABLES = {
+    "conversation_turns": TURN_COLUMNS,
+    "ai_invocations": ("id",) + INVOCATION_COLUMNS,
+}
+JSON_COLUMNS = {"chat_messages", "prompt_messages"}
+INTEGER_COLUMNS = {"id", "conversation_turn_id", "history_offset", "input_tokens", "output_tokens", "total_tokens",
+                   "cache_read_tokens", "cache_write_tokens"}
+TIMESTAMP_COLUMNS = {"created_at", "started_at", "finished_at"}
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+class JsonlWriter:
+    suffix = ".jsonl.gz"
+
+    def __init__(self, path: Path, columns: tuple[str, ...]):
+        self.path = path
+        self.file = gzip.open(path, "wt", encoding="utf-8")
+
+    def write(self, row: dict):
+        self.file.write(json.dumps(row, ensure_ascii=False, default=str) + "\n")
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetWriter:
+    suffix = ".parquet"
+
+    def __init__(self, path: Path, columns: tuple[str, ...], batch_size: int = 5000):
+        import pyarrow
+        import pyarrow.parquet as parquet
+
+        self.columns = columns
+        self.batch_size = batch_size
+        self.rows: list[dict] = []
+        self.schema = pyarrow.schema([(column, arrow_type(column)) for column in columns])
+        self.writer = parquet.ParquetWriter(path, self.schema, compression="zstd")
+
+    def write(self, row: dict):
+        # JSONB columns are kept as JSON text: their structure varies between rows
+        self.rows.append({k: json.dumps(v, ensure_ascii=False) if k in JSON_COLUMNS else v for k, v in row.items()})
+        if len(self.rows) >= self.batch_size:
+            self._flush()
+
+    def _flush(self):
+        import pyarrow
+
+        if self.rows:
+            self.writer.write_table(pyarrow.Table.from_pylist(self.rows, schema=self.schema))
+            self.rows = []
+
+    def close(self):
+        self._flush()
+        self.writer.close()
+
+
+def arrow_type(column: str):
+    import pyarrow
+
+    if column in INTEGER_COLUMNS:
+        return pyarrow.int64()
+    if column in TIMESTAMP_COLUMNS:
+        return pyarrow.timestamp("us", tz="UTC")
+    if column == "problems_detected":
+        return pyarrow.bool_()
+    return pyarrow.string()
+
+
+WRITERS = {"jsonl": JsonlWriter, "parquet": ParquetWriter}
+
+
+def load_checkpoint(path: Path) -> dict:
+    if not path.exists():
+        return {}
+    return json.loads(path.read_text(encoding="utf-8"))
+
+
+def save_checkpoint(path: Path, checkpoint: dict):
+    tmp = path.with_suffix(".tmp")
+    tmp.write_text(json.dumps(checkpoint, indent=2), encoding="utf-8")
+    os.replace(tmp, path)
+
+
+def partition_dir(out: Path, table: str, row: dict) -> Path:
+    day = row["created_at"].astimezone(timezone.utc).date().isoformat() if row["created_at"] else "unknown"
+    return out / table / f"date={day}" / f"model_key={quote(row['model_key'] or '', safe='')}"
+
+
+def export_table(conn, out: Path, table: str, columns: tuple[str, ...], since: dict, until: datetime,
+                 writer_class, fetch_size: int) -> tuple[dict, int]:
+    """Streams the rows of table after `since` and created before `until`. Returns the new checkpoint and count."""
+    since_at = datetime.fromisoformat(since["created_at"]) if since else EPOCH
+    since_id = since["id"] if since else 0
+    part = f"part-{since_at.strftime('%Y%m%dT%H%M%S%f')}-{since_id}"
+    writers: dict[Path, object] = {}
+    checkpoint = since
+    count = 0
+    try:
+        # A named cursor is a server-side cursor: rows arrive in batches of fetch_size instead of all at once
+        with conn.cursor(name=f"export_{table}") as cur:
+            cur.itersize = fetch_size
+            cur.execute(
+                f"SELECT {', '.join(columns)} FROM {table} "
+                "WHERE (created_at, id) > (%s, %s) AND created_at < %s ORDER BY created_at, id",
+                (since_at, since_id, until),
+            )
+            for values in cur:
+                row = dict(zip(columns, values))
+                directory = partition_dir(out, table, row)
+                writer = writers.get(directory)
+                if writer is None:
+                    directory.mkdir(parents=True, exist_ok=True)
+                    writer = writers[directory] = writer_class(directory / f"{part}{writer_class.suffix}", columns)
+                writer.write(row)
+                checkpoint = {"created_at": row["created_at"].isoformat(), "id": row["id"]}
+                count += 1
+    finally:
+        for writer in writers.values():
+            writer.close()
+    return checkpoint, count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export conversation_turns and ai_invocations for analytics")
+    parser.add_argument("output", type=Path)
+    parser.add_argument("--format", choices=sorted(WRITERS), default="jsonl")
+    parser.add_argument("--tables", type=lambda s: s.split(","), default=list(TABLES),
+                        help="comma separated tables to export")
+    parser.add_argument("--settle-minutes", type=float, default=10,
+                        help="leave rows younger than this for the next run")
+    parser.add_argument("--fetch-size", type=int, default=2000, help="rows per server-side cursor round-trip")
+    args = parser.parse_args()
+
+    if not DB_CONN_URL:
+        sys.exit("DB_CONN_URL is not defined")
+    unknown = set(args.tables) - set(TABLES)
+    if unknown:
+        sys.exit(f"Unknown tables: {', '.join(sorted(unknown))}")
+    if args.format == "parquet":
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            sys.exit("--format parquet needs the pyarrow package")
+
+    args.output.mkdir(parents=True, exist_ok=True)
+    checkpoint_path = args.output / "_checkpoint.json"
+    checkpoint = load_checkpoint(checkpoint_path)
+    until = datetime.now(timezone.utc) - timedelta(minutes=args.settle_minutes)
+
+    with psycopg.connect(DB_CONN_URL) as conn:
+        for table in args.tables:
+            checkpoint[table], count = export_table(conn, args.output, table, TABLES[table], checkpoint.get(table),
+                                                    until, WRITERS[args.format], args.fetch_size)
+            # Saved after each table, once its files are closed
+            save_checkpoint(checkpoint_path, checkpoint)
+            print(f"Exported {count} rows of {table}")
+
+
+if __name__ == "__main__":
+    main()
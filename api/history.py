@@ -0,0 +1,135 @@
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+
+from pydantic import BaseModel
+
+from invoke_types import InvocationRequest, LLMMessage
+from text import estimate_tokens
+from settings import HISTORY_COMPACTION, HISTORY_TOKEN_BUDGET, HISTORY_RECENT_TOKENS, HISTORY_MIN_RECENT_MESSAGES, \
+    HISTORY_SUMMARY_CACHE_SIZE
+
+logger = logging.getLogger(__name__)
+
+# 长时间审讯的对话压缩：历史超过 token 预算后，较早的轮次被折叠成按会话和角色缓存的摘要，
+# 请求中只发送摘要（拼在系统提示末尾）和最近的几轮对话。摘要在后台增量生成，不占用请求路径；
+# 摘要还没准备好时照常发送完整历史。
+
+
+def messages_hash(messages: list[LLMMessage]) -> str:
+    digest = hashlib.sha256()
+    for msg in messages:
+        digest.update(f"{msg.role}\x00{msg.content.strip()}\x01".encode("utf-8"))
+    return digest.hexdigest()
+
+
+class HistorySummary(BaseModel):
+    # Number of leading messages folded into the summary and their hash, so an edited or restarted history is
+    # never answered with a stale summary
+    covered: int
+    covered_hash: str
+    text: str
+
+
+class CompactedHistory(BaseModel):
+    summary: str | None
+    messages: list[LLMMessage]
+
+
+class HistoryCompactor:
+    """
+    Per-worker LRU of conversation summaries keyed by (character_file_version, session_id, actor name).
+
+    compact() is called on the request path and only does dictionary lookups; when the summary lags behind the part
+    of the history that should be folded, it schedules a background task that extends the summary with the
+    messages it does not cover yet.
+    """
+
+    def __init__(self, max_size: int, token_budget: int, recent_tokens: int, min_recent_messages: int):
+        self.max_size = max_size
+        self.token_budget = token_budget
+        self.recent_tokens = recent_tokens
+        self.min_recent_messages = min_recent_messages
+        self._summaries: OrderedDict[tuple, HistorySummary] = OrderedDict()
+        self._pending: dict[tuple, asyncio.Task] = {}
+        self.compacted = 0
+        self.summarized = 0
+        self.failed = 0
+
+    @staticmethod
+    def _key(request: InvocationRequest) -> tuple:
+        return request.character_file_version, request.session_id, request.actor.name
+
+    def _split_index(self, messages: list[LLMMessage]) -> int:
+        """Number of leading messages to fold: everything but a recent window that starts with a user message."""
+        kept_tokens = 0
+        split = len(messages)
+        while split > 0:
+            kept = len(messages) - split
+            tokens = estimate_tokens(messages[split - 1].content)
+            if kept >= self.min_recent_messages and kept_tokens + tokens > self.recent_tokens:
+                break
+            kept_tokens += tokens
+            split -= 1
+        # The messages sent to the provider have to start with a user turn
+        while 0 < split < len(messages) and messages[split].role != "user":
+            split -= 1
+        return split
+
+    def _summary_for(self, key: tuple, messages: list[LLMMessage]) -> HistorySummary | None:
+        summary = self._summaries.get(key)
+        if summary is None or summary.covered > len(messages):
+            return None
+        if summary.covered_hash != messages_hash(messages[:summary.covered]):
+            return None
+        self._summaries.move_to_end(key)
+        return summary
+
+    def _store(self, key: tuple, summary: HistorySummary):
+        self._summaries[key] = summary
+        self._summaries.move_to_end(key)
+        while len(self._summaries) > self.max_size:
+            self._summaries.popitem(last=False)
+
+    def compact(self, turn_id: int, request: InvocationRequest, summarizer) -> CompactedHistory:
+        """
+        Returns the summary to add to the system prompt (None if there is none yet) and the messages to send.
+        summarizer(turn_id, request, previous_summary, messages) -> str produces the extended summary.
+        """
+        messages = request.actor.messages
+        if sum(estimate_tokens(msg.content) for msg in messages) <= self.token_budget:
+            return CompactedHistory(summary=None, messages=messages)
+
+        key = self._key(request)
+        split = self._split_index(messages)
+        summary = self._summary_for(key, messages)
+        if split > 0 and (summary is None or summary.covered < split) and key not in self._pending:
+            task = asyncio.create_task(self._summarize(key, turn_id, request, summary, messages[:split], summarizer))
+            self._pending[key] = task
+            task.add_done_callback(lambda _: self._pending.pop(key, None))
+
+        if summary is None or summary.covered == 0:
+            return CompactedHistory(summary=None, messages=messages)
+        self.compacted += 1
+        return CompactedHistory(summary=summary.text, messages=messages[summary.covered:])
+
+    async def _summarize(self, key: tuple, turn_id: int, request: InvocationRequest,
+                         previous: HistorySummary | None, messages: list[LLMMessage], summarizer):
+        covered = previous.covered if previous is not None else 0
+        try:
+            text = await summarizer(turn_id, request, previous.text if previous is not None else None,
+                                    messages[covered:])
+        except Exception as e:
+            self.failed += 1
+            logger.warning("Summarizing history of %s failed: %s", key, e)
+            return
+        self.summarized += 1
+        self._store(key, HistorySummary(covered=len(messages), covered_hash=messages_hash(messages), text=text))
+
+    def clear(self):
+        self._summaries.clear()
+
+
+history_compactor = HistoryCompactor(HISTORY_SUMMARY_CACHE_SIZE, HISTORY_TOKEN_BUDGET, HISTORY_RECENT_TOKENS,
+                                     HISTORY_MIN_RECENT_MESSAGES) if HISTORY_COMPACTION else None
@@ -15,6 +15,8 @@ class Actor(BaseModel):
     violation: str
     messages: list[LLMMessage]
     hurt: Optional[str] = None
+    # Local pre-check threshold for this actor (see precheck.py); None uses PRECHECK_SAFE_SCORE, negative disables it
+    precheck_threshold: Optional[float] = None
 
 
 class InvocationRequest(BaseModel):
@@ -30,4 +32,39 @@ class InvocationResponse(BaseModel):
     problems_detected: bool
     final_response: str
     refined_response: str | None
+    # Evidence unlocked by final_response (see evidence.py); None until matched, e.g. for responses read back
+    # from conversation_turns
+    evidence_ids: list[str] | None = None
 
+
+
+class RegisteredInvocationRequest(BaseModel):
+    """
+    Compact form of InvocationRequest for characters known to the server (see registry.py): the story and the
+    actor sheet are looked up by character_file_version and actor_id instead of being sent on every turn.
+    """
+    character_file_version: str
+    # Index of the actor in the character file (as used by the frontend), or the actor's name
+    actor_id: int | str
+    session_id: str
+    messages: list[LLMMessage]
+    # Appended to the actor's context1, e.g. the detective's memory of earlier conversations
+    extra_context: Optional[str] = None
+    # Evidence presented to this actor so far; unlocks context2..lastcontext as in context2Mapping.json
+    evidence_ids: list[str] = []
+
+
+class SessionInvocationRequest(BaseModel):
+    """
+    Incremental form of RegisteredInvocationRequest: the server keeps each actor's conversation per session (see
+    sessions.py), so only the new user message is sent. history_length is the number of messages the client has
+    before it; when the server's copy differs it answers 409 and the client resends the turn once as a
+    RegisteredInvocationRequest with the full history, which also resynchronizes the server's copy.
+    """
+    character_file_version: str
+    actor_id: int | str
+    session_id: str
+    message: LLMMessage
+    history_length: int
+    extra_context: Optional[str] = None
+    evidence_ids: list[str] = []
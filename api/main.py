@@ -1,15 +1,79 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Response
+from fastapi.responses import StreamingResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
-from invoke_types import InvocationRequest, InvocationResponse
-from db import pool
+from invoke_types import InvocationRequest, InvocationResponse, RegisteredInvocationRequest, SessionInvocationRequest, \
+    LLMMessage
+from cache import response_cache, single_flight, request_cache_key
+from audit import audit_log
+from precheck import precheck_stats
+from history import history_compactor
+from admission import ProviderUnavailable, gate_samples, provider_gate
+from router import all_backends, stage_backends, router_samples
+from metrics import TurnTrace, current_trace, current_actor, span, register_collector, render_metrics, \
+    local_truncations_total
+from registry import load_character_files, resolve_request
+from evidence import load_evidence_mapping, match_evidence
+from sessions import session_store
+import asyncio
 import json
+import math
 import random
-from settings import MODEL, MODEL_KEY
-from ai import respond_initial, critique, refine, check_whether_to_refine
-from datetime import datetime, timezone
+from settings import CANDIDATE_COUNT, CANDIDATE_CANCEL_POLICY, LOCAL_TRUNCATION, PREWARM_CLIENTS, STAGES
+from ai import respond_initial, respond_initial_stream, critique, refine, length_only_violation
+from verdict import CritiqueVerdict
+from text import normalize_response, truncate_to_length
+from clients import get_client, close_clients, warm_clients, warmup_status
+from db import migrate, open_pool, database_status
+from contextlib import asynccontextmanager, nullcontext
 import time
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 每个 worker 只创建一次 provider 客户端，请求之间复用 keep-alive 连接
+    backends = all_backends()
+    for service in {backend.service for backend in backends}:
+        get_client(service)
+    load_character_files()
+    load_evidence_mapping()
+    # 在接受请求之前完成建表（多个 worker 之间由 advisory lock 串行化）、连接池预热和 provider 连接预热，
+    # 部署后的第一个请求不用再承担这些延迟
+    await asyncio.gather(migrate(), warm_clients(backends) if PREWARM_CLIENTS else asyncio.sleep(0))
+    await open_pool(wait=True)
+    await audit_log.start()
+    yield
+    await audit_log.stop()
+    await close_clients()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+def _runtime_samples():
+    samples = [
+        ("manososa_precheck_total", "counter", "Local pre-check outcomes",
+         [({"outcome": outcome}, count) for outcome, count in precheck_stats.items()]),
+        ("manososa_audit_records_total", "counter", "Audit log records by outcome",
+         [({"outcome": "written"}, audit_log.written), ({"outcome": "dropped"}, audit_log.dropped),
+          ({"outcome": "failed"}, audit_log.failed)]),
+    ]
+    if history_compactor is not None:
+        samples.append(("manososa_history_summaries_total", "counter", "History compaction outcomes",
+                        [({"outcome": "compacted"}, history_compactor.compacted),
+                         ({"outcome": "summarized"}, history_compactor.summarized),
+                         ({"outcome": "failed"}, history_compactor.failed)]))
+    if single_flight is not None:
+        samples.append(("manososa_coalesced_requests_total", "counter", "Pipeline runs started and shared",
+                        [({"role": "leader"}, single_flight.leaders), ({"role": "follower"}, single_flight.followers)]))
+    if response_cache is not None:
+        samples.append(("manososa_response_cache_total", "counter", "Response cache lookups",
+                        [({"result": "hit"}, response_cache.hits), ({"result": "miss"}, response_cache.misses)]))
+    return samples
+
+
+register_collector(_runtime_samples)
+register_collector(gate_samples)
+register_collector(router_samples)
 
 origins = [
     "*"
@@ -23,56 +87,177 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-def create_conversation_turn(conn, request: InvocationRequest) -> int:
-    if conn is None:
-        return 0
+async def create_conversation_turn(request: InvocationRequest, request_hash: str | None = None,
+                                   history_offset: int = 0) -> int:
+    # 只预留 id 并排队写入，不在请求路径上等待数据库
+    with span("reserve_turn_id"):
+        turn_id = await audit_log.reserve_turn_id()
+    await audit_log.log_turn(turn_id, request, request_hash, history_offset)
+    return turn_id
 
-    try:
-        with conn.cursor() as cur:        
-            serialized_chat_messages = [msg.model_dump() for msg in request.actor.messages]
-            cur.execute(
-                "INSERT INTO conversation_turns (session_id, character_file_version, model, model_key, actor_name, chat_messages) "
-                "VALUES (%s, %s, %s, %s, %s, %s) RETURNING id",
-                (request.session_id, request.character_file_version,
-                 MODEL, MODEL_KEY, request.actor.name, json.dumps(serialized_chat_messages), )
-            )
-            turn_id = cur.fetchone()[0]
-        conn.commit()
-        return turn_id
-    except Exception as e:
-        conn.rollback()
-        print(f"Error in create_conversation_turn: {e}")
-        return 0
+async def store_response(turn_id: int, response: InvocationResponse):
+    await audit_log.log_response(turn_id, response)
 
-def store_response(conn, turn_id: int, response: InvocationResponse):
-    try:
-        with conn.cursor() as cur:
-            cur.execute(
-               "UPDATE conversation_turns SET original_response = %s, critique_response = %s, problems_detected = %s, "
-               "final_response = %s, refined_response = %s, finished_at= %s WHERE id=%s",
-                  (response.original_response, response.critique_response, response.problems_detected, response.final_response,
-                    response.refined_response, datetime.now(tz=timezone.utc).isoformat(), turn_id, )
-            )
-        conn.commit()
-    except Exception as e:
-        conn.rollback()
-        print(f"Error in store_response: {e}")
+async def lookup_cached_response(turn_id: int, request: InvocationRequest,
+                                 cache_key: str | None) -> InvocationResponse | None:
+    if response_cache is None:
+        return None
+    with span("cache_lookup"):
+        cached = await response_cache.get(cache_key)
+    if cached is not None:
+        # A copy: the cached object is shared by every hit and stays as it was stored
+        cached = cached.model_copy()
+        if cached.evidence_ids is None:
+            # Read back from conversation_turns
+            cached.evidence_ids = match_evidence(request.actor.name, cached.final_response)
+        print(f"Cache hit for turn {turn_id}")
+        await store_response(turn_id, cached)
+    return cached
 
-def prompt_ai(conn, request: InvocationRequest) -> InvocationResponse:
-    turn_id = create_conversation_turn(conn, request)
+def request_key(request: InvocationRequest) -> str | None:
+    # 响应缓存和合并并发请求共用同一个请求键
+    return request_cache_key(request) if response_cache is not None or single_flight is not None else None
+
+async def prompt_ai(request: InvocationRequest, history_offset: int = 0) -> InvocationResponse:
+    trace = TurnTrace(0, request.actor.name)
+    current_trace.set(trace)
+    cache_key = request_key(request)
+    turn_id = trace.turn_id = await create_conversation_turn(request, cache_key, history_offset)
     print(f"Serving turn {turn_id}")
 
-    # UNREFINED
-    unrefined_response = respond_initial(conn, turn_id, request)
+    cached = await lookup_cached_response(turn_id, request, cache_key)
+    if cached is not None:
+        trace.finish("cache", cached.refined_response is not None, cached.problems_detected)
+        return cached
+
+    if single_flight is None:
+        response = await run_pipeline(turn_id, request)
+    else:
+        # 相同的请求正在处理时共享其结果（例如整个教室同时问同一个问题），每个请求仍然各自记录一行 conversation_turns
+        response, shared = await single_flight.run(cache_key, lambda: run_pipeline(turn_id, request))
+        if shared:
+            print(f"Turn {turn_id} shares the response of an identical in-flight turn")
+            await store_response(turn_id, response)
+            trace.finish("coalesced", response.refined_response is not None, response.problems_detected)
+            return response
+    if response_cache is not None:
+        response_cache.put(cache_key, response)
+    trace.finish("llm", response.refined_response is not None, response.problems_detected)
+    return response
+
+async def run_pipeline(turn_id: int, request: InvocationRequest) -> InvocationResponse:
+    if CANDIDATE_COUNT > 1:
+        # 并行生成多个候选并同时审查，只有全部未通过时才进入修改循环
+        unrefined_response, verdict = await generate_candidates(turn_id, request)
+        response = await finish_turn(turn_id, request, unrefined_response, verdict)
+    else:
+        # UNREFINED
+        unrefined_response = await respond_initial(turn_id, request)
+
+        print(f"\nunrefined_response: {unrefined_response}\n")
+
+        response = await finish_turn(turn_id, request, unrefined_response)
+    return response
+
+async def generate_candidate(turn_id: int, request: InvocationRequest) -> tuple[str, CritiqueVerdict]:
+    unrefined_response = await respond_initial(turn_id, request)
+    verdict = await critique(turn_id, request, unrefined_response)
+    return unrefined_response, verdict
+
+async def generate_candidates(turn_id: int, request: InvocationRequest) -> tuple[str, CritiqueVerdict]:
+    """
+    Generates CANDIDATE_COUNT initial responses concurrently and critiques each as soon as it is ready.
+    Returns (unrefined_response, verdict) of the first candidate that passes the critique. With
+    CANDIDATE_CANCEL_POLICY "cancel" the remaining candidates are cancelled right away; with "wait" all of them run
+    to completion (so every invocation is logged) and the earliest passing one is used. If none passes, the first
+    finished candidate is returned together with its critique so the caller can fall back to the refine loop.
+    """
+    tasks = [asyncio.create_task(generate_candidate(turn_id, request)) for _ in range(CANDIDATE_COUNT)]
+    passed = None
+    failed = None
+    last_error = None
+    try:
+        for next_finished in asyncio.as_completed(tasks):
+            try:
+                candidate = await next_finished
+            except Exception as e:
+                print(f"Error generating candidate for turn {turn_id}: {e}")
+                last_error = e
+                continue
+
+            print(f"\ncandidate: {candidate[0]}\ncritique_response: {candidate[1].to_text()}\n")
+            if candidate[1].passed:
+                passed = passed or candidate
+                if CANDIDATE_CANCEL_POLICY == "cancel":
+                    break
+            else:
+                failed = failed or candidate
+    finally:
+        for task in tasks:
+            task.cancel()
+
+    if passed is not None:
+        return passed
+    if failed is not None:
+        return failed
+    raise last_error
+
+async def prompt_ai_stream(request: InvocationRequest, history_offset: int = 0):
+    """
+    Streaming variant of prompt_ai. Yields events for the NDJSON /invoke/stream endpoint:
+    {"type": "token", "text": ...} for every chunk of the initial response while it is generated, then exactly one of
+    {"type": "confirmed", "response": ...} when the critique accepts the initial response as streamed, or
+    {"type": "refined", "response": ...} when it had to be rewritten and the client must replace the streamed text.
+    """
+    trace = TurnTrace(0, request.actor.name)
+    current_trace.set(trace)
+    cache_key = request_key(request)
+    turn_id = trace.turn_id = await create_conversation_turn(request, cache_key, history_offset)
+    print(f"Serving streamed turn {turn_id}")
 
+    cached = await lookup_cached_response(turn_id, request, cache_key)
+    if cached is not None:
+        trace.finish("cache", cached.refined_response is not None, cached.problems_detected)
+        yield {"type": "token", "text": cached.final_response}
+        yield {"type": "confirmed", "response": cached.model_dump()}
+        return
+
+    # 流式请求的 token 无法共享，只在已有相同的非流式请求处理中时等待其结果
+    in_flight = single_flight.get(cache_key) if single_flight is not None else None
+    if in_flight is not None:
+        single_flight.followers += 1
+        response = await asyncio.shield(in_flight)
+        await store_response(turn_id, response)
+        trace.finish("coalesced", response.refined_response is not None, response.problems_detected)
+        yield {"type": "token", "text": response.final_response}
+        yield {"type": "confirmed", "response": response.model_dump()}
+        return
+
+    chunks = []
+    async for chunk in respond_initial_stream(turn_id, request):
+        chunks.append(chunk)
+        yield {"type": "token", "text": chunk}
+
+    unrefined_response = normalize_response("".join(chunks))
     print(f"\nunrefined_response: {unrefined_response}\n")
 
-    # 所有角色都进行审查，原则A（发言与自身掌握的事实相矛盾）作用于所有角色
-    critique_response = critique(conn, turn_id, request, unrefined_response)
+    response = await finish_turn(turn_id, request, unrefined_response)
+    if response_cache is not None:
+        response_cache.put(cache_key, response)
+    trace.finish("llm_stream", response.refined_response is not None, response.problems_detected)
+    event_type = "confirmed" if response.refined_response is None else "refined"
+    yield {"type": event_type, "response": response.model_dump()}
+
+async def finish_turn(turn_id: int, request: InvocationRequest, unrefined_response: str,
+                      verdict: CritiqueVerdict | None = None) -> InvocationResponse:
+    if verdict is None:
+        # 所有角色都进行审查，原则A（发言与自身掌握的事实相矛盾）作用于所有角色
+        verdict = await critique(turn_id, request, unrefined_response)
 
-    print(f"\ncritique_response: {critique_response}\n")
+        print(f"\ncritique_response: {verdict.to_text()}\n")
 
-    problems_found = check_whether_to_refine(critique_response)
+    critique_response = verdict.to_text()
+    problems_found = not verdict.passed
 
     # 循环审查和修改机制：最多尝试2次
     MAX_REFINE_ATTEMPTS = 2
@@ -82,22 +267,33 @@ def prompt_ai(conn, request: InvocationRequest) -> InvocationResponse:
     previous_refine_attempts = []  # 记录之前失败的修改尝试
     refined_response = None
     
-    while problems_found and refine_attempts < MAX_REFINE_ATTEMPTS:
+    while problems_found:
+        if LOCAL_TRUNCATION and length_only_violation(current_response, verdict):
+            # 只违反原则B（字数过多）：在本地按句子边界截断，省去一次修改和一次审查
+            with span("truncate", refine_attempts):
+                current_response = refined_response = truncate_to_length(current_response)
+            local_truncations_total.inc(actor=current_actor())
+            problems_found = False
+            print(f"\n只违反原则B，已在本地截断：{current_response}\n")
+            break
+        if refine_attempts >= MAX_REFINE_ATTEMPTS:
+            break
         refine_attempts += 1
         print(f"\n=== 第 {refine_attempts} 次修改 ===\n")
         
         # 进行修改，传递之前失败的尝试历史和当前尝试次数
-        refined_response = refine(conn, turn_id, request, critique_response, current_response, previous_refine_attempts, refine_attempts)
+        refined_response = await refine(turn_id, request, critique_response, current_response, previous_refine_attempts, refine_attempts)
         print(f"\nrefined_response (attempt {refine_attempts}): {refined_response}\n")
         
         # 对修改后的内容进行审查
-        critique_response = critique(conn, turn_id, request, refined_response)
+        verdict = await critique(turn_id, request, refined_response, refine_attempts)
+        critique_response = verdict.to_text()
         print(f"\ncritique_response (attempt {refine_attempts}): {critique_response}\n")
         
         all_critique_responses.append(critique_response)
         
         # 检查是否通过审查
-        problems_found = check_whether_to_refine(critique_response)
+        problems_found = not verdict.passed
         
         if not problems_found:
             # 审查通过，使用修改后的回复
@@ -129,6 +325,15 @@ def prompt_ai(conn, request: InvocationRequest) -> InvocationResponse:
     )
 
     # 如果当前角色是二阶堂希罗，在最终回复前后加上括号（在审查和修复之后）
+    with span("postprocess"):
+        response = postprocess_response(request, response)
+        response.evidence_ids = match_evidence(request.actor.name, response.final_response)
+
+    await store_response(turn_id, response)
+
+    return response
+
+def postprocess_response(request: InvocationRequest, response: InvocationResponse) -> InvocationResponse:
     if request.actor.name == "二阶堂希罗":
         # 移除已有的括号，避免重复嵌套
         final_response_text = response.final_response
@@ -145,45 +350,149 @@ def prompt_ai(conn, request: InvocationRequest) -> InvocationResponse:
             final_response=final_response_text,
             refined_response=response.refined_response,
         )
+    return response
 
-    if conn is not None:
-        store_start = time.time()
-        store_response(conn, turn_id, response)
-        print(f"Stored in {time.time() - store_start:.2f}s")
+class SessionConflict(Exception):
+    pass
 
-    return response
+async def resolve_invocation(request: InvocationRequest | RegisteredInvocationRequest | SessionInvocationRequest) \
+        -> tuple[InvocationRequest, tuple[str, str] | None, int]:
+    """
+    Returns the InvocationRequest to run, the key of the server-side session history the turn extends (None for
+    full InvocationRequests or when sessions are off) and how many of its messages are already stored.
+    """
+    if isinstance(request, InvocationRequest):
+        return request, None, 0
+    if isinstance(request, SessionInvocationRequest) and session_store is None:
+        raise HTTPException(status_code=400, detail="Session requests are disabled (SESSION_STORE=off)")
+    try:
+        invocation = resolve_request(request)
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=e.args[0])
+    if session_store is None:
+        return invocation, None, 0
+
+    key = (request.session_id, invocation.actor.name)
+    if isinstance(request, RegisteredInvocationRequest):
+        # 完整历史：与已保存的历史比较，只保存新增的部分（历史不一致时从分歧处重写）
+        stored = await session_store.load(key)
+        offset = 0
+        for stored_msg, msg in zip(stored, request.messages):
+            if stored_msg.role != msg.role or stored_msg.content != msg.content:
+                break
+            offset += 1
+        return invocation, key, offset
+
+    history = await session_store.load(key, request.history_length)
+    if len(history) != request.history_length:
+        raise HTTPException(status_code=409, detail=f"Session history has {len(history)} messages, "
+                                                    f"the client has {request.history_length}; resend the full history")
+    invocation.actor.messages = history + invocation.actor.messages
+    return invocation, key, len(history)
+
+def session_lock(key: tuple[str, str] | None):
+    return session_store.lock(key) if key is not None else nullcontext()
+
+async def check_session(key: tuple[str, str] | None, offset: int, exact: bool):
+    # 等待锁期间同一会话的另一轮可能已经写入了新消息；只发送了新消息的请求必须正好接在已保存的历史之后
+    if key is None:
+        return
+    stored = len(await session_store.load(key))
+    if stored < offset or (exact and stored != offset):
+        raise SessionConflict("Session history changed while waiting for the previous turn; resend the full history")
+
+async def store_session_turn(key: tuple[str, str] | None, request: InvocationRequest, offset: int,
+                             response: InvocationResponse):
+    if key is None:
+        return
+    new_messages = request.actor.messages[offset:] + [LLMMessage(role="assistant", content=response.final_response)]
+    await session_store.append(key, offset, new_messages)
 
 @app.post("/invoke/")
-async def invoke(request: InvocationRequest):
+async def invoke(request: InvocationRequest | RegisteredInvocationRequest | SessionInvocationRequest):
+    is_delta = isinstance(request, SessionInvocationRequest)
+    request, session_key, history_offset = await resolve_invocation(request)
     start_time = time.time()
-    connection_pool = pool()
-    
-    conn = None
     try:
-        # Use a mock connection object or None if the pool is not available
-        conn = connection_pool.getconn() if connection_pool else None
-        
-        conn_time = time.time()
-        print(f"Conn in {conn_time - start_time:.2f}s")
-        response = prompt_ai(conn, request)
-        response_time = time.time()
-        print(f"Response in {response_time - conn_time:.2f}s")
+        async with session_lock(session_key):
+            await check_session(session_key, history_offset, is_delta)
+            response = await prompt_ai(request, history_offset)
+            await store_session_turn(session_key, request, history_offset, response)
+        print(f"Response in {time.time() - start_time:.2f}s")
 
         return response.model_dump()
+    except SessionConflict as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except ProviderUnavailable as e:
+        # 排队已满或熔断中：让客户端稍后重试，而不是返回 500
+        print(f"Provider unavailable in invoke endpoint: {e}")
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(math.ceil(e.retry_after))})
     except Exception as e:
         print(f"Error in invoke endpoint: {e}")
         import traceback
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        if conn:
-            connection_pool.putconn(conn)
+
+@app.post("/invoke/stream")
+async def invoke_stream(request: InvocationRequest | RegisteredInvocationRequest | SessionInvocationRequest):
+    is_delta = isinstance(request, SessionInvocationRequest)
+    request, session_key, history_offset = await resolve_invocation(request)
+
+    async def events():
+        start_time = time.time()
+        try:
+            async with session_lock(session_key):
+                await check_session(session_key, history_offset, is_delta)
+                async for event in prompt_ai_stream(request, history_offset):
+                    if event["type"] in ("confirmed", "refined"):
+                        await store_session_turn(session_key, request, history_offset,
+                                                 InvocationResponse(**event["response"]))
+                    yield json.dumps(event, ensure_ascii=False) + "\n"
+            print(f"Streamed response in {time.time() - start_time:.2f}s")
+        except SessionConflict as e:
+            yield json.dumps({"type": "error", "detail": str(e), "status": 409}, ensure_ascii=False) + "\n"
+        except ProviderUnavailable as e:
+            print(f"Provider unavailable in invoke stream endpoint: {e}")
+            yield json.dumps({"type": "error", "detail": str(e), "retry_after": math.ceil(e.retry_after)},
+                             ensure_ascii=False) + "\n"
+        except Exception as e:
+            # 响应头已经发出，无法再返回 500，只能以事件形式通知客户端
+            print(f"Error in invoke stream endpoint: {e}")
+            import traceback
+            traceback.print_exc()
+            yield json.dumps({"type": "error", "detail": str(e)}, ensure_ascii=False) + "\n"
+
+    return StreamingResponse(events(), media_type="application/x-ndjson")
 
 @app.get("/")
 async def root():
     return {"message": "AI Murder Mystery API is running", "status": "ok"}
 
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
 @app.get("/health")
-async def health_check():
-    # TODO: Implement a better health check mechanism here
-    return {"status": "ok"}
+async def health_check(response: Response):
+    """
+    Readiness probe. "unavailable" (503) when some stage has no usable backend; "degraded" when the database is
+    unreachable (turns are still served, audit records may be dropped) or some backends are unhealthy.
+    """
+    database = await database_status()
+    providers = {
+        backend.name: {
+            "healthy": backend.healthy,
+            "circuit": provider_gate(backend.service).breaker.state,
+            "error_rate": round(backend.error_rate, 4),
+            "warmup": warmup_status.get(backend.service),
+        }
+        for backend in all_backends()
+    }
+    if not all(any(backend.healthy for backend in stage_backends(stage)) for stage in STAGES):
+        status = "unavailable"
+    elif database["status"] == "error" or not all(provider["healthy"] for provider in providers.values()):
+        status = "degraded"
+    else:
+        status = "ok"
+    response.status_code = 503 if status == "unavailable" else 200
+    return {"status": status, "database": database, "providers": providers, "audit_log": audit_log.enabled}
@@ -0,0 +1,177 @@
+import json
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from settings import MODEL_KEY
+
+# Minimal in-process metrics with Prometheus text exposition (served by /metrics in main.py). Each uvicorn worker
+# keeps its own numbers, like the rest of the per-worker state (clients, caches, audit log).
+
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 3.0, 5.0, 8.0, 13.0, 20.0, 30.0, 60.0)
+
+
+def _format_labels(labelnames: tuple[str, ...], values: tuple, extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for key, value in self._values.items():
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        # label values -> [bucket counts..., sum, count]
+        self._values: dict[tuple, list[float]] = {}
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        data = self._values.get(key)
+        if data is None:
+            data = self._values[key] = [0] * (len(self.buckets) + 2)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                data[i] += 1
+        data[-2] += value
+        data[-1] += 1
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for key, data in self._values.items():
+            for bound, count in zip(self.buckets, data):
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {count}")
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {data[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {data[-2]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {data[-1]}")
+        return lines
+
+
+stage_seconds = Histogram("manososa_stage_seconds", "Duration of each stage of a turn",
+                          ("stage", "attempt", "actor", "model_key"))
+turn_seconds = Histogram("manososa_turn_seconds", "End-to-end duration of a turn", ("actor", "model_key", "source"))
+turns_total = Counter("manososa_turns_total", "Finished turns",
+                      ("actor", "model_key", "source", "refined", "problems_detected"))
+tokens_total = Counter("manososa_tokens_total", "LLM tokens by stage and kind",
+                       ("stage", "kind", "actor", "model_key"))
+llm_errors_total = Counter("manososa_llm_errors_total", "Failed LLM invocations", ("stage", "actor", "model_key"))
+db_write_seconds = Histogram("manososa_db_write_seconds", "Duration of audit log batch writes", ())
+local_truncations_total = Counter("manososa_local_truncations_total",
+                                  "Over-length replies shortened locally instead of refined", ("actor",))
+
+_metrics = [stage_seconds, turn_seconds, turns_total, tokens_total, llm_errors_total, db_write_seconds,
+            local_truncations_total]
+# Callables returning extra (name, type, documentation, [(labels dict, value)]) samples, evaluated on every scrape
+_collectors = []
+
+
+def register_collector(collector):
+    _collectors.append(collector)
+
+
+def render_metrics() -> str:
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    for collector in _collectors:
+        for name, metric_type, documentation, samples in collector():
+            lines.append(f"# HELP {name} {documentation}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for labels, value in samples:
+                lines.append(f"{name}{_format_labels(tuple(labels), tuple(labels.values()))} {value}")
+    return "\n".join(lines) + "\n"
+
+
+class TurnTrace:
+    """Per-turn timing spans, collected through a context variable so nested coroutines and tasks can add to it."""
+
+    def __init__(self, turn_id: int, actor: str):
+        self.turn_id = turn_id
+        self.actor = actor
+        self.started = time.perf_counter()
+        self.spans: list[dict] = []
+        # kind ("input", "output", "cache_read", "cache_write") -> tokens used by the turn's LLM calls
+        self.tokens: dict[str, int] = {}
+
+    def summary(self, **fields) -> str:
+        return json.dumps({
+            "turn_id": self.turn_id,
+            "actor": self.actor,
+            "model_key": MODEL_KEY,
+            "total": round(time.perf_counter() - self.started, 3),
+            "spans": self.spans,
+            "tokens": self.tokens,
+            **fields,
+        }, ensure_ascii=False)
+
+    def finish(self, source: str, refined: bool, problems_detected: bool):
+        """Records the finished turn in manososa_turn_seconds / manososa_turns_total and prints its span summary."""
+        turn_seconds.observe(time.perf_counter() - self.started, actor=self.actor, model_key=MODEL_KEY, source=source)
+        turns_total.inc(actor=self.actor, model_key=MODEL_KEY, source=source, refined=str(refined).lower(),
+                        problems_detected=str(problems_detected).lower())
+        print(f"Turn trace: {self.summary(source=source, refined=refined, problems_detected=problems_detected)}")
+
+
+current_trace: ContextVar[TurnTrace | None] = ContextVar("current_trace", default=None)
+
+
+def current_actor() -> str:
+    trace = current_trace.get()
+    return trace.actor if trace is not None else ""
+
+
+@contextmanager
+def span(stage: str, attempt: int = 0, model_key: str = MODEL_KEY):
+    """
+    Times a block, observing manososa_stage_seconds and appending the span to the current turn's trace. Yields the
+    span's labels, so that an LLM call can set labels["model_key"] once it knows which backend served it.
+    """
+    started = time.perf_counter()
+    labels = {"model_key": model_key}
+    try:
+        yield labels
+    finally:
+        elapsed = time.perf_counter() - started
+        stage_seconds.observe(elapsed, stage=stage, attempt=attempt, actor=current_actor(),
+                              model_key=labels["model_key"])
+        trace = current_trace.get()
+        if trace is not None:
+            trace.spans.append({"stage": stage, "attempt": attempt, "seconds": round(elapsed, 3)})
+
+
+def record_tokens(stage: str, usage: dict, model_key: str = MODEL_KEY):
+    trace = current_trace.get()
+    actor = trace.actor if trace is not None else ""
+    for kind in ("input", "output", "cache_read", "cache_write"):
+        tokens = usage.get(f"{kind}_tokens")
+        if tokens:
+            tokens_total.inc(tokens, stage=stage, kind=kind, actor=actor, model_key=model_key)
+            if trace is not None:
+                trace.tokens[kind] = trace.tokens.get(kind, 0) + tokens
@@ -0,0 +1,128 @@
+import asyncio
+import json
+import logging
+import random
+from pathlib import Path
+
+from invoke_types import LLMMessage
+from verdict import parse_verdict
+from settings import MOCK_TRACE_FILE, MOCK_LATENCY, MOCK_LATENCY_JITTER, MOCK_LATENCY_SCALE, MOCK_INPUT_TOKENS, \
+    MOCK_OUTPUT_TOKENS, MOCK_CRITIQUE_FAIL_RATE, MOCK_SEED
+
+logger = logging.getLogger(__name__)
+
+# 离线压测用的模拟 provider（INFERENCE_SERVICE=mock）：不访问任何外部 API，
+# 按配置（或按从 ai_invocations 导出的记录回放）的延迟和 token 数返回回复。
+
+CANNED_REPLY = "我当时一直待在自己的房间里，什么都没听到。"
+CANNED_PASS = "NONE!"
+CANNED_FAIL = "违反的原则：原则A。发言中提到的时间与角色掌握的事实相矛盾。"
+STREAM_CHUNKS = 8
+
+
+def critique_passes(text: str) -> bool:
+    # Same rule check_whether_to_refine applies
+    return parse_verdict(text).passed
+
+
+class MockProvider:
+    """
+    Stand-in for an LLM provider. Each call sleeps for a latency and returns (text, usage) like the real invoke_*
+    functions.
+
+    Without a trace, latency is MOCK_LATENCY +/- MOCK_LATENCY_JITTER, the usage is MOCK_INPUT_TOKENS /
+    MOCK_OUTPUT_TOKENS and replies are canned. With a trace (JSON lines as written by `bench.py export-trace`), a
+    random recorded invocation of the same prompt_role is replayed: its latency, token counts and response text.
+    Critiques fail with probability MOCK_CRITIQUE_FAIL_RATE when it is set, otherwise at the trace's own rate.
+    """
+
+    def __init__(self, trace_file: str = "", latency: float = 1.0, jitter: float = 0.0, latency_scale: float = 1.0,
+                 input_tokens: int = 0, output_tokens: int = 0, critique_fail_rate: float | None = None,
+                 seed: int | None = None):
+        self.latency = latency
+        self.jitter = jitter
+        self.latency_scale = latency_scale
+        self.input_tokens = input_tokens
+        self.output_tokens = output_tokens
+        self.critique_fail_rate = critique_fail_rate
+        self.random = random.Random(seed)
+        self.calls = 0
+        # prompt_role -> recorded invocations; critiques are further split into "critique:pass" / "critique:fail"
+        self.trace: dict[str, list[dict]] = {}
+        if trace_file:
+            self.load_trace(Path(trace_file))
+
+    def load_trace(self, path: Path):
+        with path.open(encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                role = record["prompt_role"]
+                if role == "critique":
+                    role = "critique:pass" if critique_passes(record.get("response") or "") else "critique:fail"
+                self.trace.setdefault(role, []).append(record)
+        logger.info("Loaded mock trace from %s: %s", path,
+                    ", ".join(f"{role}={len(records)}" for role, records in sorted(self.trace.items())))
+
+    def _pick(self, prompt_role: str) -> dict | None:
+        if prompt_role == "critique":
+            if self.critique_fail_rate is not None:
+                fails = self.random.random() < self.critique_fail_rate
+            else:
+                passed = len(self.trace.get("critique:pass", []))
+                failed = len(self.trace.get("critique:fail", []))
+                fails = passed + failed > 0 and self.random.random() < failed / (passed + failed)
+            records = self.trace.get("critique:fail" if fails else "critique:pass")
+            if not records:
+                return {"response": CANNED_FAIL if fails else CANNED_PASS}
+        else:
+            records = self.trace.get(prompt_role)
+            if not records:
+                return None
+        return self.random.choice(records)
+
+    def _sample(self, prompt_role: str) -> tuple[float, str, dict]:
+        record = self._pick(prompt_role) or {}
+        if record.get("latency") is not None:
+            latency = record["latency"]
+        else:
+            latency = self.latency + self.random.uniform(-self.jitter, self.jitter)
+        text = record.get("response") or CANNED_REPLY
+        usage = {
+            'input_tokens': record.get("input_tokens", self.input_tokens),
+            'output_tokens': record.get("output_tokens", self.output_tokens),
+            'cache_read_tokens': record.get("cache_read_tokens", 0),
+            'cache_write_tokens': record.get("cache_write_tokens", 0),
+        }
+        self.calls += 1
+        return max(0.0, latency * self.latency_scale), text, usage
+
+    async def invoke(self, prompt_role: str, system_prompt: str, messages: list[LLMMessage]):
+        latency, text, usage = self._sample(prompt_role)
+        await asyncio.sleep(latency)
+        return text, usage
+
+    async def stream(self, prompt_role: str, system_prompt: str, messages: list[LLMMessage], usage: dict):
+        latency, text, sampled_usage = self._sample(prompt_role)
+        size = max(1, -(-len(text) // STREAM_CHUNKS))
+        chunks = [text[i:i + size] for i in range(0, len(text), size)]
+        for chunk in chunks:
+            await asyncio.sleep(latency / len(chunks))
+            yield chunk
+        usage.update(sampled_usage)
+
+    async def close(self):
+        pass
+
+
+mock_provider = MockProvider(
+    trace_file=MOCK_TRACE_FILE,
+    latency=MOCK_LATENCY,
+    jitter=MOCK_LATENCY_JITTER,
+    latency_scale=MOCK_LATENCY_SCALE,
+    input_tokens=MOCK_INPUT_TOKENS,
+    output_tokens=MOCK_OUTPUT_TOKENS,
+    critique_fail_rate=float(MOCK_CRITIQUE_FAIL_RATE) if MOCK_CRITIQUE_FAIL_RATE else None,
+    seed=int(MOCK_SEED) if MOCK_SEED else None,
+)
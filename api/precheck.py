@@ -0,0 +1,177 @@
+import re
+from functools import lru_cache
+
+from pydantic import BaseModel
+
+from invoke_types import InvocationRequest
+from settings import PRECHECK_ENABLED, PRECHECK_SAFE_SCORE, PRECHECK_ENTITIES, PROMPT_CACHE_SIZE
+
+# 本地预审：在调用 LLM 审查原则A和角色特定原则之前，先用规则给回复打分。
+# 回复中每一个"事实性"的片段（时间、地点、数字、提到的人物）、与违规原则或秘密重合的内容都会加分，
+# 提到秘密或原则中出现的人物按违规计分；
+# 分数不超过阈值（默认 0，即回复中没有任何事实性内容）时直接视为通过，省去一次 LLM 审查，
+# 否则交给 LLM 审查。本地规则只用来放行明显安全的回复，从不据此判定违规。
+
+KNOWN_FACT_WEIGHT = 0.5  # 角色文本中出现过的时间/地点/数字
+UNKNOWN_TIME_WEIGHT = 2.0  # 角色文本中没有的时间，可能与时间线矛盾
+UNKNOWN_FACT_WEIGHT = 1.5  # 角色文本中没有的地点/数字
+PRINCIPLE_WEIGHT = 3.0  # 与某条违规原则的内容重合
+SECRET_WEIGHT = 3.0  # 与秘密的内容重合
+ENTITY_WEIGHT = 1.5  # 提到其他人物（关于他人的陈述都是事实性内容）
+
+CJK_RUN = re.compile(r'[\u4e00-\u9fff]+')
+PRINCIPLE_SPLIT = re.compile(r'原则\s*[0-9A-Za-z一二三四五六七八九十]+\s*[：:]')
+TIME_PATTERN = re.compile(r'(\d{1,2})\s*(?:[:：]\s*\d{2}|点)')
+DAYPART_PATTERN = re.compile(r'上午|中午|下午|早上|晚上|傍晚|凌晨|午饭|晚饭|早饭')
+PLACE_PATTERN = re.compile(r'[\u4e00-\u9fff][室厅房堂田楼间场馆园库台廊所]')
+NUMBER_PATTERN = re.compile(r'\d+')
+
+# 原则和秘密里常见、但不代表具体内容的二元组
+STOP_BIGRAMS = frozenset([
+    "透露", "说明", "提及", "主动", "任何", "相关", "信息", "情报", "需要", "不需", "不要", "不可", "可以", "如果",
+    "但是", "隐瞒", "被问", "问起", "自己", "我们", "他们", "她们", "这个", "那个", "什么", "因为", "所以", "没有",
+    "不能", "必须", "知道", "事情", "时候", "时间", "的是", "是给", "了一", "一个", "提到", "承认", "否认", "告诉",
+])
+
+
+class PrecheckResult(BaseModel):
+    score: float
+    safe: bool
+    reasons: list[str]
+
+
+# 本地预审的统计，跨请求累计
+precheck_stats = {"checked": 0, "skipped_llm": 0, "escalated": 0}
+
+
+# 人物的称呼（全名和名字）-> 全名，由 register_entities 在加载角色文件时填充
+_entities: dict[str, str] = {}
+_entity_pattern: re.Pattern | None = None
+
+
+def register_entities(names):
+    """
+    Registers people the pre-check recognizes in replies, secrets and principles, by full name and by given name
+    (the full name without the surname, e.g. 玛格 for 宝生玛格).
+    """
+    global _entity_pattern
+    for name in names:
+        _entities[name] = name
+        if len(name) >= 3:
+            _entities.setdefault(name[-2:], name)
+    # Longest first, so a full name is not matched as its given name
+    _entity_pattern = re.compile("|".join(map(re.escape, sorted(_entities, key=len, reverse=True))))
+    _mentioned_entities.cache_clear()
+
+
+@lru_cache(maxsize=PROMPT_CACHE_SIZE)
+def _mentioned_entities(text: str) -> frozenset[str]:
+    if _entity_pattern is None or not text:
+        return frozenset()
+    return frozenset(_entities[match.group(0)] for match in _entity_pattern.finditer(text))
+
+
+register_entities(PRECHECK_ENTITIES)
+
+
+def _bigrams(text: str) -> set[str]:
+    bigrams = set()
+    for run in CJK_RUN.findall(text):
+        for i in range(len(run) - 1):
+            bigram = run[i:i + 2]
+            if bigram not in STOP_BIGRAMS:
+                bigrams.add(bigram)
+    return bigrams
+
+
+@lru_cache(maxsize=PROMPT_CACHE_SIZE)
+def _principle_bigrams(violation: str) -> tuple[frozenset[str], ...]:
+    parts = [part.strip(" \n。；;") for part in PRINCIPLE_SPLIT.split(violation or "")]
+    return tuple(frozenset(_bigrams(part)) for part in parts if part)
+
+
+@lru_cache(maxsize=PROMPT_CACHE_SIZE)
+def _known_facts(context: str) -> tuple[frozenset[str], frozenset[str], frozenset[str], frozenset[str]]:
+    hours = frozenset(str(int(hour)) for hour in TIME_PATTERN.findall(context))
+    dayparts = frozenset(DAYPART_PATTERN.findall(context))
+    places = frozenset(PLACE_PATTERN.findall(context))
+    numbers = frozenset(str(int(number)) for number in NUMBER_PATTERN.findall(context))
+    return hours, dayparts, places, numbers
+
+
+def score_reply(request: InvocationRequest, reply: str) -> PrecheckResult:
+    actor = request.actor
+    threshold = actor.precheck_threshold if actor.precheck_threshold is not None else PRECHECK_SAFE_SCORE
+    # 角色文本 + 故事背景中出现过的事实视为"已知"
+    hours, dayparts, places, numbers = _known_facts(f"{actor.context1}\n{request.global_story}")
+
+    score = 0.0
+    reasons = []
+
+    reply_hours = [str(int(hour)) for hour in TIME_PATTERN.findall(reply)]
+    for hour in reply_hours:
+        if hour in hours:
+            score += KNOWN_FACT_WEIGHT
+        else:
+            score += UNKNOWN_TIME_WEIGHT
+            reasons.append(f"time {hour} not in character text")
+    for daypart in DAYPART_PATTERN.findall(reply):
+        score += KNOWN_FACT_WEIGHT if daypart in dayparts else UNKNOWN_TIME_WEIGHT
+    for place in PLACE_PATTERN.findall(reply):
+        if place in places:
+            score += KNOWN_FACT_WEIGHT
+        else:
+            score += UNKNOWN_FACT_WEIGHT
+            reasons.append(f"place {place} not in character text")
+    # 时间中的数字已经计过分
+    for number in NUMBER_PATTERN.findall(reply):
+        number = str(int(number))
+        if number in reply_hours:
+            continue
+        score += KNOWN_FACT_WEIGHT if number in numbers else UNKNOWN_FACT_WEIGHT
+
+    # 秘密和原则中点名的人物：回复提到就按违规计分（例如"不要提及画作和安安的联系"），其他人物按事实计分
+    secret_entities = _mentioned_entities(actor.secret)
+    principle_entities = _mentioned_entities(actor.violation)
+    for entity in sorted(_mentioned_entities(reply) - {actor.name}):
+        if entity in secret_entities:
+            score += SECRET_WEIGHT
+            reasons.append(f"mentions {entity} named in secret")
+        elif entity in principle_entities:
+            score += PRINCIPLE_WEIGHT
+            reasons.append(f"mentions {entity} named in principles")
+        else:
+            score += ENTITY_WEIGHT
+            reasons.append(f"mentions {entity}")
+
+    reply_bigrams = _bigrams(reply)
+    for i, principle in enumerate(_principle_bigrams(actor.violation)):
+        overlap = principle & reply_bigrams
+        if len(overlap) >= 2 or (overlap and len(principle) <= 2):
+            score += PRINCIPLE_WEIGHT
+            reasons.append(f"overlaps principle {i + 1}: {'、'.join(sorted(overlap))}")
+    secret_overlap = _bigrams(actor.secret) & reply_bigrams
+    if len(secret_overlap) >= 3:
+        score += SECRET_WEIGHT
+        reasons.append(f"overlaps secret: {'、'.join(sorted(secret_overlap))}")
+
+    return PrecheckResult(score=score, safe=score <= threshold, reasons=reasons)
+
+
+def precheck_reply(request: InvocationRequest, reply: str) -> PrecheckResult | None:
+    """
+    Returns the local pre-check result, or None when the pre-check is disabled globally or for this actor
+    (a negative precheck_threshold disables it per actor).
+    """
+    if not PRECHECK_ENABLED:
+        return None
+    if request.actor.precheck_threshold is not None and request.actor.precheck_threshold < 0:
+        return None
+
+    result = score_reply(request, reply)
+    precheck_stats["checked"] += 1
+    if result.safe:
+        precheck_stats["skipped_llm"] += 1
+    else:
+        precheck_stats["escalated"] += 1
+    return result
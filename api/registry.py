@@ -0,0 +1,170 @@
+import json
+import logging
+from itertools import combinations
+from pathlib import Path
+
+from pydantic import BaseModel
+
+from ai import get_system_prompt, get_critique_prefix, get_refiner_prefix
+from precheck import register_entities
+from invoke_types import Actor, InvocationRequest, RegisteredInvocationRequest, SessionInvocationRequest
+from settings import CHARACTER_FILES, CONTEXT_MAPPING_FILE
+
+logger = logging.getLogger(__name__)
+
+
+class CharacterFile(BaseModel):
+    file_key: str
+    global_story: str
+    # Raw character entries as they appear in the file (also carries context2..lastcontext, image, ...)
+    characters: list[dict]
+    # actor name -> context_key(unlocked contexts) -> context1 with those contexts appended, built at load time
+    contexts: dict[str, dict[str, str]] = {}
+
+
+# Keyed by fileKey and, as a fallback when two files share a fileKey, by the file name without extension
+_files: dict[str, CharacterFile] = {}
+# actor name -> evidence id -> context unlocked by presenting that evidence (context2Mapping.json)
+_evidence_contexts: dict[str, dict[str, str]] = {}
+
+# 出示证物后追加到 context1 的额外设定。无论解锁的先后顺序，总是按这个顺序追加，
+# 这样每种解锁组合只对应一个固定的 context1，系统提示可以预先构建并被 provider 前缀缓存命中。
+# lastcontext 只有在 context2 / context3 / context4 都已解锁（或为空）时才生效，与前端的规则一致。
+CONTEXT_ORDER = ("context2", "context3", "context4", "lastcontext")
+
+
+def context_key(contexts) -> str:
+    return "+".join(name for name in CONTEXT_ORDER if name in contexts)
+
+
+def _context_text(entry: dict, name: str) -> str:
+    return (entry.get(name) or "").strip()
+
+
+def _context_variants(entry: dict) -> dict[str, str]:
+    """Every reachable combination of unlocked contexts of an actor, keyed by context_key, as the full context1."""
+    base = entry.get("context1") or ""
+    optional = [name for name in CONTEXT_ORDER[:-1] if _context_text(entry, name)]
+    combos = [combo for size in range(len(optional) + 1) for combo in combinations(optional, size)]
+    if _context_text(entry, "lastcontext"):
+        combos.append(tuple(optional) + ("lastcontext",))
+    variants = {}
+    for combo in combos:
+        context1 = base
+        for name in combo:
+            context1 = (context1 + "\n\n" if context1.strip() else context1) + _context_text(entry, name)
+        variants[context_key(combo)] = context1
+    return variants
+
+
+def unlocked_contexts(entry: dict, evidence_ids: list[str]) -> str:
+    """context_key of the contexts an actor has unlocked, given the evidence presented to them."""
+    mapping = _evidence_contexts.get(entry["name"], {})
+    unlocked = {mapping.get(evidence_id) for evidence_id in evidence_ids}
+    unlocked = {name for name in CONTEXT_ORDER if name in unlocked and _context_text(entry, name)}
+    if "lastcontext" in unlocked and any(_context_text(entry, name) and name not in unlocked
+                                         for name in CONTEXT_ORDER[:-1]):
+        unlocked.discard("lastcontext")
+    return context_key(unlocked)
+
+
+def load_context_mapping(path: Path | None = CONTEXT_MAPPING_FILE):
+    if path is None:
+        logger.info("CONTEXT_MAPPING_FILE is empty, evidence_ids will not unlock contexts")
+        return
+    data = json.loads(path.read_text(encoding="utf-8"))
+    _evidence_contexts.clear()
+    for actor_name, evidence in data.items():
+        # Entries that unlock nothing are false
+        _evidence_contexts[actor_name] = {evidence_id: name for evidence_id, name in evidence.items()
+                                          if name in CONTEXT_ORDER}
+
+
+def _actor_from_entry(entry: dict, messages=None, extra_context: str | None = None,
+                      context1: str | None = None) -> Actor:
+    """context1, when given, replaces the entry's own (one of the precomputed context variants)."""
+    if context1 is None:
+        context1 = entry.get("context1") or ""
+    if extra_context:
+        context1 = f"{context1}\n\n{extra_context}" if context1 else extra_context
+    # 文件内容在加载时已经解析过，这里跳过 pydantic 校验
+    return Actor.model_construct(
+        name=entry["name"],
+        bio=entry.get("bio") or "",
+        personality=entry.get("personality") or "",
+        context1=context1,
+        secret=entry.get("secret") or "",
+        violation=entry.get("violation") or "",
+        hurt=entry.get("hurt"),
+        precheck_threshold=entry.get("precheck_threshold"),
+        messages=messages or [],
+    )
+
+
+def _warm_prompts(character_file: CharacterFile):
+    # 预先构建每个角色在每种证物解锁组合下的系统提示、审查提示和修改提示的静态前缀，热路径上只剩缓存命中
+    for entry in character_file.characters:
+        for context1 in character_file.contexts[entry["name"]].values():
+            request = InvocationRequest(global_story=character_file.global_story,
+                                        actor=_actor_from_entry(entry, context1=context1),
+                                        session_id="", character_file_version=character_file.file_key)
+            get_system_prompt(request)
+            get_critique_prefix(request)
+            get_refiner_prefix(request)
+
+
+def load_character_files(paths: list[Path] = CHARACTER_FILES):
+    load_context_mapping()
+    for path in paths:
+        data = json.loads(path.read_text(encoding="utf-8"))
+        character_file = CharacterFile(file_key=data["fileKey"], global_story=data["globalStory"],
+                                       characters=data["characters"],
+                                       contexts={entry["name"]: _context_variants(entry)
+                                                 for entry in data["characters"]})
+        registered = _files.get(character_file.file_key)
+        if registered is not None and registered is not _files.get(path.stem):
+            # Clients select the file by fileKey, so a second file with the same key could never be reached
+            raise ValueError(f"Character file {path} reuses fileKey {character_file.file_key}")
+        _files[character_file.file_key] = character_file
+        _files[path.stem] = character_file
+        register_entities(entry["name"] for entry in character_file.characters)
+        _warm_prompts(character_file)
+        logger.info("Loaded %d characters (%d context variants) from %s (%s)", len(character_file.characters),
+                    sum(len(variants) for variants in character_file.contexts.values()), path,
+                    character_file.file_key)
+
+
+def get_character_file(character_file_version: str) -> CharacterFile:
+    character_file = _files.get(character_file_version)
+    if character_file is None:
+        raise KeyError(f"Unknown character file: {character_file_version}")
+    return character_file
+
+
+def get_character_entry(character_file: CharacterFile, actor_id: int | str) -> dict:
+    if isinstance(actor_id, int):
+        if 0 <= actor_id < len(character_file.characters):
+            return character_file.characters[actor_id]
+    else:
+        for entry in character_file.characters:
+            if entry["name"] == actor_id:
+                return entry
+    raise KeyError(f"Unknown actor {actor_id} in character file {character_file.file_key}")
+
+
+def resolve_request(request: RegisteredInvocationRequest | SessionInvocationRequest) -> InvocationRequest:
+    """
+    Expands a RegisteredInvocationRequest into the full InvocationRequest the pipeline works on. For a
+    SessionInvocationRequest the messages are just the new message; the caller prepends the stored history.
+    Raises KeyError when the character file or the actor is unknown.
+    """
+    character_file = get_character_file(request.character_file_version)
+    entry = get_character_entry(character_file, request.actor_id)
+    messages = request.messages if isinstance(request, RegisteredInvocationRequest) else [request.message]
+    context1 = character_file.contexts[entry["name"]][unlocked_contexts(entry, request.evidence_ids)]
+    return InvocationRequest.model_construct(
+        global_story=character_file.global_story,
+        actor=_actor_from_entry(entry, messages, request.extra_context, context1),
+        session_id=request.session_id,
+        character_file_version=request.character_file_version,
+    )
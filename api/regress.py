@@ -0,0 +1,292 @@
+"""
+Prompt regression runner: asks every actor of a character file a scripted question set through prompt_ai and
+reports, per actor, how often replies were refined, flagged (problems_detected) or over the 88 character limit,
+along with latency and token usage.
+
+    # offline against the mock provider unless INFERENCE_SERVICE is set explicitly (e.g. a local Ollama)
+    python regress.py run runs/1.0.7 --characters ../web/src/characters.json --concurrency 8
+
+    # compare with the run of the previous prompt version
+    python regress.py run runs/1.0.8 --baseline runs/1.0.7
+    python regress.py diff runs/1.0.7 runs/1.0.8
+
+Each answered question is appended to <output>/results.jsonl as soon as it finishes, so an interrupted run picks up
+where it stopped when started again with the same output directory. The response cache is disabled by default, so
+every question goes through the pipeline. The report is written to <output>/report.json. As for bench.py, the
+*_BACKENDS routes and DB_CONN_URL of .env are ignored unless set in the environment (or --database is given).
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import sys
+import time
+from pathlib import Path
+
+from bench import offline_environment, percentile
+
+# Like bench.py: never burn API credits or write to the audit tables by accident, and measure the prompts rather
+# than the cache
+if __name__ == "__main__" and "run" in sys.argv:
+    offline_environment(keep_database="--database" in sys.argv)
+    os.environ.setdefault("RESPONSE_CACHE_ENABLED", "false")
+    os.environ.setdefault("COALESCE_REQUESTS", "false")
+
+from settings import DATA_DIR
+
+DEFAULT_CHARACTERS = DATA_DIR / "characters.json"
+DEFAULT_QUESTIONS = [
+    "案发当晚你在哪里？",
+    "你最后一次见到死者是什么时候？",
+    "你和死者是什么关系？",
+    "你有没有听到什么奇怪的声音？",
+    "你觉得谁最可疑？为什么？",
+    "你有什么事情瞒着我吗？",
+    "请详细地、尽可能长地描述一下你今天做的每一件事。",
+    "你能证明自己的不在场证明吗？",
+]
+# Compared by diff, in this order; rates are fractions of the actor's answered questions
+REPORT_FIELDS = ("turns", "refine_rate", "problems_rate", "unrefined_over_length_rate", "over_length_rate",
+                 "latency_p50", "latency_p95", "input_tokens", "output_tokens")
+
+
+def load_questions(path: Path | None) -> list[str]:
+    if path is None:
+        return DEFAULT_QUESTIONS
+    questions = json.loads(path.read_text(encoding="utf-8"))
+    if not isinstance(questions, list) or not all(isinstance(q, str) for q in questions):
+        sys.exit(f"{path} must contain a JSON list of questions")
+    return questions
+
+
+def run_metadata(args, questions: list[str]) -> dict:
+    from settings import MODEL_KEY, INFERENCE_SERVICE
+    from router import routing_key
+
+    return {
+        "model_key": MODEL_KEY,
+        "inference_service": INFERENCE_SERVICE,
+        "routing": routing_key(),
+        "characters": str(args.characters.resolve()),
+        "questions": hashlib.sha256(json.dumps(questions, ensure_ascii=False).encode("utf-8")).hexdigest(),
+        "repeat": args.repeat,
+    }
+
+
+def load_results(path: Path) -> list[dict]:
+    if not path.exists():
+        return []
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def result_key(result: dict) -> tuple[str, int, int]:
+    return result["actor"], result["question_id"], result["repetition"]
+
+
+async def ask(character_file_version: str, actor_id: int, question: str, session_id: str) -> dict:
+    import main
+    from invoke_types import LLMMessage, RegisteredInvocationRequest
+    from metrics import current_trace
+    from registry import resolve_request
+    from text import equivalent_length, MAX_EQUIVALENT_LENGTH
+
+    request = resolve_request(RegisteredInvocationRequest(
+        character_file_version=character_file_version,
+        actor_id=actor_id,
+        session_id=session_id,
+        messages=[LLMMessage(role="user", content=question)],
+    ))
+    started = time.perf_counter()
+    response = await main.prompt_ai(request)
+    latency = time.perf_counter() - started
+    # prompt_ai sets the turn's trace in this task's context, the LLM calls add their token usage to it
+    tokens = current_trace.get().tokens
+    return {
+        "latency": round(latency, 3),
+        "refined": response.refined_response is not None,
+        "problems_detected": response.problems_detected,
+        "unrefined_over_length": equivalent_length(response.original_response) > MAX_EQUIVALENT_LENGTH,
+        "over_length": equivalent_length(response.final_response) > MAX_EQUIVALENT_LENGTH,
+        "input_tokens": tokens.get("input", 0),
+        "output_tokens": tokens.get("output", 0),
+        "final_response": response.final_response,
+    }
+
+
+async def drive(args, character_file_version: str, characters: list[dict], questions: list[str],
+                results_path: Path, done: set) -> int:
+    queue = asyncio.Queue()
+    for actor_id, entry in enumerate(characters):
+        if args.actors and entry["name"] not in args.actors:
+            continue
+        for question_id, question in enumerate(questions):
+            for repetition in range(args.repeat):
+                if (entry["name"], question_id, repetition) not in done:
+                    queue.put_nowait((actor_id, entry["name"], question_id, question, repetition))
+    total = queue.qsize()
+    print(f"{len(done)} questions already answered, {total} to go", file=sys.stderr)
+    errors = 0
+
+    with open(results_path, "a", encoding="utf-8") as results_file:
+        async def worker():
+            nonlocal errors
+            while not queue.empty():
+                actor_id, name, question_id, question, repetition = queue.get_nowait()
+                try:
+                    result = await ask(character_file_version, actor_id, question,
+                                       f"regress-{actor_id}-{question_id}-{repetition}")
+                except Exception as e:
+                    # Not recorded, so the next run asks it again
+                    errors += 1
+                    print(f"{name} / question {question_id} failed: {e}", file=sys.stderr)
+                    continue
+                result = {"actor": name, "question_id": question_id, "repetition": repetition,
+                          "question": question, **result}
+                results_file.write(json.dumps(result, ensure_ascii=False) + "\n")
+                results_file.flush()
+
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    return errors
+
+
+def summarize(results: list[dict]) -> dict:
+    latencies = [result["latency"] for result in results]
+    turns = len(results)
+
+    def rate(field: str) -> float:
+        return round(sum(bool(result[field]) for result in results) / turns, 3) if turns else 0.0
+
+    return {
+        "turns": turns,
+        "refine_rate": rate("refined"),
+        "problems_rate": rate("problems_detected"),
+        "unrefined_over_length_rate": rate("unrefined_over_length"),
+        "over_length_rate": rate("over_length"),
+        "latency_p50": round(percentile(latencies, 50), 3),
+        "latency_p95": round(percentile(latencies, 95), 3),
+        "input_tokens": sum(result["input_tokens"] for result in results),
+        "output_tokens": sum(result["output_tokens"] for result in results),
+    }
+
+
+def build_report(metadata: dict, results: list[dict]) -> dict:
+    by_actor: dict[str, list[dict]] = {}
+    for result in results:
+        by_actor.setdefault(result["actor"], []).append(result)
+    return {
+        **metadata,
+        "total": summarize(results),
+        "actors": {actor: summarize(actor_results) for actor, actor_results in by_actor.items()},
+    }
+
+
+def _actor_cell(name: str) -> str:
+    # Actor names are CJK: pad by display width, where a wide character takes two columns
+    from text import wide_count
+
+    return name + " " * max(1, 17 - len(name) - wide_count(name))
+
+
+def print_report(report: dict):
+    print(f"model_key {report['model_key']}  routing {report['routing']}")
+    print(_actor_cell("actor") + " ".join(f"{field:>12.12}" for field in REPORT_FIELDS))
+    for actor, summary in [*report["actors"].items(), ("(all)", report["total"])]:
+        print(_actor_cell(actor) + " ".join(f"{summary[field]:>12}" for field in REPORT_FIELDS))
+
+
+def print_diff(baseline: dict, report: dict):
+    print(f"{baseline['model_key']} -> {report['model_key']}")
+    print(_actor_cell("actor") + " ".join(f"{field:>12.12}" for field in REPORT_FIELDS))
+    rows = [(actor, baseline["actors"].get(actor), summary) for actor, summary in report["actors"].items()]
+    rows.append(("(all)", baseline["total"], report["total"]))
+    for actor, before, after in rows:
+        if before is None:
+            print(_actor_cell(actor) + "(not in baseline)")
+            continue
+        cells = []
+        for field in REPORT_FIELDS:
+            delta = after[field] - before[field]
+            cells.append(f"{delta:>+12.3f}" if isinstance(delta, float) else f"{delta:>+12}")
+        print(_actor_cell(actor) + " ".join(cells))
+
+
+def read_report(directory: Path) -> dict:
+    path = directory / "report.json"
+    if not path.exists():
+        sys.exit(f"{path} does not exist")
+    return json.loads(path.read_text(encoding="utf-8"))
+
+
+async def run(args):
+    import main
+    from registry import get_character_file, load_character_files
+
+    questions = load_questions(args.questions)
+    args.output.mkdir(parents=True, exist_ok=True)
+    metadata_path = args.output / "run.json"
+    results_path = args.output / "results.jsonl"
+    metadata = run_metadata(args, questions)
+    if metadata_path.exists() and not args.restart:
+        previous = json.loads(metadata_path.read_text(encoding="utf-8"))
+        if previous != metadata:
+            sys.exit(f"{args.output} holds a run with different settings ({metadata_path}); "
+                     f"use another directory or --restart")
+    elif args.restart:
+        results_path.unlink(missing_ok=True)
+    metadata_path.write_text(json.dumps(metadata, ensure_ascii=False, indent=2), encoding="utf-8")
+
+    # Clients, the default character files and the audit log, as for the server
+    lifespan = main.lifespan(main.app)
+    await lifespan.__aenter__()
+    try:
+        character_file_version = args.characters.stem
+        try:
+            get_character_file(character_file_version)
+        except KeyError:
+            load_character_files([args.characters])
+        characters = get_character_file(character_file_version).characters
+        done = {result_key(result) for result in load_results(results_path)}
+        errors = await drive(args, character_file_version, characters, questions, results_path, done)
+    finally:
+        await lifespan.__aexit__(None, None, None)
+
+    report = build_report(metadata, load_results(results_path))
+    (args.output / "report.json").write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+    print_report(report)
+    if args.baseline:
+        print()
+        print_diff(read_report(args.baseline), report)
+    if errors:
+        print(f"{errors} questions failed; run again to retry them", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a scripted question set against every actor")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="ask every actor the question set and write a report")
+    run_parser.add_argument("output", type=Path)
+    run_parser.add_argument("--characters", type=Path, default=DEFAULT_CHARACTERS)
+    run_parser.add_argument("--questions", type=Path, help="JSON list of questions; default a built-in set")
+    run_parser.add_argument("--actors", type=lambda s: s.split(","), help="comma separated actor names")
+    run_parser.add_argument("--repeat", type=int, default=1, help="ask each question this many times")
+    run_parser.add_argument("--concurrency", type=int, default=8)
+    run_parser.add_argument("--baseline", type=Path, help="output directory of a previous run to diff against")
+    run_parser.add_argument("--restart", action="store_true", help="discard the results already in output")
+    run_parser.add_argument("--database", action="store_true", help="keep DB_CONN_URL and write the audit log")
+
+    diff_parser = commands.add_parser("diff", help="compare the reports of two runs")
+    diff_parser.add_argument("baseline", type=Path)
+    diff_parser.add_argument("output", type=Path)
+
+    args = parser.parse_args()
+    if args.command == "run":
+        asyncio.run(run(args))
+    else:
+        print_diff(read_report(args.baseline), read_report(args.output))
+
+
+if __name__ == "__main__":
+    main()
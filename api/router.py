@@ -0,0 +1,169 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+from admission import provider_gate, ProviderUnavailable
+from settings import STAGES, STAGE_BACKENDS, INFERENCE_SERVICE, MODEL, MAX_TOKENS, PROMPTS_VERSION, ROUTER_WINDOW, \
+    ROUTER_MAX_ERROR_RATE, ROUTER_SLOW_LATENCY, ROUTER_HEDGE_AFTER
+
+logger = logging.getLogger(__name__)
+
+# 按阶段（initial / critique / refine / summarize）选择 provider 和模型：每个阶段配置一组按优先级排列的后端，
+# 根据最近的错误率和延迟把不健康的后端排到最后，失败时切换到下一个，可选地在调用过慢时对冲到下一个后端。
+
+MIN_SAMPLES = 5  # calls before a backend's error rate / latency is trusted
+
+
+class Backend:
+    """One (service, model) pair with rolling statistics of its recent calls."""
+
+    def __init__(self, service: str, model: str):
+        self.service = service
+        self.model = model
+        self.model_key = f"{model}:{MAX_TOKENS}:{PROMPTS_VERSION}"
+        self._calls: deque[tuple[bool, float]] = deque(maxlen=ROUTER_WINDOW)
+        self.hedges = 0
+        self.failovers = 0
+
+    @property
+    def name(self) -> str:
+        return f"{self.service}:{self.model}"
+
+    def record(self, ok: bool, latency: float):
+        self._calls.append((ok, latency))
+
+    @property
+    def error_rate(self) -> float:
+        if not self._calls:
+            return 0.0
+        return sum(1 for ok, _ in self._calls if not ok) / len(self._calls)
+
+    @property
+    def mean_latency(self) -> float:
+        latencies = [latency for ok, latency in self._calls if ok]
+        return sum(latencies) / len(latencies) if latencies else 0.0
+
+    @property
+    def healthy(self) -> bool:
+        if provider_gate(self.service).breaker.state == "open":
+            return False
+        return len(self._calls) < MIN_SAMPLES or self.error_rate < ROUTER_MAX_ERROR_RATE
+
+    @property
+    def slow(self) -> bool:
+        return bool(ROUTER_SLOW_LATENCY) and len(self._calls) >= MIN_SAMPLES \
+            and self.mean_latency > ROUTER_SLOW_LATENCY
+
+
+# Backends are shared between stages that use the same (service, model), so their statistics are too
+_backends: dict[tuple[str, str], Backend] = {}
+
+
+def _backend(service: str, model: str) -> Backend:
+    backend = _backends.get((service, model))
+    if backend is None:
+        backend = _backends[(service, model)] = Backend(service, model)
+    return backend
+
+
+_stages: dict[str, list[Backend]] = {
+    stage: [_backend(service, model) for service, model in STAGE_BACKENDS[stage]] for stage in STAGES
+}
+
+
+def default_backend() -> Backend:
+    return _backend(INFERENCE_SERVICE, MODEL)
+
+
+def stage_backends(stage: str) -> list[Backend]:
+    """Configured backends of a stage, healthy and fast ones first, otherwise in configured order."""
+    backends = _stages.get(stage) or [default_backend()]
+    if len(backends) == 1:
+        return backends
+    return sorted(backends, key=lambda backend: (not backend.healthy, backend.slow))
+
+
+def all_backends() -> list[Backend]:
+    return list(_backends.values())
+
+
+def routing_key() -> str:
+    """Identifies the stage -> backends configuration, so cached responses of another configuration are not reused."""
+    return ";".join(f"{stage}={','.join(b.name for b in _stages[stage])}" for stage in STAGES)
+
+
+async def _timed(backend: Backend, call):
+    started = time.perf_counter()
+    try:
+        result = await call(backend)
+    except asyncio.CancelledError:
+        raise
+    except ProviderUnavailable:
+        # Rejected locally (circuit open / queue full): not a sample of the backend's behaviour
+        raise
+    except Exception:
+        backend.record(False, time.perf_counter() - started)
+        raise
+    backend.record(True, time.perf_counter() - started)
+    return result
+
+
+async def route(stage: str, call):
+    """
+    Runs call(backend) on the stage's backends and returns (backend, result) of the first that succeeds.
+
+    A failed backend fails over to the next one. With ROUTER_HEDGE_AFTER set, a call that has not finished after
+    that many seconds is raced against the next backend; the first result wins and the other call is cancelled.
+    """
+    backends = stage_backends(stage)
+    pending: dict[asyncio.Task, Backend] = {}
+    next_index = 0
+    last_error = None
+
+    def launch():
+        nonlocal next_index
+        backend = backends[next_index]
+        next_index += 1
+        pending[asyncio.create_task(_timed(backend, call))] = backend
+
+    launch()
+    try:
+        while pending:
+            can_hedge = ROUTER_HEDGE_AFTER > 0 and next_index < len(backends)
+            done, _ = await asyncio.wait(pending, timeout=ROUTER_HEDGE_AFTER if can_hedge else None,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                backends[next_index - 1].hedges += 1
+                logger.info("%s call on %s is slow, hedging on %s", stage, backends[next_index - 1].name,
+                            backends[next_index].name)
+                launch()
+                continue
+            for task in done:
+                backend = pending.pop(task)
+                try:
+                    return backend, task.result()
+                except Exception as e:
+                    last_error = e
+                    logger.warning("%s call on %s failed: %s", stage, backend.name, e)
+            if not pending and next_index < len(backends):
+                backends[next_index - 1].failovers += 1
+                launch()
+        raise last_error
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+def router_samples():
+    """Samples for metrics.register_collector."""
+    return [
+        ("manososa_backend_error_rate", "gauge", "Error rate over the backend's recent calls",
+         [({"backend": b.name}, round(b.error_rate, 4)) for b in all_backends()]),
+        ("manososa_backend_mean_latency_seconds", "gauge", "Mean latency of the backend's recent successful calls",
+         [({"backend": b.name}, round(b.mean_latency, 4)) for b in all_backends()]),
+        ("manososa_backend_hedges_total", "counter", "Calls hedged on the next backend because this one was slow",
+         [({"backend": b.name}, b.hedges) for b in all_backends()]),
+        ("manososa_backend_failovers_total", "counter", "Calls that failed over from this backend to the next one",
+         [({"backend": b.name}, b.failovers) for b in all_backends()]),
+    ]
@@ -52,3 +52,35 @@ CREATE TABLE IF NOT EXISTS "public".ai_invocations (
     created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
 );
 
+
+-- Content hash of the request (see cache.py), used by the response cache to find previous answers
+ALTER TABLE "public".conversation_turns ADD COLUMN IF NOT EXISTS request_hash TEXT;
+CREATE INDEX IF NOT EXISTS conversation_turns_request_hash_idx ON "public".conversation_turns (request_hash, model_key);
+
+-- Provider prompt caching: tokens read from / written to the provider's prompt cache (NULL when not reported)
+ALTER TABLE "public".ai_invocations ADD COLUMN IF NOT EXISTS cache_read_tokens INTEGER;
+ALTER TABLE "public".ai_invocations ADD COLUMN IF NOT EXISTS cache_write_tokens INTEGER;
+-- Parsed critique verdict ("pass" / "violation"), NULL for other prompt roles
+ALTER TABLE "public".ai_invocations ADD COLUMN IF NOT EXISTS verdict VARCHAR;
+
+-- Server-side session histories (see sessions.py), one row per message, written as per-turn deltas
+CREATE TABLE IF NOT EXISTS "public".session_messages (
+    session_id TEXT NOT NULL,
+    actor_name TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (session_id, actor_name, seq)
+);
+
+-- Number of earlier messages not repeated in chat_messages: session turns only store the messages they added
+ALTER TABLE "public".conversation_turns ADD COLUMN IF NOT EXISTS history_offset INTEGER NOT NULL DEFAULT 0;
+
+-- Indexes for analytics queries and the incremental export (see export.py), which reads in (created_at, id) order
+CREATE INDEX IF NOT EXISTS conversation_turns_session_id_idx ON "public".conversation_turns (session_id);
+CREATE INDEX IF NOT EXISTS conversation_turns_created_at_idx ON "public".conversation_turns (created_at, id);
+CREATE INDEX IF NOT EXISTS conversation_turns_model_key_idx ON "public".conversation_turns (model_key);
+CREATE INDEX IF NOT EXISTS ai_invocations_conversation_turn_id_idx ON "public".ai_invocations (conversation_turn_id);
+CREATE INDEX IF NOT EXISTS ai_invocations_created_at_idx ON "public".ai_invocations (created_at, id);
+CREATE INDEX IF NOT EXISTS ai_invocations_model_key_idx ON "public".ai_invocations (model_key);
@@ -0,0 +1,144 @@
+import asyncio
+import hashlib
+import json
+import logging
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+from db import pool
+from invoke_types import LLMMessage
+from settings import SESSION_STORE, SESSION_CACHE_SIZE, SESSION_TTL, SESSION_DIR
+
+logger = logging.getLogger(__name__)
+
+# 服务端保存的会话历史：按 (session_id, 角色名) 保存每个角色的完整对话，客户端每轮只需发送新的一条消息。
+# 内存中是带 TTL 的 LRU；可选地以 Postgres 或本地磁盘为后备存储，后备存储只追加每轮新增的消息。
+
+
+class SessionStore:
+    """
+    Conversation histories keyed by (session_id, actor_name).
+
+    The in-process LRU is the fast path. With a backing store ("postgres" or "disk") every change is persisted as
+    a delta (only the appended messages) and histories missing from or stale in memory, e.g. because another worker
+    served the previous turn, are reloaded from it.
+    """
+
+    def __init__(self, backend: str, max_size: int, ttl: float, directory: Path):
+        self.backend = backend
+        self.max_size = max_size
+        self.ttl = ttl
+        self.directory = directory
+        self._entries: OrderedDict[tuple[str, str], tuple[float, list[LLMMessage]]] = OrderedDict()
+        self._locks: dict[tuple[str, str], asyncio.Lock] = {}
+
+    def lock(self, key: tuple[str, str]) -> asyncio.Lock:
+        """Serializes turns of the same session and actor within this worker."""
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+        return lock
+
+    def _cached(self, key: tuple[str, str]) -> list[LLMMessage] | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def _remember(self, key: tuple[str, str], messages: list[LLMMessage]):
+        self._entries[key] = (time.monotonic() + self.ttl, messages)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            evicted, _ = self._entries.popitem(last=False)
+            lock = self._locks.get(evicted)
+            if lock is not None and not lock.locked():
+                del self._locks[evicted]
+
+    async def load(self, key: tuple[str, str], expected_length: int | None = None) -> list[LLMMessage]:
+        """
+        Returns the stored history. When the cached copy does not have expected_length messages the backing store is
+        consulted, since another worker may have appended to it.
+        """
+        messages = self._cached(key)
+        if messages is not None and (expected_length is None or len(messages) == expected_length):
+            return messages
+        if self.backend == "postgres":
+            messages = await self._load_postgres(key)
+        elif self.backend == "disk":
+            messages = await asyncio.to_thread(self._load_disk, key)
+        elif messages is None:
+            messages = []
+        self._remember(key, messages)
+        return messages
+
+    async def append(self, key: tuple[str, str], start: int, new_messages: list[LLMMessage]):
+        """Stores new_messages after the first `start` messages of the history, persisting only them."""
+        messages = (self._cached(key) or [])[:start] + new_messages
+        self._remember(key, messages)
+        try:
+            if self.backend == "postgres":
+                await self._write_postgres(key, start, new_messages)
+            elif self.backend == "disk":
+                await asyncio.to_thread(self._write_disk, key, start, new_messages)
+        except Exception as e:
+            logger.warning("Error persisting session %s: %s", key, e)
+
+    def clear(self):
+        self._entries.clear()
+
+    async def _load_postgres(self, key: tuple[str, str]) -> list[LLMMessage]:
+        async with pool().connection() as conn, conn.cursor() as cur:
+            await cur.execute(
+                "SELECT role, content FROM session_messages WHERE session_id = %s AND actor_name = %s ORDER BY seq",
+                key
+            )
+            return [LLMMessage(role=role, content=content) for role, content in await cur.fetchall()]
+
+    async def _write_postgres(self, key: tuple[str, str], start: int, new_messages: list[LLMMessage]):
+        async with pool().connection() as conn, conn.cursor() as cur:
+            # A resync may rewrite the tail of the history
+            await cur.execute("DELETE FROM session_messages WHERE session_id = %s AND actor_name = %s AND seq >= %s",
+                              (*key, start))
+            await cur.executemany(
+                "INSERT INTO session_messages (session_id, actor_name, seq, role, content) VALUES (%s, %s, %s, %s, %s)",
+                [(*key, start + i, msg.role, msg.content) for i, msg in enumerate(new_messages)]
+            )
+
+    def _path(self, key: tuple[str, str]) -> Path:
+        digest = hashlib.sha256("\x00".join(key).encode("utf-8")).hexdigest()
+        return self.directory / f"{digest}.jsonl"
+
+    def _load_disk(self, key: tuple[str, str]) -> list[LLMMessage]:
+        path = self._path(key)
+        if not path.exists():
+            return []
+        messages = []
+        for line in path.read_text(encoding="utf-8").splitlines():
+            if line:
+                record = json.loads(line)
+                # Each line is a delta: messages from record["start"] on
+                del messages[record["start"]:]
+                messages.extend(LLMMessage(**msg) for msg in record["messages"])
+        return messages
+
+    def _write_disk(self, key: tuple[str, str], start: int, new_messages: list[LLMMessage]):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        record = {"start": start, "messages": [msg.model_dump() for msg in new_messages]}
+        with self._path(key).open("a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+def _backend() -> str:
+    if SESSION_STORE == "postgres" and pool() is None:
+        logger.warning("SESSION_STORE=postgres but DB_CONN_URL is not defined, keeping sessions in memory only")
+        return "memory"
+    return SESSION_STORE
+
+
+session_store = SessionStore(_backend(), SESSION_CACHE_SIZE, SESSION_TTL, SESSION_DIR) \
+    if SESSION_STORE != "off" else None
@@ -26,6 +26,10 @@ SCHEMA_PATH = BASE_DIR / "schema.sql"
 
 # Provide a default value if DB_CONN_URL is not set
 DB_CONN_URL = os.getenv("DB_CONN_URL")
+# Connections per worker: min_size are opened at startup and kept, up to max_size under load
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "2"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+DB_POOL_OPEN_TIMEOUT = float(os.getenv("DB_POOL_OPEN_TIMEOUT", "30"))  # seconds to wait for min_size at startup
 
 # Use a generic API_KEY environment variable
 API_KEY = os.getenv("API_KEY")
@@ -43,17 +47,196 @@ elif INFERENCE_SERVICE == "deepseek":
     MODEL = os.getenv("MODEL", "deepseek-chat")
 elif INFERENCE_SERVICE == "ollama":
     MODEL = os.getenv("MODEL", "llama2")
+elif INFERENCE_SERVICE == "mock":
+    # Offline provider for load tests and benchmarks, see mock.py
+    MODEL = os.getenv("MODEL", "mock")
 else:
     raise ValueError(f"Unknown inference service: {INFERENCE_SERVICE}")
 
 MAX_TOKENS = int(os.getenv("MAX_TOKENS", "200"))
 
 # Increment this whenever we make changes to the prompts
-PROMPTS_VERSION = "1.0.5"
+PROMPTS_VERSION = "1.0.8"
 
 MODEL_KEY = f"{MODEL}:{MAX_TOKENS}:{PROMPTS_VERSION}"
 
+SERVICES = ("anthropic", "openai", "groq", "openrouter", "deepseek", "ollama", "mock")
+DEFAULT_MODELS = {
+    "anthropic": "claude-3-haiku-20240307",
+    "openai": "gpt-3.5-turbo",
+    "groq": "gpt-3.5-turbo",
+    "openrouter": "gpt-3.5-turbo",
+    "deepseek": "deepseek-chat",
+    "ollama": "llama2",
+    "mock": "mock",
+}
+# Per-service API keys (e.g. DEEPSEEK_API_KEY) for routing stages to several providers, falling back to API_KEY
+API_KEYS = {service: os.getenv(f"{service.upper()}_API_KEY") or API_KEY for service in SERVICES}
+
+
+def _parse_backends(spec: str) -> list[tuple[str, str]]:
+    # "deepseek:deepseek-chat,anthropic" -> [("deepseek", "deepseek-chat"), ("anthropic", "claude-3-haiku-20240307")]
+    backends = []
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        service, _, model = item.partition(":")
+        if service not in SERVICES:
+            raise ValueError(f"Unknown inference service in backend list: {service}")
+        backends.append((service, model or DEFAULT_MODELS[service]))
+    return backends
+
+
+# Backends per pipeline stage (see router.py), e.g. CRITIQUE_BACKENDS=groq:llama3-8b-8192,deepseek. The first
+# healthy backend is used, the others are failover / hedging targets. Unset stages use INFERENCE_SERVICE and MODEL.
+STAGES = ("initial", "critique", "refine", "summarize")
+STAGE_BACKENDS = {
+    stage: _parse_backends(os.getenv(f"{stage.upper()}_BACKENDS", "")) or [(INFERENCE_SERVICE, MODEL)]
+    for stage in STAGES
+}
+
 # Additional settings for specific services
 OLLAMA_URL = os.getenv("OLLAMA_URL", "http://localhost:11434")
+# How long Ollama keeps a model loaded after a request (Ollama duration, e.g. "30m"; "-1" keeps it loaded). The
+# runner reuses the KV cache of the longest matching prompt prefix, so a resident model only prefills the new turns.
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+# Context window in tokens (0 keeps the model's default, which is often too small for the story and actor sheet)
+OLLAMA_NUM_CTX = int(os.getenv("OLLAMA_NUM_CTX", "0"))
 GROQ_API_BASE = os.getenv("GROQ_API_BASE", "https://api.groq.com/openai/v1")
 OPENROUTER_API_BASE = os.getenv("OPENROUTER_API_BASE", "https://openrouter.ai/api/v1")
+
+# Provider HTTP client settings (shared, keep-alive connection pool per worker)
+PROVIDER_TIMEOUT = float(os.getenv("PROVIDER_TIMEOUT", "120"))
+PROVIDER_CONNECT_TIMEOUT = float(os.getenv("PROVIDER_CONNECT_TIMEOUT", "10"))
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "60"))
+HTTP2 = os.getenv("HTTP2", "true").lower() in ("1", "true", "yes")
+# Open a connection to every configured provider at startup (one cheap model list request each), so the first
+# turn after a deploy does not pay for DNS and the TLS handshake
+PREWARM_CLIENTS = os.getenv("PREWARM_CLIENTS", "true").lower() in ("1", "true", "yes")
+
+# Response cache in front of prompt_ai (see cache.py). Off unless enabled: with one variant every player asking an
+# actor the same question in the same context gets the same reply for the whole TTL
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "false").lower() in ("1", "true", "yes")
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "2048"))  # max number of cached requests per worker
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "86400"))  # seconds
+# Also look up finished conversation_turns rows with the same request hash (shared across workers)
+RESPONSE_CACHE_DB = os.getenv("RESPONSE_CACHE_DB", "false").lower() in ("1", "true", "yes")
+# Collect this many different responses per request before serving cached ones at random
+RESPONSE_CACHE_VARIANTS = int(os.getenv("RESPONSE_CACHE_VARIANTS", "1"))
+# Let concurrent identical requests (same request_cache_key, any session) share one pipeline run
+COALESCE_REQUESTS = os.getenv("COALESCE_REQUESTS", "true").lower() in ("1", "true", "yes")
+
+# Story data shared with the frontend: character files and the evidence / context mappings. Defaults to the
+# frontend's sources in a checkout; the Docker image only contains api/ and expects them mounted at DATA_DIR.
+# Relative file names below are resolved against DATA_DIR, a configured file that does not exist stops the startup.
+DATA_DIR = Path(os.getenv("DATA_DIR", str(BASE_DIR.parent / "web" / "src")))
+
+
+def _data_file(name: str, default: str) -> Path | None:
+    value = os.getenv(name, default)
+    return DATA_DIR / value if value else None
+
+
+# Character files loaded once at startup (see registry.py), comma separated; empty loads none
+CHARACTER_FILES = [DATA_DIR / p.strip() for p in os.getenv("CHARACTER_FILES", "characters.json,characters2.json")
+                   .split(",") if p.strip()]
+# Max number of memoized prompt skeletons (system / principles / refiner) per worker
+PROMPT_CACHE_SIZE = int(os.getenv("PROMPT_CACHE_SIZE", "512"))
+
+# Mark the static system prompt prefix as cacheable (Anthropic cache_control; OpenAI-compatible providers cache
+# stable prefixes automatically)
+PROMPT_CACHING = os.getenv("PROMPT_CACHING", "true").lower() in ("1", "true", "yes")
+
+# Write-behind audit log for conversation_turns / ai_invocations (see audit.py)
+AUDIT_QUEUE_SIZE = int(os.getenv("AUDIT_QUEUE_SIZE", "10000"))
+AUDIT_BATCH_SIZE = int(os.getenv("AUDIT_BATCH_SIZE", "200"))
+AUDIT_FLUSH_INTERVAL = float(os.getenv("AUDIT_FLUSH_INTERVAL", "1.0"))  # seconds
+AUDIT_OVERFLOW = os.getenv("AUDIT_OVERFLOW", "drop")  # "drop" or "block" when the queue is full
+AUDIT_ID_BLOCK_SIZE = int(os.getenv("AUDIT_ID_BLOCK_SIZE", "50"))  # turn ids reserved per sequence round-trip
+
+# Local rule-based pre-check before the LLM critique (see precheck.py). Replies scoring at most PRECHECK_SAFE_SCORE
+# skip the LLM critique; actors can override the threshold with "precheck_threshold" in the character file.
+# Off by default until its verdicts have been validated against recorded LLM critiques.
+PRECHECK_ENABLED = os.getenv("PRECHECK_ENABLED", "false").lower() in ("1", "true", "yes")
+PRECHECK_SAFE_SCORE = float(os.getenv("PRECHECK_SAFE_SCORE", "0"))
+# People the pre-check recognizes besides the actors of the loaded character files (e.g. the victim), comma separated
+PRECHECK_ENTITIES = [name.strip() for name in os.getenv("PRECHECK_ENTITIES", "宝生玛格").split(",") if name.strip()]
+
+# Ask providers for the critique verdict as JSON (Anthropic via a forced tool call, OpenAI-compatible JSON mode,
+# Ollama format schema). Free-text critiques are still parsed either way (see verdict.py).
+CRITIQUE_STRUCTURED_OUTPUT = os.getenv("CRITIQUE_STRUCTURED_OUTPUT", "true").lower() in ("1", "true", "yes")
+
+# Shorten replies whose only problem is the 88 character limit (原则B) locally on sentence boundaries instead of
+# spending a refine and another critique call on them (see text.truncate_to_length)
+LOCAL_TRUNCATION = os.getenv("LOCAL_TRUNCATION", "true").lower() in ("1", "true", "yes")
+
+# Best-of-N: generate this many initial responses concurrently on /invoke/ and use the first one that passes the
+# critique, falling back to the refine loop only when all fail. 1 keeps the serial initial -> critique -> refine flow.
+CANDIDATE_COUNT = int(os.getenv("CANDIDATE_COUNT", "1"))
+# "cancel" stops the other candidates once one passes, "wait" lets them finish (all invocations get logged)
+CANDIDATE_CANCEL_POLICY = os.getenv("CANDIDATE_CANCEL_POLICY", "cancel")
+
+# Mock provider (INFERENCE_SERVICE=mock, see mock.py). Without a trace file every call sleeps MOCK_LATENCY seconds
+# (+/- MOCK_LATENCY_JITTER) and returns a canned reply; with MOCK_TRACE_FILE it replays recorded invocations.
+MOCK_TRACE_FILE = os.getenv("MOCK_TRACE_FILE", "")
+MOCK_LATENCY = float(os.getenv("MOCK_LATENCY", "1.0"))
+MOCK_LATENCY_JITTER = float(os.getenv("MOCK_LATENCY_JITTER", "0.3"))
+MOCK_LATENCY_SCALE = float(os.getenv("MOCK_LATENCY_SCALE", "1.0"))  # multiplies every latency, also replayed ones
+MOCK_INPUT_TOKENS = int(os.getenv("MOCK_INPUT_TOKENS", "1500"))
+MOCK_OUTPUT_TOKENS = int(os.getenv("MOCK_OUTPUT_TOKENS", "60"))
+# Share of critiques that report a violation; empty keeps the ratio of the replayed trace (0 without a trace)
+MOCK_CRITIQUE_FAIL_RATE = os.getenv("MOCK_CRITIQUE_FAIL_RATE", "")
+MOCK_SEED = os.getenv("MOCK_SEED", "")
+
+# History compaction for long interrogations (see history.py): once a conversation's history exceeds
+# HISTORY_TOKEN_BUDGET (estimated) tokens, older turns are folded into a per-session summary generated in the
+# background, and the initial response only gets the summary plus about HISTORY_RECENT_TOKENS of recent turns.
+HISTORY_COMPACTION = os.getenv("HISTORY_COMPACTION", "true").lower() in ("1", "true", "yes")
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "3000"))
+HISTORY_RECENT_TOKENS = int(os.getenv("HISTORY_RECENT_TOKENS", "1200"))
+HISTORY_MIN_RECENT_MESSAGES = int(os.getenv("HISTORY_MIN_RECENT_MESSAGES", "6"))
+HISTORY_SUMMARY_CACHE_SIZE = int(os.getenv("HISTORY_SUMMARY_CACHE_SIZE", "4096"))  # summaries kept per worker
+
+# Admission control around provider calls (see admission.py), per worker process. Calls beyond
+# PROVIDER_MAX_CONCURRENCY wait in a priority queue (initial responses first) of at most PROVIDER_QUEUE_SIZE calls.
+PROVIDER_MAX_CONCURRENCY = int(os.getenv("PROVIDER_MAX_CONCURRENCY", "32"))
+PROVIDER_QUEUE_SIZE = int(os.getenv("PROVIDER_QUEUE_SIZE", "256"))
+# Requests / tokens (estimated input + MAX_TOKENS) per minute, 0 = unlimited
+PROVIDER_RPM = int(os.getenv("PROVIDER_RPM", "0"))
+PROVIDER_TPM = int(os.getenv("PROVIDER_TPM", "0"))
+# Retries of 429 / 5xx / connection errors, honoring Retry-After, otherwise jittered exponential backoff (seconds)
+PROVIDER_MAX_RETRIES = int(os.getenv("PROVIDER_MAX_RETRIES", "4"))
+PROVIDER_RETRY_BASE = float(os.getenv("PROVIDER_RETRY_BASE", "0.5"))
+PROVIDER_RETRY_MAX = float(os.getenv("PROVIDER_RETRY_MAX", "20"))
+# Reject calls for CIRCUIT_RESET_TIMEOUT seconds after this many consecutive failed calls, 0 disables the breaker
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_RESET_TIMEOUT = float(os.getenv("CIRCUIT_RESET_TIMEOUT", "30"))
+
+# Router (see router.py): health is judged on the last ROUTER_WINDOW calls of each backend. Backends with an error
+# rate of at least ROUTER_MAX_ERROR_RATE, or a mean latency above ROUTER_SLOW_LATENCY seconds (0 = off), are tried
+# last. With ROUTER_HEDGE_AFTER > 0 a call still running after that many seconds is hedged on the next backend.
+ROUTER_WINDOW = int(os.getenv("ROUTER_WINDOW", "50"))
+ROUTER_MAX_ERROR_RATE = float(os.getenv("ROUTER_MAX_ERROR_RATE", "0.5"))
+ROUTER_SLOW_LATENCY = float(os.getenv("ROUTER_SLOW_LATENCY", "0"))
+ROUTER_HEDGE_AFTER = float(os.getenv("ROUTER_HEDGE_AFTER", "0"))
+
+# Server-side conversation histories (see sessions.py), so clients can send only the new message of each turn.
+# "memory" keeps them per worker, "postgres" / "disk" also persist each turn's new messages and let any worker
+# continue a session; "off" disables session requests.
+SESSION_STORE = os.getenv("SESSION_STORE", "memory")
+if SESSION_STORE not in ("memory", "postgres", "disk", "off"):
+    raise ValueError(f"Unknown session store: {SESSION_STORE}")
+SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", "10000"))  # histories kept in memory per worker
+SESSION_TTL = float(os.getenv("SESSION_TTL", "86400"))  # seconds
+SESSION_DIR = Path(os.getenv("SESSION_DIR", str(BASE_DIR / "sessions")))
+
+# Evidence id -> context2 / context3 / context4 / lastcontext unlocked for each actor (see registry.py); empty
+# disables context unlocks
+CONTEXT_MAPPING_FILE = _data_file("CONTEXT_MAPPING_FILE", "context2Mapping.json")
+
+# Per-actor keywords that unlock evidence (see evidence.py), matched against every final response; empty leaves
+# evidence unlocks to the client
+EVIDENCE_MAPPING_FILE = _data_file("EVIDENCE_MAPPING_FILE", "responseKeywordMapping.json")
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# The api modules import each other as top-level modules (uvicorn runs from api/)
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
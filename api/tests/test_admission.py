@@ -0,0 +1,117 @@
+import asyncio
+
+import pytest
+
+import admission
+from admission import CircuitBreaker, PriorityLimiter, ProviderGate, ProviderUnavailable
+
+
+def test_circuit_opens_after_threshold(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(admission.time, "monotonic", lambda: now[0])
+    breaker = CircuitBreaker(threshold=2, reset_timeout=10)
+    breaker.record_failure()
+    assert breaker.state == "closed"
+    breaker.record_failure()
+    assert breaker.state == "open"
+    with pytest.raises(ProviderUnavailable) as e:
+        breaker.check()
+    assert e.value.retry_after == 10
+
+    now[0] += 10
+    assert breaker.state == "half_open"
+    assert breaker.check() is True
+    # Only one probe at a time
+    with pytest.raises(ProviderUnavailable):
+        breaker.check()
+    breaker.record_success()
+    assert breaker.state == "closed"
+    assert breaker.check() is False
+
+
+def test_failed_probe_reopens_circuit(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(admission.time, "monotonic", lambda: now[0])
+    breaker = CircuitBreaker(threshold=1, reset_timeout=10)
+    breaker.record_failure()
+    now[0] += 10
+    assert breaker.check()
+    breaker.record_failure()
+    assert breaker.state == "open"
+
+
+def test_probe_rejected_by_full_queue_releases_circuit(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(admission.time, "monotonic", lambda: now[0])
+    gate = ProviderGate("test")
+    gate.breaker = CircuitBreaker(threshold=1, reset_timeout=10)
+    gate.limiter = PriorityLimiter(max_concurrency=0, max_waiting=0)
+    gate.breaker.record_failure()
+    now[0] += 10
+
+    async def admit():
+        async with gate.admit("initial", 0):
+            pass
+
+    with pytest.raises(ProviderUnavailable):
+        asyncio.run(admit())
+    assert not gate.breaker.probing
+    assert gate.rejected == 1
+    # The next call may probe again
+    assert gate.breaker.check()
+
+
+def test_limiter_admits_by_priority():
+    async def scenario():
+        limiter = PriorityLimiter(max_concurrency=1, max_waiting=10)
+        order = []
+        await limiter.acquire(0)
+
+        async def waiter(name, priority):
+            await limiter.acquire(priority)
+            order.append(name)
+            limiter.release()
+
+        tasks = [asyncio.create_task(waiter("refine", 2)), asyncio.create_task(waiter("critique", 1)),
+                 asyncio.create_task(waiter("initial", 0)), asyncio.create_task(waiter("critique 2", 1))]
+        await asyncio.sleep(0)
+        assert limiter.waiting == 4
+        limiter.release()
+        await asyncio.gather(*tasks)
+        assert limiter.active == 0
+        return order
+
+    assert asyncio.run(scenario()) == ["initial", "critique", "critique 2", "refine"]
+
+
+def test_limiter_queue_full():
+    async def scenario():
+        limiter = PriorityLimiter(max_concurrency=1, max_waiting=1)
+        await limiter.acquire(0)
+        queued = asyncio.create_task(limiter.acquire(0))
+        await asyncio.sleep(0)
+        with pytest.raises(ProviderUnavailable):
+            await limiter.acquire(0)
+        limiter.release()
+        await queued
+        assert limiter.active == 1
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_waiter_passes_slot_on():
+    async def scenario():
+        limiter = PriorityLimiter(max_concurrency=1, max_waiting=10)
+        await limiter.acquire(0)
+        first = asyncio.create_task(limiter.acquire(0))
+        second = asyncio.create_task(limiter.acquire(0))
+        await asyncio.sleep(0)
+        first.cancel()
+        limiter.release()
+        await second
+        assert first.cancelled()
+        assert limiter.active == 1
+        limiter.release()
+        assert limiter.active == 0
+
+    asyncio.run(scenario())
@@ -0,0 +1,237 @@
+import asyncio
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+
+import pytest
+
+import audit
+from audit import AuditLog, INSERT_INVOCATION, INSERT_TURN
+from invoke_types import Actor, InvocationRequest, InvocationResponse
+
+NOW = datetime.now(timezone.utc)
+
+
+class FakeCursor:
+    def __init__(self, db: "FakeDatabase"):
+        self.db = db
+        self.rows = []
+
+    async def execute(self, query: str, params):
+        # Only the id reservation goes through a cursor
+        self.rows = [(next(self.db.sequence), ) for _ in range(params[0])]
+
+    async def fetchall(self):
+        return self.rows
+
+    @asynccontextmanager
+    async def copy(self, statement: str):
+        table = statement.split()[1]
+        rows = []
+
+        class Copy:
+            async def write_row(self, row):
+                rows.append(row)
+
+        yield Copy()
+        self.db.check(table, rows)
+        self.db.pending.extend((table, row) for row in rows)
+
+    async def executemany(self, query: str, params_seq):
+        self.db.pending.extend(("update", params) for params in params_seq)
+
+
+class FakeConnection:
+    def __init__(self, db: "FakeDatabase"):
+        self.db = db
+
+    @asynccontextmanager
+    async def cursor(self):
+        yield FakeCursor(self.db)
+
+    @asynccontextmanager
+    async def transaction(self):
+        yield
+
+    async def execute(self, query: str, params):
+        table = "conversation_turns" if query == INSERT_TURN else \
+            "ai_invocations" if query == INSERT_INVOCATION else "update"
+        self.db.check(table, [params])
+        self.db.rows.append((table, params))
+
+
+class FakeDatabase:
+    """
+    Stands in for the connection pool. A batch (one connection) commits only when the connection is returned
+    without an error; rows for which `fail(table, row)` is true fail their statement.
+    """
+
+    def __init__(self, fail=lambda table, row: False, reachable: bool = True, delay: float = 0):
+        self.fail = fail
+        self.reachable = reachable
+        self.delay = delay
+        self.sequence = iter(range(1, 1000000))
+        self.rows = []
+        self.pending = []
+        self.connections = 0
+
+    async def connected(self):
+        self.connections += 1
+        await asyncio.sleep(self.delay)
+        if not self.reachable:
+            raise ConnectionError("database is down")
+
+    def check(self, table: str, rows: list):
+        if any(self.fail(table, row) for row in rows):
+            raise ValueError(f"bad row in {table}")
+
+    @asynccontextmanager
+    async def connection(self):
+        await self.connected()
+        self.pending = []
+        yield FakeConnection(self)
+        self.rows.extend(self.pending)
+
+    def table(self, name: str) -> list:
+        return [row for table, row in self.rows if table == name]
+
+
+@pytest.fixture
+def database(monkeypatch):
+    db = FakeDatabase()
+    monkeypatch.setattr(audit, "pool", lambda: db)
+
+    async def open_pool():
+        pass
+
+    monkeypatch.setattr(audit, "open_pool", open_pool)
+    return db
+
+
+def make_log() -> AuditLog:
+    return AuditLog(queue_size=100, batch_size=100, flush_interval=0.01, overflow="drop", id_block_size=4)
+
+
+def make_request() -> InvocationRequest:
+    actor = Actor(name="远野", bio="", personality="", context1="", secret="", violation="", messages=[])
+    return InvocationRequest(global_story="", actor=actor, session_id="s", character_file_version="test")
+
+
+def make_response() -> InvocationResponse:
+    return InvocationResponse(original_response="我在书房。", critique_response="NONE!", problems_detected=False,
+                              final_response="我在书房。", refined_response=None)
+
+
+async def log_turn(log: AuditLog, usage: dict | None = None) -> int:
+    turn_id = await log.reserve_turn_id()
+    await log.log_turn(turn_id, make_request())
+    await log.log_invocation(turn_id, "initial", "system", [], "我在书房。",
+                             usage or {"input_tokens": 10, "output_tokens": 5, "cache_read_tokens": 0,
+                                       "cache_write_tokens": 0}, NOW, NOW)
+    await log.log_response(turn_id, make_response())
+    return turn_id
+
+
+def test_batch_is_written_with_responses_folded_in(database):
+    async def scenario():
+        log = make_log()
+        await log.start()
+        turn_ids = [await log_turn(log) for _ in range(3)]
+        await log.stop()
+        return log, turn_ids
+
+    log, turn_ids = asyncio.run(scenario())
+    turns = database.table("conversation_turns")
+    assert [row[0] for row in turns] == turn_ids
+    # The response arrived in the same batch as its turn and is part of the row
+    assert all(row[audit.TURN_COLUMNS.index("final_response")] == "我在书房。" for row in turns)
+    assert len(database.table("ai_invocations")) == 3
+    assert database.table("update") == []
+    assert (log.written, log.failed, log.dropped) == (6, 0, 0)
+
+
+def test_failed_batch_is_written_record_by_record(database):
+    bad_turns = set()
+    database.fail = lambda table, row: table == "conversation_turns" and row[0] in bad_turns
+
+    async def scenario():
+        log = make_log()
+        await log.start()
+        turn_ids = [await log_turn(log) for _ in range(3)]
+        bad_turns.add(turn_ids[1])
+        await log.stop()
+        return log, turn_ids
+
+    log, turn_ids = asyncio.run(scenario())
+    assert [row[0] for row in database.table("conversation_turns")] == [turn_ids[0], turn_ids[2]]
+    # The invocation of the failed turn would only fail the foreign key
+    assert [row[0] for row in database.table("ai_invocations")] == [turn_ids[0], turn_ids[2]]
+    assert (log.written, log.failed) == (4, 2)
+
+
+def test_dependents_of_a_lost_turn_are_dropped(database):
+    async def scenario():
+        log = make_log()
+        await log.start()
+        turn_id = await log.reserve_turn_id()
+        # As when the turn record was dropped from a full queue
+        log._lose_turn(turn_id)
+        await log.log_invocation(turn_id, "initial", "system", [], "我在书房。",
+                                 {"input_tokens": 10, "output_tokens": 5, "cache_read_tokens": 0,
+                                  "cache_write_tokens": 0}, NOW, NOW)
+        await log.log_response(turn_id, make_response())
+        await log.stop()
+        return log
+
+    log = asyncio.run(scenario())
+    assert database.rows == []
+    assert (log.written, log.dropped) == (0, 2)
+
+
+def test_missing_token_counts_are_stored_as_zero(database):
+    async def scenario():
+        log = make_log()
+        await log.start()
+        await log_turn(log, {"input_tokens": None, "output_tokens": None, "cache_read_tokens": None,
+                             "cache_write_tokens": None})
+        await log.stop()
+
+    asyncio.run(scenario())
+    (invocation, ) = database.table("ai_invocations")
+    columns = audit.INVOCATION_COLUMNS
+    assert [invocation[columns.index(column)] for column in ("input_tokens", "output_tokens", "total_tokens")] \
+        == [0, 0, 0]
+
+
+def test_ids_are_refilled_ahead(database):
+    async def scenario():
+        log = make_log()
+        await log.start()
+        turn_ids = [await log.reserve_turn_id() for _ in range(3)]
+        await asyncio.sleep(0)
+        await log.stop()
+        return log, turn_ids
+
+    log, turn_ids = asyncio.run(scenario())
+    assert turn_ids == [1, 2, 3]
+    # The first block at start, the second once the first was half used
+    assert database.connections == 2
+    assert len(log._ids) == 5
+
+
+def test_reserve_does_not_wait_for_an_unreachable_database(database):
+    database.reachable = False
+    database.delay = 0.2
+
+    async def scenario():
+        log = make_log()
+        await log.start()
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        turn_ids = await asyncio.gather(*(log.reserve_turn_id() for _ in range(10)))
+        elapsed = loop.time() - started
+        await log.stop()
+        return turn_ids, elapsed
+
+    turn_ids, elapsed = asyncio.run(scenario())
+    assert turn_ids == [0] * 10
+    assert elapsed < 0.1
@@ -0,0 +1,147 @@
+import asyncio
+
+import cache
+import main
+from cache import ResponseCache, request_cache_key
+from invoke_types import Actor, InvocationRequest, InvocationResponse, LLMMessage
+
+
+def make_request(session_id: str = "s", question: str = "案发当晚你在哪里？") -> InvocationRequest:
+    actor = Actor(name="远野", bio="", personality="", context1="我晚上8点在书房看书。", secret="", violation="",
+                  messages=[LLMMessage(role="user", content=question)])
+    return InvocationRequest(global_story="庄园里发生了命案。", actor=actor, session_id=session_id,
+                             character_file_version="test")
+
+
+def make_response(text: str = "我在书房。", problems_detected: bool = False) -> InvocationResponse:
+    return InvocationResponse(original_response=text, critique_response="NONE!", problems_detected=problems_detected,
+                              final_response=text, refined_response=None)
+
+
+def test_request_cache_key():
+    assert request_cache_key(make_request("a")) == request_cache_key(make_request("b"))
+    assert request_cache_key(make_request(question="案发当晚你在哪里？ ")) == request_cache_key(make_request())
+    assert request_cache_key(make_request(question="你是谁？")) != request_cache_key(make_request())
+
+
+def test_hit_and_miss():
+    response_cache = ResponseCache(max_size=10, ttl=60, variants=1, use_db=False)
+    assert asyncio.run(response_cache.get("k")) is None
+    response_cache.put("k", make_response())
+    assert asyncio.run(response_cache.get("k")).final_response == "我在书房。"
+    assert (response_cache.hits, response_cache.misses) == (1, 1)
+
+
+def test_failed_responses_are_not_cached():
+    response_cache = ResponseCache(max_size=10, ttl=60, variants=1, use_db=False)
+    response_cache.put("k", make_response(problems_detected=True))
+    assert asyncio.run(response_cache.get("k")) is None
+
+
+def test_ttl(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(cache.time, "monotonic", lambda: now[0])
+    response_cache = ResponseCache(max_size=10, ttl=60, variants=1, use_db=False)
+    response_cache.put("k", make_response())
+    now[0] += 61
+    assert asyncio.run(response_cache.get("k")) is None
+
+
+def test_lru_eviction():
+    response_cache = ResponseCache(max_size=2, ttl=60, variants=1, use_db=False)
+    response_cache.put("a", make_response())
+    response_cache.put("b", make_response())
+    asyncio.run(response_cache.get("a"))
+    response_cache.put("c", make_response())
+    assert asyncio.run(response_cache.get("b")) is None
+    assert asyncio.run(response_cache.get("a")) is not None
+
+
+def test_variants():
+    response_cache = ResponseCache(max_size=10, ttl=60, variants=2, use_db=False)
+    response_cache.put("k", make_response("我在书房。"))
+    # Not a hit until two different responses have been collected
+    assert asyncio.run(response_cache.get("k")) is None
+    response_cache.put("k", make_response("我在看书。"))
+    replies = {asyncio.run(response_cache.get("k")).final_response for _ in range(50)}
+    assert replies == {"我在书房。", "我在看书。"}
+
+
+def test_lookup_does_not_modify_the_cached_response(monkeypatch):
+    response_cache = ResponseCache(max_size=10, ttl=60, variants=1, use_db=False)
+    monkeypatch.setattr(main, "response_cache", response_cache)
+    monkeypatch.setattr(main, "match_evidence", lambda actor_name, text: ["e1"])
+    stored = make_response()
+    response_cache.put("k", stored)
+
+    served = asyncio.run(main.lookup_cached_response(0, make_request(), "k"))
+    assert served.evidence_ids == ["e1"]
+    assert stored.evidence_ids is None
+
+
+def test_single_flight_shares_one_run():
+    async def scenario():
+        flight = cache.SingleFlight()
+        runs = 0
+        release = asyncio.Event()
+
+        async def pipeline():
+            nonlocal runs
+            runs += 1
+            await release.wait()
+            return make_response()
+
+        waiters = [asyncio.create_task(flight.run("k", pipeline)) for _ in range(3)]
+        await asyncio.sleep(0)
+        assert flight.get("k") is not None
+        release.set()
+        results = await asyncio.gather(*waiters)
+        assert flight.get("k") is None
+        return runs, results, flight
+
+    runs, results, flight = asyncio.run(scenario())
+    assert runs == 1
+    assert [shared for _, shared in results] == [False, True, True]
+    assert (flight.leaders, flight.followers) == (1, 2)
+
+
+def test_single_flight_survives_a_cancelled_leader():
+    async def scenario():
+        flight = cache.SingleFlight()
+        release = asyncio.Event()
+
+        async def pipeline():
+            await release.wait()
+            return make_response()
+
+        leader = asyncio.create_task(flight.run("k", pipeline))
+        await asyncio.sleep(0)
+        follower = asyncio.create_task(flight.run("k", pipeline))
+        await asyncio.sleep(0)
+        # The leader's client disconnects, the run goes on for the follower
+        leader.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        return await follower
+
+    response, shared = asyncio.run(scenario())
+    assert shared
+    assert response.final_response == "我在书房。"
+
+
+def test_single_flight_shares_errors_and_forgets_the_run():
+    async def scenario():
+        flight = cache.SingleFlight()
+
+        async def failing():
+            await asyncio.sleep(0)
+            raise ValueError("provider down")
+
+        results = await asyncio.gather(flight.run("k", failing), flight.run("k", failing), return_exceptions=True)
+        # A later request starts a new run
+        response, shared = await flight.run("k", lambda: asyncio.sleep(0, make_response()))
+        return results, shared
+
+    results, shared = asyncio.run(scenario())
+    assert all(isinstance(result, ValueError) for result in results)
+    assert not shared
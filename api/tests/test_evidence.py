@@ -0,0 +1,30 @@
+from evidence import KeywordMatcher
+
+
+def test_find():
+    matcher = KeywordMatcher({"画作": {"e1"}, "书房": {"e2"}, "钥匙": {"e3"}})
+    assert matcher.find("我在书房看那幅画作") == {"e1", "e2"}
+    assert matcher.find("什么也没有") == set()
+
+
+def test_overlapping_keywords():
+    # 画 is a suffix of 油画, 油画 a suffix of 一幅油画
+    matcher = KeywordMatcher({"画": {"a"}, "油画": {"b"}, "一幅油画": {"c"}, "幅油": {"d"}})
+    assert matcher.find("一幅油画") == {"a", "b", "c", "d"}
+    assert matcher.find("一幅水彩画") == {"a"}
+
+
+def test_failure_links():
+    matcher = KeywordMatcher({"abcd": {"x"}, "bce": {"y"}})
+    assert matcher.find("abce") == {"y"}
+    assert matcher.find("abcbce") == {"y"}
+
+
+def test_case_insensitive():
+    matcher = KeywordMatcher({"Key": {"k"}})
+    assert matcher.find("a KEY") == {"k"}
+
+
+def test_keyword_with_several_payloads():
+    matcher = KeywordMatcher({"手帕": {"e1", "e2"}})
+    assert matcher.find("手帕") == {"e1", "e2"}
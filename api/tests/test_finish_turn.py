@@ -0,0 +1,90 @@
+import asyncio
+
+import pytest
+
+import ai
+import main
+from invoke_types import Actor, InvocationRequest
+from text import equivalent_length
+from verdict import CritiqueVerdict
+
+LONG_REPLY = "我那天晚上一直待在书房里看书。" * 8
+SHORT_REPLY = "我一直在书房里看书。"
+
+
+def make_request() -> InvocationRequest:
+    actor = Actor(name="远野", bio="", personality="", context1="我晚上8点在书房看书。", secret="", violation="",
+                  messages=[])
+    return InvocationRequest(global_story="", actor=actor, session_id="s", character_file_version="test")
+
+
+@pytest.fixture
+def pipeline(monkeypatch):
+    """The LLM critique answers with the queued verdicts (then passes), refine with SHORT_REPLY."""
+    calls = {"critique": 0, "refine": 0}
+    verdicts = []
+
+    async def invoke_ai(turn_id, prompt_role, **kwargs):
+        calls["critique"] += 1
+        return verdicts.pop(0) if verdicts else CritiqueVerdict(verdict="pass")
+
+    async def refine(*args):
+        calls["refine"] += 1
+        return SHORT_REPLY
+
+    monkeypatch.setattr(ai, "invoke_ai", invoke_ai)
+    monkeypatch.setattr(ai, "precheck_reply", lambda request, reply: None)
+    monkeypatch.setattr(main, "refine", refine)
+    monkeypatch.setattr(main, "LOCAL_TRUNCATION", True)
+    return calls, verdicts
+
+
+def test_length_only_violation_is_truncated_locally(pipeline):
+    calls, _ = pipeline
+    response = asyncio.run(main.finish_turn(0, make_request(), LONG_REPLY))
+    assert calls == {"critique": 1, "refine": 0}
+    assert equivalent_length(response.final_response) <= 88
+    assert response.refined_response == response.final_response
+    assert response.final_response.endswith("。")
+    assert LONG_REPLY.startswith(response.final_response)
+    assert not response.problems_detected
+    assert "原则B" in response.critique_response
+
+
+def test_other_violations_are_refined(pipeline):
+    calls, verdicts = pipeline
+    verdicts.append(CritiqueVerdict(verdict="violation", principles=["原则A"], critique="时间与时间线矛盾"))
+    response = asyncio.run(main.finish_turn(0, make_request(), LONG_REPLY))
+    assert calls == {"critique": 2, "refine": 1}
+    assert response.final_response == SHORT_REPLY
+
+
+def test_structured_violation_without_principles_is_refined(pipeline):
+    calls, verdicts = pipeline
+    verdicts.append(CritiqueVerdict(verdict="violation"))
+    response = asyncio.run(main.finish_turn(0, make_request(), SHORT_REPLY))
+    assert calls["refine"] == 1
+    assert response.refined_response == SHORT_REPLY
+
+
+def test_disabled(pipeline, monkeypatch):
+    calls, _ = pipeline
+    monkeypatch.setattr(main, "LOCAL_TRUNCATION", False)
+    response = asyncio.run(main.finish_turn(0, make_request(), LONG_REPLY))
+    assert calls == {"critique": 2, "refine": 1}
+    assert response.final_response == SHORT_REPLY
+
+
+def test_refined_reply_that_is_only_too_long_is_truncated(pipeline, monkeypatch):
+    calls, verdicts = pipeline
+    verdicts.append(CritiqueVerdict(verdict="violation", principles=["原则A"]))
+
+    async def refine(*args):
+        calls["refine"] += 1
+        return LONG_REPLY
+
+    monkeypatch.setattr(main, "refine", refine)
+    response = asyncio.run(main.finish_turn(0, make_request(), SHORT_REPLY))
+    assert calls == {"critique": 2, "refine": 1}
+    assert equivalent_length(response.final_response) <= 88
+    assert not response.problems_detected
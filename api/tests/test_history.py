@@ -0,0 +1,139 @@
+import asyncio
+
+from history import HistoryCompactor
+from invoke_types import Actor, InvocationRequest, LLMMessage
+
+
+def make_request(turns: int, session_id: str = "s") -> InvocationRequest:
+    # Every message is 10 tokens (one per ideograph)
+    messages = []
+    for i in range(turns):
+        messages.append(LLMMessage(role="user", content=f"问题{'问' * 8}{i % 10}"[:10]))
+        messages.append(LLMMessage(role="assistant", content=f"回答{'答' * 8}"))
+    messages.append(LLMMessage(role="user", content="最后一个问题问问问问"))
+    actor = Actor(name="远野", bio="", personality="", context1="", secret="", violation="", messages=messages)
+    return InvocationRequest(global_story="", actor=actor, session_id=session_id, character_file_version="test")
+
+
+def make_compactor() -> HistoryCompactor:
+    return HistoryCompactor(max_size=10, token_budget=100, recent_tokens=40, min_recent_messages=2)
+
+
+async def settle(compactor: HistoryCompactor):
+    # Until the background summaries have finished and been stored
+    while compactor._pending:
+        await asyncio.sleep(0)
+
+
+class Summarizer:
+    def __init__(self, fail: bool = False):
+        self.fail = fail
+        self.calls = []
+
+    async def __call__(self, turn_id, request, previous_summary, messages):
+        self.calls.append((previous_summary, len(messages)))
+        if self.fail:
+            raise ValueError("provider down")
+        return f"{previous_summary or ''}+{len(messages)}"
+
+
+def test_short_history_is_sent_as_is():
+    summarizer = Summarizer()
+
+    async def scenario():
+        return make_compactor().compact(0, make_request(3), summarizer)
+
+    compacted = asyncio.run(scenario())
+    assert compacted.summary is None
+    assert len(compacted.messages) == 7
+    assert summarizer.calls == []
+
+
+def test_summary_is_built_in_the_background():
+    summarizer = Summarizer()
+    compactor = make_compactor()
+
+    async def scenario():
+        request = make_request(10)
+        # No summary yet: the full history goes out and the summary is generated in the background
+        first = compactor.compact(0, request, summarizer)
+        await settle(compactor)
+        second = compactor.compact(0, request, summarizer)
+        return request, first, second
+
+    request, first, second = asyncio.run(scenario())
+    assert first.summary is None
+    assert first.messages == request.actor.messages
+    # 21 messages: the recent window is the last 40 tokens, widened back to start with a user message
+    assert summarizer.calls == [(None, 16)]
+    assert second.summary == "+16"
+    assert second.messages == request.actor.messages[16:]
+    assert second.messages[0].role == "user"
+    assert compactor.compacted == 1
+
+
+def test_summary_is_extended_incrementally():
+    summarizer = Summarizer()
+    compactor = make_compactor()
+
+    async def scenario():
+        compactor.compact(0, make_request(10), summarizer)
+        await settle(compactor)
+        longer = make_request(12)
+        compactor.compact(0, longer, summarizer)
+        await settle(compactor)
+        return compactor.compact(0, longer, summarizer)
+
+    compacted = asyncio.run(scenario())
+    # The second summary only reads the messages the first one did not cover
+    assert summarizer.calls == [(None, 16), ("+16", 4)]
+    assert compacted.summary == "+16+4"
+    assert len(compacted.messages) == 5
+
+
+def test_stale_summary_is_not_used():
+    summarizer = Summarizer()
+    compactor = make_compactor()
+
+    async def scenario():
+        compactor.compact(0, make_request(10), summarizer)
+        await settle(compactor)
+        edited = make_request(10)
+        edited.actor.messages[0] = LLMMessage(role="user", content="另一个问题")
+        return compactor.compact(0, edited, summarizer)
+
+    compacted = asyncio.run(scenario())
+    assert compacted.summary is None
+    assert len(compacted.messages) == 21
+
+
+def test_one_summary_per_session_at_a_time():
+    summarizer = Summarizer()
+    compactor = make_compactor()
+
+    async def scenario():
+        for _ in range(3):
+            compactor.compact(0, make_request(10), summarizer)
+        compactor.compact(0, make_request(10, session_id="other"), summarizer)
+        await settle(compactor)
+
+    asyncio.run(scenario())
+    assert len(summarizer.calls) == 2
+
+
+def test_failed_summary_keeps_the_full_history():
+    summarizer = Summarizer(fail=True)
+    compactor = make_compactor()
+
+    async def scenario():
+        compactor.compact(0, make_request(10), summarizer)
+        await settle(compactor)
+        compacted = compactor.compact(0, make_request(10), summarizer)
+        await settle(compactor)
+        return compacted
+
+    compacted = asyncio.run(scenario())
+    assert compacted.summary is None
+    assert len(compacted.messages) == 21
+    # The next turn tries again
+    assert compactor.failed == 2
@@ -0,0 +1,57 @@
+import asyncio
+
+import pytest
+
+import ai
+import router
+from metrics import llm_errors_total, render_metrics, span, stage_seconds
+from router import Backend
+
+
+def model_keys(metric) -> set[str]:
+    index = metric.labelnames.index("model_key")
+    return {key[index] for key in metric._values}
+
+
+@pytest.fixture
+def backends(monkeypatch):
+    primary, secondary = Backend("primary", "model-a"), Backend("secondary", "model-b")
+    monkeypatch.setitem(router._stages, "refine", [primary, secondary])
+    monkeypatch.setattr(router, "ROUTER_HEDGE_AFTER", 0)
+    monkeypatch.setattr(stage_seconds, "_values", {})
+    monkeypatch.setattr(llm_errors_total, "_values", {})
+    return primary, secondary
+
+
+def fake_provider(failing: set[str]):
+    async def call_provider(backend, prompt_role, system_prompt, messages, static_prefix, structured):
+        if backend.service in failing:
+            raise ValueError(f"{backend.service} is down")
+        return "我在书房。", {"input_tokens": 10, "output_tokens": 5, "cache_read_tokens": 0, "cache_write_tokens": 0}
+
+    return call_provider
+
+
+def test_span_labels(monkeypatch):
+    monkeypatch.setattr(stage_seconds, "_values", {})
+    with span("refine", 1, "model-x:200:1") as labels:
+        labels["model_key"] = "model-y:200:1"
+    assert model_keys(stage_seconds) == {"model-y:200:1"}
+
+
+def test_stage_is_labelled_with_the_backend_that_served_it(backends, monkeypatch):
+    primary, secondary = backends
+    monkeypatch.setattr(ai, "call_provider", fake_provider({"primary"}))
+    assert asyncio.run(ai.invoke_ai(0, "refine", "system", [])) == "我在书房。"
+    assert model_keys(stage_seconds) == {secondary.model_key}
+    assert model_keys(llm_errors_total) == set()
+
+
+def test_errors_are_labelled_with_the_last_backend_tried(backends, monkeypatch):
+    primary, secondary = backends
+    monkeypatch.setattr(ai, "call_provider", fake_provider({"primary", "secondary"}))
+    with pytest.raises(ValueError):
+        asyncio.run(ai.invoke_ai(0, "refine", "system", []))
+    assert model_keys(stage_seconds) == {secondary.model_key}
+    assert model_keys(llm_errors_total) == {secondary.model_key}
+    assert f'model_key="{secondary.model_key}"' in render_metrics()
@@ -0,0 +1,62 @@
+import pytest
+
+from invoke_types import Actor, InvocationRequest
+from precheck import register_entities, score_reply
+
+
+@pytest.fixture(scope="module", autouse=True)
+def entities():
+    register_entities(["宝生玛格", "安安", "远野"])
+
+
+def make_request(**actor) -> InvocationRequest:
+    fields = {
+        "name": "远野",
+        "bio": "",
+        "personality": "",
+        "context1": "我晚上8点在书房看书。",
+        "secret": "我和死者有金钱纠纷，欠了他一大笔钱。",
+        "violation": "原则1：不要提及画作和安安的联系。原则2：不要透露金钱纠纷。",
+        "messages": [],
+        **actor,
+    }
+    return InvocationRequest(global_story="庄园里发生了命案。", actor=Actor(**fields), session_id="s",
+                             character_file_version="test")
+
+
+def test_reply_without_facts_is_safe():
+    result = score_reply(make_request(), "我不太清楚，你去问别人吧。")
+    assert result.score == 0
+    assert result.safe
+
+
+def test_known_facts_score_less_than_unknown_ones():
+    known = score_reply(make_request(), "我8点在书房。")
+    unknown = score_reply(make_request(), "我11点在厨房。")
+    assert 0 < known.score < unknown.score
+    assert not known.safe
+    assert "time 11 not in character text" in unknown.reasons
+
+
+def test_entity_named_in_principles():
+    result = score_reply(make_request(), "安安吗？")
+    assert "mentions 安安 named in principles" in result.reasons
+
+
+def test_entity_named_in_secret():
+    result = score_reply(make_request(secret="宝生玛格知道我欠钱。"), "玛格跟你说了什么？")
+    assert "mentions 宝生玛格 named in secret" in result.reasons
+
+
+def test_own_name_is_not_an_entity():
+    assert score_reply(make_request(), "我是远野。").score == 0
+
+
+def test_principle_and_secret_overlap():
+    result = score_reply(make_request(), "我和死者之间的金钱纠纷跟这件事无关。")
+    assert any(reason.startswith("overlaps principle 2") for reason in result.reasons)
+
+
+def test_actor_threshold():
+    request = make_request(precheck_threshold=10)
+    assert score_reply(request, "我8点在书房。").safe
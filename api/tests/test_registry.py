@@ -0,0 +1,82 @@
+import json
+
+import pytest
+
+import registry
+from invoke_types import LLMMessage, RegisteredInvocationRequest
+from registry import get_character_file, load_character_files, load_context_mapping, resolve_request
+
+CHARACTERS = {
+    "fileKey": "test-characters::v1",
+    "globalStory": "庄园里发生了命案。",
+    "characters": [
+        {"name": "远野", "bio": "", "personality": "", "context1": "我晚上8点在书房。", "secret": "", "violation": "",
+         "context2": "我看到了一把钥匙。", "context3": "我听到了争吵。", "context4": "",
+         "lastcontext": "其实我就是凶手。"},
+        {"name": "安安", "bio": "", "personality": "", "context1": "我在花园。", "secret": "", "violation": ""},
+    ],
+}
+MAPPING = {"远野": {"key": "context2", "letter": "context3", "knife": "lastcontext", "photo": False}}
+
+
+@pytest.fixture
+def character_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(registry, "_files", {})
+    monkeypatch.setattr(registry, "_evidence_contexts", {})
+    mapping_path = tmp_path / "context2Mapping.json"
+    mapping_path.write_text(json.dumps(MAPPING, ensure_ascii=False), encoding="utf-8")
+    monkeypatch.setattr(registry, "load_context_mapping", lambda: load_context_mapping(mapping_path))
+    path = tmp_path / "characters.json"
+    path.write_text(json.dumps(CHARACTERS, ensure_ascii=False), encoding="utf-8")
+    load_character_files([path])
+    return path
+
+
+def context1(actor_id, evidence_ids: list[str]) -> str:
+    request = RegisteredInvocationRequest(character_file_version="test-characters::v1", actor_id=actor_id,
+                                          session_id="s", messages=[LLMMessage(role="user", content="你好")],
+                                          evidence_ids=evidence_ids)
+    return resolve_request(request).actor.context1
+
+
+def test_variants_are_precomputed(character_file):
+    contexts = get_character_file("test-characters::v1").contexts
+    # context4 is empty: every subset of context2 / context3, and lastcontext once both are unlocked
+    assert sorted(contexts["远野"]) == ["", "context2", "context2+context3", "context2+context3+lastcontext",
+                                        "context3"]
+    assert list(contexts["安安"]) == [""]
+    # Also reachable by file name
+    assert get_character_file("characters") is get_character_file("test-characters::v1")
+
+
+def test_unlocked_contexts_are_appended_in_a_fixed_order(character_file):
+    assert context1(0, []) == "我晚上8点在书房。"
+    assert context1(0, ["key"]) == "我晚上8点在书房。\n\n我看到了一把钥匙。"
+    assert context1(0, ["letter", "key"]) == context1(0, ["key", "letter"]) \
+        == "我晚上8点在书房。\n\n我看到了一把钥匙。\n\n我听到了争吵。"
+
+
+def test_lastcontext_needs_every_other_context(character_file):
+    assert "凶手" not in context1(0, ["knife"])
+    assert "凶手" not in context1(0, ["knife", "key"])
+    assert context1(0, ["knife", "key", "letter"]).endswith("其实我就是凶手。")
+
+
+def test_unknown_and_unmapped_evidence(character_file):
+    assert context1(0, ["photo", "nothing"]) == "我晚上8点在书房。"
+    # The mapping is per actor
+    assert context1("安安", ["key"]) == "我在花园。"
+
+
+def test_duplicate_file_key_is_rejected(character_file, tmp_path):
+    # Reloading the same file is fine
+    load_character_files([character_file])
+    other = tmp_path / "characters2.json"
+    other.write_text(json.dumps(CHARACTERS, ensure_ascii=False), encoding="utf-8")
+    with pytest.raises(ValueError, match="reuses fileKey"):
+        load_character_files([other])
+
+
+def test_missing_file(character_file, tmp_path):
+    with pytest.raises(FileNotFoundError):
+        load_character_files([tmp_path / "missing.json"])
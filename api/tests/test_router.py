@@ -0,0 +1,87 @@
+import asyncio
+
+import pytest
+
+import router
+from admission import ProviderUnavailable
+from router import Backend, route, stage_backends
+
+
+@pytest.fixture
+def backends(monkeypatch):
+    first, second, third = Backend("one", "m1"), Backend("two", "m2"), Backend("three", "m3")
+    monkeypatch.setitem(router._stages, "critique", [first, second, third])
+    monkeypatch.setattr(router, "ROUTER_HEDGE_AFTER", 0)
+    return first, second, third
+
+
+def make_call(latencies: dict[str, float], failing: set[str] = frozenset(), calls: list | None = None):
+    async def call(backend: Backend):
+        if calls is not None:
+            calls.append(backend.service)
+        await asyncio.sleep(latencies.get(backend.service, 0))
+        if backend.service in failing:
+            raise ValueError(f"{backend.service} failed")
+        return backend.service
+
+    return call
+
+
+def test_first_backend_serves(backends):
+    calls = []
+    backend, result = asyncio.run(route("critique", make_call({}, calls=calls)))
+    assert (backend, result) == (backends[0], "one")
+    assert calls == ["one"]
+
+
+def test_failover(backends):
+    first, second, _ = backends
+    backend, result = asyncio.run(route("critique", make_call({}, failing={"one"})))
+    assert backend is second
+    assert first.failovers == 1
+    assert first.error_rate == 1.0
+
+
+def test_every_backend_failing_raises_the_last_error(backends):
+    with pytest.raises(ValueError, match="three failed"):
+        asyncio.run(route("critique", make_call({}, failing={"one", "two", "three"})))
+
+
+def test_local_rejection_is_not_counted_against_the_backend(backends):
+    first, second, _ = backends
+
+    async def call(backend: Backend):
+        if backend is first:
+            raise ProviderUnavailable("Provider queue is full", retry_after=1.0)
+        return backend.service
+
+    assert asyncio.run(route("critique", call))[0] is second
+    assert first.error_rate == 0.0
+
+
+def test_hedging(backends, monkeypatch):
+    first, second, _ = backends
+    monkeypatch.setattr(router, "ROUTER_HEDGE_AFTER", 0.05)
+    calls = []
+    backend, _ = asyncio.run(route("critique", make_call({"one": 1.0, "two": 0}, calls=calls)))
+    assert backend is second
+    assert calls == ["one", "two"]
+    assert first.hedges == 1
+    # The slow call was cancelled, not recorded as a failure
+    assert first.error_rate == 0.0
+
+
+def test_unhealthy_backends_are_tried_last(backends):
+    first, second, third = backends
+    for _ in range(router.MIN_SAMPLES):
+        first.record(False, 0.1)
+    assert stage_backends("critique") == [second, third, first]
+
+
+def test_slow_backends_are_tried_after_fast_ones(backends, monkeypatch):
+    first, second, third = backends
+    monkeypatch.setattr(router, "ROUTER_SLOW_LATENCY", 1.0)
+    for _ in range(router.MIN_SAMPLES):
+        first.record(True, 5.0)
+        second.record(True, 0.2)
+    assert stage_backends("critique") == [second, third, first]
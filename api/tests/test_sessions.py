@@ -0,0 +1,57 @@
+import asyncio
+
+from invoke_types import LLMMessage
+from sessions import SessionStore
+
+KEY = ("session", "远野")
+
+
+def messages(*contents: str) -> list[LLMMessage]:
+    return [LLMMessage(role="user" if i % 2 == 0 else "assistant", content=content)
+            for i, content in enumerate(contents)]
+
+
+def test_disk_store_replays_deltas(tmp_path):
+    async def scenario():
+        store = SessionStore("disk", max_size=10, ttl=60, directory=tmp_path)
+        await store.append(KEY, 0, messages("q1", "a1"))
+        await store.append(KEY, 2, messages("q2", "a2"))
+        # A resync rewrites the tail
+        await store.append(KEY, 2, messages("q2'", "a2'"))
+
+        # Another worker has nothing cached and replays the deltas
+        other = SessionStore("disk", max_size=10, ttl=60, directory=tmp_path)
+        return await other.load(KEY)
+
+    assert [msg.content for msg in asyncio.run(scenario())] == ["q1", "a1", "q2'", "a2'"]
+
+
+def test_stale_cache_is_reloaded(tmp_path):
+    async def scenario():
+        store = SessionStore("disk", max_size=10, ttl=60, directory=tmp_path)
+        other = SessionStore("disk", max_size=10, ttl=60, directory=tmp_path)
+        await store.append(KEY, 0, messages("q1", "a1"))
+        assert len(await other.load(KEY)) == 2
+        # The next turn is served by the first worker
+        await store.append(KEY, 2, messages("q2", "a2"))
+        cached = await other.load(KEY)
+        reloaded = await other.load(KEY, expected_length=4)
+        return cached, reloaded
+
+    cached, reloaded = asyncio.run(scenario())
+    assert len(cached) == 2
+    assert [msg.content for msg in reloaded] == ["q1", "a1", "q2", "a2"]
+
+
+def test_memory_store_lru(tmp_path):
+    async def scenario():
+        store = SessionStore("memory", max_size=1, ttl=60, directory=tmp_path)
+        await store.append(("a", "x"), 0, messages("q1"))
+        await store.append(("b", "x"), 0, messages("q1"))
+        kept = await store.load(("b", "x"))
+        return await store.load(("a", "x")), kept
+
+    evicted, kept = asyncio.run(scenario())
+    assert evicted == []
+    assert [msg.content for msg in kept] == ["q1"]
+    assert not list(tmp_path.iterdir())
@@ -0,0 +1,44 @@
+from text import equivalent_length, truncate_to_length, over_length
+
+
+def test_equivalent_length():
+    assert equivalent_length("") == 0
+    assert equivalent_length("我在书房") == 4
+    # Half-width characters count half, rounded up
+    assert equivalent_length("abc") == 2
+    assert equivalent_length("八点 ok") == 4
+    # Full-width punctuation and the quotation marks Chinese text uses count as one
+    assert equivalent_length("“好，”") == 4
+    # Extension B ideographs
+    assert equivalent_length("\U00020000") == 1
+
+
+def test_over_length():
+    assert over_length(["我" * 88, "我" * 89, None]) == [False, True, False]
+
+
+def test_truncate_keeps_short_text():
+    text = "我" * 88
+    assert truncate_to_length(text) is text
+
+
+def test_truncate_at_sentence_end():
+    text = "我" * 60 + "。" + "你" * 60 + "。"
+    assert truncate_to_length(text) == "我" * 60 + "。"
+
+
+def test_truncate_at_clause_break():
+    text = "我" * 10 + "。" + "你" * 60 + "，" + "他" * 60
+    assert truncate_to_length(text) == "我" * 10 + "。" + "你" * 60 + "。"
+
+
+def test_truncate_without_breaks():
+    result = truncate_to_length("我" * 200, limit=20)
+    assert result == "我" * 19 + "。"
+    assert equivalent_length(result) == 20
+
+
+def test_truncate_mixed_width():
+    result = truncate_to_length("abc " * 100, limit=10)
+    assert equivalent_length(result) <= 10
+    assert result.endswith("。")
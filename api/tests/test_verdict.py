@@ -0,0 +1,77 @@
+import pytest
+
+from verdict import CritiqueVerdict, parse_verdict
+
+
+def test_empty_critique_passes():
+    assert parse_verdict("").passed
+    assert parse_verdict(None).passed
+
+
+def test_none_marker_passes():
+    assert parse_verdict("NONE!").passed
+    assert parse_verdict("违反的原则：无").passed
+
+
+def test_free_text_violation():
+    text = '引用："我在书房" 批评：透露了案发时的位置 违反的原则：原则1'
+    verdict = parse_verdict(text)
+    assert verdict.verdict == "violation"
+    assert verdict.principles == ["原则1"]
+    assert verdict.quotes == ["我在书房"]
+    assert verdict.to_text() == text
+
+
+def test_negation_after_violation_is_not_a_pass():
+    verdict = parse_verdict("批评：回复提到了画作。除此之外没有发现其他违反")
+    assert verdict.verdict == "violation"
+
+
+def test_violation_marker_is_not_overridden():
+    assert not parse_verdict("NONE! 不过再看一遍，批评：回复透露了秘密").passed
+    verdict = parse_verdict("批评：回答泄露秘密。违反的原则：原则A。除此之外NONE!")
+    assert verdict.verdict == "violation"
+    assert verdict.principles == ["原则A"]
+
+
+def test_principle_starting_with_none_character():
+    verdict = parse_verdict("违反的原则：无中生有，编造了不存在的证人")
+    assert verdict.verdict == "violation"
+
+
+def test_json_verdict():
+    verdict = parse_verdict('```json\n{"verdict": "violation", "principles": ["原则A"], "quotes": ["八点"], '
+                            '"critique": "时间与时间线矛盾"}\n```')
+    assert verdict.verdict == "violation"
+    assert verdict.principles == ["原则A"]
+    assert verdict.to_text() == '引用："八点" 批评：时间与时间线矛盾 违反的原则：原则A'
+
+
+def test_invalid_json_falls_back_to_free_text():
+    assert parse_verdict('{"verdict": "maybe"} NONE!').passed
+    assert not parse_verdict('{"verdict": "maybe"} 批评：透露了秘密').passed
+
+
+def test_unmarked_text():
+    assert parse_verdict("好的").passed
+    assert not parse_verdict("这个回复违反").passed
+    assert not parse_verdict("这个回复有很多问题，角色不应该这样回答侦探的提问。").passed
+
+
+@pytest.mark.parametrize("verdict", [
+    CritiqueVerdict(verdict="pass"),
+    CritiqueVerdict(verdict="violation"),
+    CritiqueVerdict(verdict="violation", quotes=["我在书房"]),
+    CritiqueVerdict(verdict="violation", critique="透露了案发时的位置"),
+    CritiqueVerdict(verdict="violation", principles=["原则A", "原则1"]),
+    CritiqueVerdict(verdict="violation", principles=["原则A"], quotes=["八点"], critique="时间与时间线矛盾"),
+    CritiqueVerdict(verdict="violation", text="这段回复的语气和角色性格完全不符，需要重写。"),
+    CritiqueVerdict(verdict="violation", text="违反的原则：原则2"),
+], ids=["pass", "bare", "quotes", "critique", "principles", "full", "text", "text with marker"])
+def test_round_trip(verdict):
+    parsed = parse_verdict(verdict.to_text())
+    assert parsed.passed == verdict.passed
+    if not verdict.passed and verdict.text is None:
+        assert parsed.quotes == verdict.quotes
+        if verdict.principles:
+            assert parsed.principles == ["；".join(verdict.principles)]
@@ -0,0 +1,107 @@
+import re
+from typing import Iterable
+
+# 文本工具：等效字数、token 估算、回复规范化和按字数预算截断。
+# 计数都是一次 C 层的正则扫描（subn 只返回替换次数，不构造中间列表），可以直接用于整列已保存的回复。
+
+# Characters counted as one full character: CJK ideographs (including the extension blocks and compatibility
+# ideographs), kana, CJK symbols and punctuation, full-width forms, and the quotation marks, ellipsis and dash that
+# Chinese text sets at full width. Everything else counts as half a character.
+WIDE_CHARS = (
+    '\u2e80-\u2fdf'          # CJK radicals, Kangxi radicals
+    '\u3000-\u303f'          # CJK symbols and punctuation (、。「」《》)
+    '\u3040-\u30ff'          # Hiragana, Katakana
+    '\u3100-\u312f\u3190-\u31ff'
+    '\u3400-\u4dbf'          # Extension A
+    '\u4e00-\u9fff'          # Unified ideographs
+    '\uf900-\ufaff'          # Compatibility ideographs
+    '\ufe30-\ufe4f'          # CJK compatibility forms
+    '\uff01-\uff60\uffe0-\uffe6'  # Full-width forms (，！？：；（）)
+    '\u2014\u2018\u2019\u201c\u201d\u2026'  # — ‘ ’ “ ” …
+    '\U00020000-\U0003134f'  # Extensions B-H, compatibility supplement
+)
+_WIDE = re.compile(f'[{WIDE_CHARS}]')
+# Only ideographs for token estimates: punctuation merges with its neighbours in most tokenizers
+_IDEOGRAPH = re.compile('[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\U00020000-\U0003134f]')
+_LINE_BREAKS_AND_SPACES = re.compile(r'[\r\n ]+')
+# Where a truncated reply may end: after sentence-final punctuation, otherwise after a comma
+_SENTENCE_END = re.compile(r'[。！？!?…；;]+[”’」』）)]*')
+_CLAUSE_END = re.compile(r'[，,、：:]')
+
+MAX_EQUIVALENT_LENGTH = 88  # 原则B
+
+
+def wide_count(text: str) -> int:
+    return _WIDE.subn('', text)[1]
+
+
+def equivalent_length(text: str) -> int:
+    """
+    计算文本的等效字数
+    规则：中文字符（含扩展区汉字和全角标点）每个算1字，其他字符（字母、数字、半角标点、空格等）每2个算1字，向上取整
+    """
+    wide = wide_count(text)
+    return wide + (len(text) - wide + 1) // 2
+
+
+def estimate_tokens(text: str) -> int:
+    # 中文大约每字一个 token，其他字符大约每 4 个一个 token
+    cjk = _IDEOGRAPH.subn('', text)[1]
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def normalize_response(text: str) -> str:
+    # 清理换行符和多余空格，确保输出为单行
+    return _LINE_BREAKS_AND_SPACES.sub(' ', text).strip()
+
+
+def truncate_to_length(text: str, limit: int = MAX_EQUIVALENT_LENGTH) -> str:
+    """
+    Shortens text to at most `limit` equivalent characters, ending it at the last sentence end (or failing that,
+    the last clause break, replaced by 。) that fits, so the reply still reads as complete. Text within the limit
+    is returned unchanged.
+    """
+    if equivalent_length(text) <= limit:
+        return text
+    # Half-character units: a wide character is 2, anything else 1, so `budget` units are `limit` equivalent chars
+    budget = 2 * limit
+    used = 0
+    cut = 0
+    for cut, c in enumerate(text):
+        used += 2 if _WIDE.match(c) else 1
+        if used > budget:
+            break
+    head = text[:cut]
+
+    ends = [m.end() for m in _SENTENCE_END.finditer(head)]
+    # Prefer a sentence end unless it throws away more than half of what fits
+    if ends and ends[-1] * 2 >= len(head):
+        return head[:ends[-1]].rstrip()
+    clauses = [m.start() for m in _CLAUSE_END.finditer(head)]
+    if clauses and clauses[-1] * 2 >= len(head):
+        return _close(head[:clauses[-1]], limit)
+    if ends:
+        return head[:ends[-1]].rstrip()
+    return _close(head, limit)
+
+
+def _close(text: str, limit: int) -> str:
+    # Ends a cut-off clause with 。, dropping characters until it fits again
+    text = text.rstrip() + '。'
+    while equivalent_length(text) > limit:
+        text = text[:-2].rstrip() + '。'
+    return text
+
+
+def equivalent_lengths(texts: Iterable[str | None]) -> list[int]:
+    """equivalent_length over a column of texts (e.g. stored responses); None counts as 0."""
+    return [equivalent_length(text) if text else 0 for text in texts]
+
+
+def normalize_responses(texts: Iterable[str | None]) -> list[str | None]:
+    return [normalize_response(text) if text is not None else None for text in texts]
+
+
+def over_length(texts: Iterable[str | None], limit: int = MAX_EQUIVALENT_LENGTH) -> list[bool]:
+    """Whether each text exceeds the 原则B limit."""
+    return [length > limit for length in equivalent_lengths(texts)]
@@ -0,0 +1,107 @@
+import json
+import re
+
+from pydantic import BaseModel, ValidationError
+
+# 审查结论的解析：审查调用优先请求结构化 JSON 输出（见 ai.call_provider），
+# provider 不支持或模型没有按格式输出时，用一个预编译的正则对自由文本做单遍扫描。
+
+# Passed to providers that support structured output (Anthropic as a forced tool, Ollama as a format schema)
+VERDICT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "verdict": {"type": "string", "enum": ["pass", "violation"]},
+        "principles": {"type": "array", "items": {"type": "string"}},
+        "quotes": {"type": "array", "items": {"type": "string"}},
+        "critique": {"type": "string"},
+    },
+    "required": ["verdict", "principles", "quotes", "critique"],
+}
+
+# Free-text markers, scanned in a single pass. A 批评 / 违反的原则 marker makes the critique a violation whatever
+# follows it (models append "除此之外NONE!" to real violations); otherwise only the explicit NONE! / 违反的原则：无
+# conclusions count as a pass, free-text negations ("除此之外没有发现其他违反") do not
+_MARKERS = re.compile(
+    r'(?P<pass>none!|违反的原则[：:]\s*无(?=[\s。；;，,.]|$))'
+    r'|违反的原则[：:]\s*(?P<principle>[^。\n]+)'
+    r'|引用[：:]\s*["“「]?(?P<quote>[^"”」\n]+?)["”」]?\s*(?=批评|违反的原则|$)'
+    r'|(?P<criticism>批评[：:])',
+    re.IGNORECASE,
+)
+_JSON_OBJECT = re.compile(r'\{.*\}', re.DOTALL)
+# Ends a violation that names no principle, so its text still reads back as a violation
+UNNAMED_PRINCIPLE = "违反的原则：未注明"
+
+
+class CritiqueVerdict(BaseModel):
+    verdict: str  # "pass" or "violation"
+    principles: list[str] = []
+    quotes: list[str] = []
+    critique: str = ""
+    # The free-text critique this was parsed from, if any; it is passed on verbatim
+    text: str | None = None
+
+    @property
+    def passed(self) -> bool:
+        return self.verdict == "pass"
+
+    def to_text(self) -> str:
+        """
+        The critique as the refine prompt and the audit log expect it: NONE! or 引用：... 批评：... 违反的原则：...
+        A violation always carries a violation marker, so parse_verdict reads the text back as a violation.
+        """
+        if self.passed:
+            return "NONE!"
+        if self.text is not None:
+            return self.text if _has_violation_marker(self.text) else f"{self.text} {UNNAMED_PRINCIPLE}"
+        parts = [f'引用："{quote}"' for quote in self.quotes]
+        if self.critique:
+            parts.append(f"批评：{self.critique}")
+        parts.append(f"违反的原则：{'；'.join(self.principles)}" if self.principles else UNNAMED_PRINCIPLE)
+        return " ".join(parts)
+
+
+def _has_violation_marker(text: str) -> bool:
+    return any(match.group("principle") or match.group("criticism") for match in _MARKERS.finditer(text))
+
+
+def _parse_json(text: str) -> CritiqueVerdict | None:
+    match = _JSON_OBJECT.search(text)
+    if match is None:
+        return None
+    try:
+        verdict = CritiqueVerdict.model_validate(json.loads(match.group(0)))
+    except (ValueError, ValidationError):
+        return None
+    return verdict if verdict.verdict in ("pass", "violation") else None
+
+
+def parse_verdict(text: str) -> CritiqueVerdict:
+    """Parses a critique response: JSON when the model produced it, otherwise free text."""
+    text = (text or "").strip()
+    if not text:
+        return CritiqueVerdict(verdict="pass")
+    if "{" in text:
+        verdict = _parse_json(text)
+        if verdict is not None:
+            return verdict
+
+    decision = None
+    principles = []
+    quotes = []
+    for match in _MARKERS.finditer(text):
+        if match.group("pass"):
+            decision = decision or "pass"
+        elif match.group("principle"):
+            decision = "violation"
+            principles.append(match.group("principle").strip())
+        elif match.group("quote"):
+            quotes.append(match.group("quote").strip())
+        else:
+            decision = "violation"
+    if decision is None:
+        # No recognizable marker: a short fragment (e.g. a truncated reply) does not justify a refine round-trip
+        decision = "pass" if len(text) < 20 and "违反" not in text else "violation"
+    if decision == "pass":
+        return CritiqueVerdict(verdict="pass")
+    return CritiqueVerdict(verdict="violation", principles=principles, quotes=quotes, text=text)
@@ -14,6 +14,8 @@ export interface InvokeResponse {
   problems_detected: boolean;
   final_response: string;
   refined_response: string;
+  // 服务端根据 final_response 匹配到的证物ID（旧版后端不返回）
+  evidence_ids?: string[] | null;
 }
 
 export default async function invokeAI({
@@ -50,3 +52,145 @@ export default async function invokeAI({
     throw new Error(`解析响应失败: ${error instanceof Error ? error.message : '未知错误'}`);
   }
 }
+
+export interface InvokeSessionParams {
+  characterFileVersion: string;
+  actorId: number | string;
+  sessionId: string;
+  // 当前角色的完整对话，最后一条是新的用户消息
+  messages: Actor["messages"];
+  extraContext?: string;
+  // 已向该角色出示过的证物ID，由服务端据此选择追加的 context2 / context3 / context4 / lastcontext
+  evidenceIds?: string[];
+}
+
+/**
+ * 增量调用 /invoke/：服务端按 session_id 和角色保存对话历史，只发送新的用户消息。
+ * 服务端的历史与本地不一致时（409，例如服务重启或其他标签页发送过消息），改为发送一次完整历史以重新同步。
+ */
+export async function invokeAISession({
+  characterFileVersion,
+  actorId,
+  sessionId,
+  messages,
+  extraContext,
+  evidenceIds,
+}: InvokeSessionParams): Promise<InvokeResponse> {
+  if (!API_URL) {
+    throw new Error('API URL 未配置。请设置 REACT_APP_API_URL 环境变量或确保后端服务正在运行。');
+  }
+
+  const post = (body: object) => fetch(`${API_URL}/invoke/`, {
+    method: "POST",
+    body: JSON.stringify({
+      character_file_version: characterFileVersion,
+      actor_id: actorId,
+      session_id: sessionId,
+      extra_context: extraContext,
+      evidence_ids: evidenceIds ?? [],
+      ...body,
+    }),
+    headers: {
+      "Content-Type": "application/json",
+    },
+  });
+
+  let resp = await post({
+    message: messages[messages.length - 1],
+    history_length: messages.length - 1,
+  });
+  if (resp.status === 409) {
+    resp = await post({ messages });
+  }
+
+  if (!resp.ok) {
+    const errorText = await resp.text().catch(() => '未知错误');
+    throw new Error(`API 请求失败: ${resp.status} ${resp.statusText}. ${errorText}`);
+  }
+
+  try {
+    return await resp.json();
+  } catch (error) {
+    throw new Error(`解析响应失败: ${error instanceof Error ? error.message : '未知错误'}`);
+  }
+}
+
+export type InvokeStreamEvent =
+  | { type: "token"; text: string }
+  | { type: "confirmed"; response: InvokeResponse }
+  | { type: "refined"; response: InvokeResponse }
+  | { type: "error"; detail: string; status?: number; retry_after?: number };
+
+/**
+ * 流式调用 /invoke/stream（NDJSON）
+ * - onToken 在收到初始回复的每个片段时被调用，参数为目前已收到的完整文本
+ * - 审查通过时收到 confirmed 事件，需要修改时收到 refined 事件（应使用其中的 final_response 替换已显示的文本）
+ * 返回值与 invokeAI 相同
+ */
+export async function invokeAIStream(
+  { globalStory, actor, sessionId, characterFileVersion }: InvokeParams,
+  onToken?: (textSoFar: string) => void,
+): Promise<InvokeResponse> {
+  if (!API_URL) {
+    throw new Error('API URL 未配置。请设置 REACT_APP_API_URL 环境变量或确保后端服务正在运行。');
+  }
+
+  const resp = await fetch(`${API_URL}/invoke/stream`, {
+    method: "POST",
+    body: JSON.stringify({
+      global_story: globalStory,
+      actor,
+      session_id: sessionId,
+      character_file_version: characterFileVersion,
+    }),
+    headers: {
+      "Content-Type": "application/json",
+    },
+  });
+
+  if (!resp.ok || !resp.body) {
+    const errorText = await resp.text().catch(() => '未知错误');
+    throw new Error(`API 请求失败: ${resp.status} ${resp.statusText}. ${errorText}`);
+  }
+
+  const reader = resp.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = "";
+  let textSoFar = "";
+
+  const handleLine = (line: string): InvokeResponse | null => {
+    if (!line.trim()) {
+      return null;
+    }
+    const event = JSON.parse(line) as InvokeStreamEvent;
+    if (event.type === "token") {
+      textSoFar += event.text;
+      onToken?.(textSoFar);
+      return null;
+    }
+    if (event.type === "error") {
+      throw new Error(`API 请求失败: ${event.detail}`);
+    }
+    return event.response;
+  };
+
+  while (true) {
+    const { done, value } = await reader.read();
+    buffer += decoder.decode(value, { stream: !done });
+    const lines = buffer.split("\n");
+    buffer = lines.pop() ?? "";
+    for (const line of lines) {
+      const result = handleLine(line);
+      if (result) {
+        return result;
+      }
+    }
+    if (done) {
+      const result = handleLine(buffer);
+      if (result) {
+        return result;
+      }
+      throw new Error('解析响应失败: 流在返回最终结果前结束');
+    }
+  }
+}
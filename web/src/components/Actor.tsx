@@ -199,11 +199,13 @@ const sendChat = async (
     }
     
     // 检查回复内容是否包含关键词，如果包含则获取对应证物（仅针对ID 11-15）
-    const evidenceId = checkKeywordsAndGetEvidence(data.final_response, actor.name);
-    if (evidenceId && onEvidenceObtained) {
+    // 优先使用服务端匹配的结果，后端未返回时在本地匹配
+    const localEvidenceId = data.evidence_ids ? null : checkKeywordsAndGetEvidence(data.final_response, actor.name);
+    const evidenceIds = data.evidence_ids ?? (localEvidenceId ? [localEvidenceId] : []);
+    for (const evidenceId of evidenceIds) {
       // 只处理ID为11-15的证物
       const evidenceIdNum = parseInt(evidenceId, 10);
-      if (evidenceIdNum >= 11 && evidenceIdNum <= 15) {
+      if (onEvidenceObtained && evidenceIdNum >= 11 && evidenceIdNum <= 15) {
         onEvidenceObtained(evidenceId);
       }
     }